@@ -1,15 +1,66 @@
-from .docker_util import DockerRuntime, detect_runtime
-
-from .list_util import grep
-from .text_finder import TextFinder
-from .zulutime import ZuluTime
-from .arglist import Arglist
-from .report import Report
-from .template import fill_template
-from .fpos import Fpos
-from . import template_parser
-from . import template_instr
-from . import template_tokenizer
-from . import template_vm
+# Submodules and their dependencies (lark, dateutil, pytz, ...) are loaded on first
+# attribute access so that importing the package, eg. from the fill-template command,
+# only pays for what is actually used.
+from importlib import import_module
+
+_exports = {
+    "DockerRuntime": "docker_util",
+    "detect_runtime": "docker_util",
+    "grep": "list_util",
+    "igrep": "list_util",
+    "TextFinder": "text_finder",
+    "NeedleIndex": "text_finder",
+    "ZuluTime": "zulutime",
+    "Arglist": "arglist",
+    "Report": "report",
+    "fill_template": "template",
+    "Fpos": "fpos",
+    "TraceHook": "template_trace",
+    "PrintTrace": "template_trace",
+    "RingBufferTrace": "template_trace",
+    "TemplateMetrics": "template_metrics",
+    "specialize": "template_specialize",
+    "TableSource": "table_source",
+    "load_defines": "define_file",
+    "ParallelLoops": "template_parallel",
+    "FileLoader": "template_loader",
+    "MemoryLoader": "template_loader",
+    "FileWriter": "template_loader",
+    "OutputCollector": "template_loader",
+    "TemplateLimits": "template_limits",
+    "LimitExceeded": "template_limits",
+}
+
+_submodules = [
+    "template_parser",
+    "template_instr",
+    "template_tokenizer",
+    "template_vm",
+    "template_trace",
+    "template_metrics",
+    "template_specialize",
+    "template_parallel",
+    "template_optimize",
+    "template_link",
+    "template_loader",
+    "template_limits",
+]
+
+__all__ = list(_exports) + _submodules
 
 __version__ = "0.1.2"
+
+
+def __getattr__(name):
+    if name in _exports:
+        value = getattr(import_module(f".{_exports[name]}", __name__), name)
+    elif name in _submodules:
+        value = import_module(f".{name}", __name__)
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
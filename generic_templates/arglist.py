@@ -1,3 +1,4 @@
+import os
 import sys
 from copy import copy
 
@@ -22,6 +23,7 @@ class Arglist:
             args = copy(sys.argv[1:]) # skip executable 
         self.opts = {}
         self.args = args
+        self.cwd = None         # directory that response files are read from, instead of the working directory
 
     def __len__(self):
         return len(self.args)
@@ -62,19 +64,60 @@ class Arglist:
         #self.shift_opts()
         return self._shift(default)
     
-    def stack_opts(self, options : str):
+    def read_response_file(self, path : str):
+        """ - Inserts the arguments in the response file 'path' in place of '@path'.  Each line of the file
+        is one argument, so arguments can contain spaces without being quoted.  Blank lines and lines
+        starting with '#' are skipped.
+        """
+        if self.cwd is not None:
+            path = os.path.join(self.cwd, path)
+        with open(path, "rt") as f:
+            lines = [ x.strip() for x in f ]
+        self.args[0:0] = [ x for x in lines if x and not x.startswith('#') ]
+
+    def stack_opts(self, options : str, long_options=()):
+        """ - Shifts single letter options in the style of getopt.  Options that take a parameter are
+        followed by ':' in 'options', and the parameter is either the next argument or the remainder of
+        the option ('-DNAME=value').  Long options ('--name value' or '--name=value') are listed in
+        'long_options', with a trailing '=' if they take a parameter.  An '@file' argument in place of an
+        option is replaced by the arguments in the file (see read_response_file).
+        """
         arg =  self._peek()
-        while arg and len(arg)==2 and arg[0]=='-':
+        while arg and len(arg)>=2 and arg[0] in '-@':
             #print(arg, '/', self.args)
-            self._shift()
-            opt = arg[1]
-            optarg = options.find(opt)
-            if optarg < 0:
-                raise ValueError(f"Invalid option -{opt}")
-            param = True
-            #print("arg", arg, "optarg", optarg, "param") #, options[optarg+1])
-            if len(options)>optarg+1 and options[optarg+1]==':':
-                param=self._shift()
+            if arg[0] == '@':
+                self._shift()
+                self.read_response_file(arg[1:])
+                arg = self._peek()
+                continue
+            if arg == '--':
+                self._shift()
+                break
+            if arg[1] == '-':
+                self._shift()
+                opt, eq, param = arg[2:].partition('=')
+                if opt in long_options:
+                    if eq:
+                        raise ValueError(f"Option --{opt} doesn't take a parameter")
+                    param = True
+                elif opt + '=' in long_options:
+                    if not eq:
+                        param = self._shift()
+                else:
+                    raise ValueError(f"Invalid option --{opt}")
+            else:
+                opt = arg[1]
+                optarg = options.find(opt)
+                takes_param = optarg >= 0 and len(options)>optarg+1 and options[optarg+1]==':'
+                if len(arg)>2 and not takes_param:
+                    break
+                self._shift()
+                if optarg < 0:
+                    raise ValueError(f"Invalid option -{opt}")
+                param = True
+                #print("arg", arg, "optarg", optarg, "param") #, options[optarg+1])
+                if takes_param:
+                    param = arg[2:] if len(arg)>2 else self._shift()
             if opt not in self.opts:
                 self.opts[opt] = []
             self.opts[opt].append(param)
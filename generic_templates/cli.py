@@ -0,0 +1,92 @@
+import os
+import sys
+from .arglist import Arglist
+from .template import fill_template
+
+
+def usage(appname:str):
+    """- Shows usage information for fill-template.py"""
+    print(f"Usage: {appname} [-D <VARNAME>[=<value>]] [--env-file <file>] [-M <metrics-file>] [-m] [-C <cache-dir>] [-T [<prefix>=]<table>] [-j <workers>] [-I <dir>] [@<response-file>] <templatefile> [template-argument...]")
+    print("  --env-file <file>  load defines from a file of NAME=value lines, or a JSON object if the file ends in .json,")
+    print("                     where lists can be used as #for lists; -D defines override them.  May be repeated")
+    print("  @<response-file>   read more options from a file, one argument per line")
+    print("  -M <metrics-file>  write per-stage metrics as JSON lines, or Prometheus text if the file ends in .prom")
+    print("  -m                 include peak traced memory in the metrics (slower)")
+    print("  -C <cache-dir>     reuse rendered results stored in cache-dir when the template, defines and arguments repeat")
+    print("  -T [<prefix>=]<table>  bind each column of a .csv, .tsv or .jsonl table to the symbol <prefix><column>,")
+    print("                     for use as a #for list; rows are read as the loop advances")
+    print("  -j <workers>       render large #for loops that don't change any variables on a pool of worker processes")
+    print("  -I <dir>           search <dir> for the template and its #include files, may be repeated")
+    sys.exit(1)
+
+def main(args : Arglist, cache=None, render_cache=None, cwd=None, environ=None):
+    """- Runs the fill-template command
+    Args:
+        args :Arglist: The command line arguments
+        cache :TemplateCache: Optional cache of compiled templates (used by template_daemon)
+        render_cache :RenderCache: Optional cache of rendered results (used by template_daemon)
+        cwd :str: Directory that the paths in 'args' are relative to, instead of the working directory
+            (used by template_daemon)
+        environ :Dict[str, str]: Environment variables for '@env:' substitutions, instead of os.environ
+    """
+    def resolve(path):
+        return path if cwd is None or path is None else os.path.join(cwd, path)
+
+    _app = args.program
+    env = {}
+    args.cwd = cwd
+    args.stack_opts("D:M:mC:T:j:I:", [ "env-file=" ])
+    env_files = args.opt('env-file', [])
+    if env_files:
+        from .define_file import load_defines
+        for path in env_files:
+            env.update(load_defines(resolve(path)))
+    for opt in args.opt('D', []):
+        if '=' in opt:
+            name,value = opt.split("=", 1)
+            env[name] = value
+        else:
+            env[opt] = True
+    tables = args.opt('T', [])
+    if tables:
+        from .table_source import TableSource
+        for opt in tables:
+            prefix, _, path = opt.partition("=") if "=" in opt else ("", "", opt)
+            env.update(TableSource(resolve(path)).bind(prefix))
+    search_path = args.opt('I', [])
+    loader = None
+    if search_path or cwd is not None:
+        from .template_loader import FileLoader
+        loader = FileLoader(search_path, root=cwd)
+    template_file = args.shift()
+    if template_file and loader is not None:
+        template_file = loader.find(template_file)
+    if not template_file or not os.path.isfile(template_file):
+        usage(_app)
+
+    metrics_file = resolve(args.opt('M', [None])[-1])
+    metrics = None
+    if metrics_file:
+        from .template_metrics import TemplateMetrics
+        metrics = TemplateMetrics(template_file, trace_memory=bool(args.opt('m')))
+
+    cache_dir = resolve(args.opt('C', [None])[-1])
+    if cache_dir:
+        from .render_cache import RenderCache
+        render_cache = RenderCache(directory=cache_dir)
+
+    workers = args.opt('j', [None])[-1]
+    parallel = None
+    if workers:
+        from .template_parallel import ParallelLoops
+        parallel = ParallelLoops(int(workers))
+
+    # process the template
+    try:
+        fill_template(template_file, env, *args.args, metrics=metrics, cache=cache, render_cache=render_cache,
+                      parallel=parallel, loader=loader, cwd=cwd, environ=environ)
+    finally:
+        if parallel:
+            parallel.close()
+    if metrics:
+        metrics.write(metrics_file)
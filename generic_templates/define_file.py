@@ -0,0 +1,86 @@
+"""Bulk loading of preprocessor defines from files.
+
+A generator that passes thousands of symbols can put them in a define file rather than
+on the command line, where they would run into the argv length limit:
+
+    $ fill-template --env-file datasets.env --env-file hosts.json foo.py.template
+
+Files ending in .json hold one JSON object mapping symbol names to values.  The values keep
+their JSON types, so a list can be used directly as a #for list:
+
+    { "@ENVIRON": "prod", "@NLIST": ["a", "b"], "@VLIST": [1, 2] }
+
+Any other file is read as an env file of NAME=value lines.  Blank lines and '#' comments are
+skipped, a leading 'export ' is ignored and quotes around the value are removed.  A value
+written as a JSON array is loaded as a list, and a line without '=' defines the symbol as
+True, like '-D NAME':
+
+    # datasets
+    export @ENVIRON=prod
+    @DATASETS=["/data/sales", "/data/stock"]
+    DEBUG
+"""
+import json
+import re
+
+from typing import Any, Dict
+
+ESCAPE = re.compile(r"\\(.)")
+ESCAPES = { "n": "\n", "t": "\t", "r": "\r" }
+
+
+def unquote(value : str):
+    """- Returns an env file value with its quotes removed, or the list for a JSON array"""
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in "\"'":
+        if value[0] == "'":
+            return value[1:-1]
+        return ESCAPE.sub(lambda m: ESCAPES.get(m.group(1), m.group(1)), value[1:-1])
+    if value.startswith("["):
+        try:
+            return json.loads(value)
+        except ValueError:
+            pass
+    return value
+
+
+def read_env_file(path : str) -> Dict[str, Any]:
+    """- Returns the defines of an env file
+    Args:
+        path :str: Path of the file
+    """
+    defines = {}
+    with open(path, "rt") as f:
+        for n, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("export "):
+                line = line[7:].lstrip()
+            name, eq, value = line.partition("=")
+            name = name.strip()
+            if not name:
+                raise ValueError(f"{path}:{n}: missing symbol name")
+            defines[name] = unquote(value.strip()) if eq else True
+    return defines
+
+
+def read_json_defines(path : str) -> Dict[str, Any]:
+    """- Returns the defines of a JSON define file
+    Args:
+        path :str: Path of the file
+    """
+    with open(path, "rt") as f:
+        defines = json.load(f)
+    if not isinstance(defines, dict):
+        raise ValueError(f"{path}: expected a JSON object of symbol names and values")
+    return defines
+
+
+def load_defines(path : str) -> Dict[str, Any]:
+    """- Returns the defines of a define file, a JSON object if the file ends in .json, otherwise an env file
+    Args:
+        path :str: Path of the file
+    """
+    if path.endswith(".json"):
+        return read_json_defines(path)
+    return read_env_file(path)
@@ -6,36 +6,134 @@ class ErrorLevel(Enum):
     WARN=1
     ERROR=2
 
+def position(where):
+    """ Returns 'line L, column C' for a lark Token (or anything with 'line' and 'column'
+    attributes), a (line, column) tuple or a line number """
+    if isinstance(where, tuple):
+        line, column = where
+    elif isinstance(where, int):
+        line, column = where, None
+    else:
+        line, column = getattr(where, "line", None), getattr(where, "column", None)
+    if column is None:
+        return f"line {line}"
+    return f"line {line}, column {column}"
+
 class ErrorReport:
     Level = ErrorLevel #NOSONAR
 
-    def __init__(self):
+    def __init__(self, aggregate=False, limit=None, buffered=False):
+        """
+        aggregate - report each distinct message once and count its repeats
+        limit - record at most this many (distinct) messages, the rest are only counted
+        buffered - hold messages until flush() (or exit_on_error()) instead of printing each one
+        """
         self.errors = []
+        self.levels = []            # the level of each message in self.errors
         self.max_level : ErrorLevel = ErrorLevel.INFO
+        self.aggregate = aggregate
+        self.limit = limit
+        self.buffered = buffered
+        self.counts = {}            # (level, msg) -> count, when aggregating
+        self.printed = {}           # (level, msg) -> count at the time it was last printed
+        self.pending = []           # (level, msg) waiting to be printed
+        self.dropped = {}           # level name -> messages over the limit
+        self.dropped_printed = 0
 
-    def warn(self, msg):
-        self.show(ErrorLevel.WARN, msg)
+    def warn(self, msg, where=None):
+        self.show(ErrorLevel.WARN, msg, where)
 
-    def info(self, msg):
-        self.show(ErrorLevel.INFO, msg)
+    def info(self, msg, where=None):
+        self.show(ErrorLevel.INFO, msg, where)
 
-    def error(self, msg):
-        self.show(ErrorLevel.ERROR, msg)
+    def error(self, msg, where=None):
+        self.show(ErrorLevel.ERROR, msg, where)
 
-    def show(self, level : ErrorLevel, msg):
-        self.errors.append(msg)
+    def show(self, level : ErrorLevel, msg, where=None):
+        """ Reports a message, 'where' is the template position it refers to (see position()) """
+        if where is not None:
+            msg = f"{position(where)}: {msg}"
+        self.record(level, msg)
+
+    def record(self, level : ErrorLevel, msg, count=1):
         if self.max_level.value < level.value: self.max_level = level
-        print(f"{level.name}: {msg}", file=sys.stderr)
+        if self.aggregate:
+            key = (level, msg)
+            if key in self.counts:
+                self.counts[key] += count
+                return
+            if self.limit is not None and len(self.counts) >= self.limit:
+                self.dropped[level.name] = self.dropped.get(level.name, 0) + count
+                return
+            self.counts[key] = count
+        elif self.limit is not None and len(self.errors) >= self.limit:
+            self.dropped[level.name] = self.dropped.get(level.name, 0) + count
+            return
+        self.errors.append(msg)
+        self.levels.append(level)
+        if not self.buffered:
+            print(f"{level.name}: {msg}", file=sys.stderr)
+            if self.aggregate:
+                self.printed[(level, msg)] = 1
+        elif not self.aggregate:
+            self.pending.append((level, msg))
+
+    def items(self):
+        """ Generates ((level, msg), count) for each recorded message """
+        if self.aggregate:
+            yield from self.counts.items()
+        else:
+            for level, msg in zip(self.levels, self.errors):
+                yield (level, msg), 1
+
+    def merge(self, other):
+        """ Adds the messages of another report, eg. one returned by a worker process, as if
+        they had been reported here """
+        for (level, msg), count in other.items():
+            self.record(level, msg, count)
+        for name, count in other.dropped.items():
+            self.dropped[name] = self.dropped.get(name, 0) + count
+        if self.max_level.value < other.max_level.value: self.max_level = other.max_level
+
+    def summary(self):
+        """ Returns a line counting the messages over the limit, or None """
+        total = sum(self.dropped.values())
+        if not total:
+            return None
+        counts = ", ".join(f"{count} {name}" for name, count in self.dropped.items())
+        return f"... {total} more messages not shown ({counts})"
+
+    def flush(self):
+        """ Prints the buffered messages, the repeat counts of aggregated messages and the
+        summary of messages over the limit, as one write """
+        lines = []
+        if self.aggregate:
+            for key, count in self.counts.items():
+                if count > self.printed.get(key, 0):
+                    level, msg = key
+                    repeats = f" ({count} times)" if count > 1 else ""
+                    lines.append(f"{level.name}: {msg}{repeats}")
+                    self.printed[key] = count
+        else:
+            lines += [ f"{level.name}: {msg}" for level, msg in self.pending ]
+        self.pending = []
+        total = sum(self.dropped.values())
+        if total > self.dropped_printed:
+            lines.append(self.summary())
+            self.dropped_printed = total
+        if lines:
+            sys.stderr.write("\n".join(lines) + "\n")
 
     def exit_on_error(self):
+        self.flush()
         if self.max_level.value > ErrorLevel.WARN.value:
             print("Exiting on error")
             sys.exit(1)
 
     def test(self, condition, msg, level : ErrorLevel = ErrorLevel.ERROR):
         if not condition:
-            self.show(level, msg) 
+            self.show(level, msg)
 
     def to_string(self):
         return "\n".join(self.errors)
-    
+
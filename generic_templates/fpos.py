@@ -1,15 +1,18 @@
 from typing import Union, List
-from io import IOBase, StringIO
+from io import IOBase, StringIO, BytesIO
 
 class Fpos:
     """Windowed view of an input stream"""
-    def __init__(self, data : Union[str, IOBase, List[str]]):
+    def __init__(self, data : Union[str, IOBase, List[str]], encoding : str = None):
         """ - Provides a windowed view of an input stream.  Each line is assumed to be terminated by a newline.
         Args:
         data :Union[str, IOBase, List[str]]: A file path or derivative class of IOBase to read from, or a list of lines
+        encoding :str: Read the stream in bytes mode.  Lines are kept as bytes, except that lines starting with an
+            ASCII '#' (the candidate directives) are decoded with 'encoding' so that they can be tokenized.  The other
+            lines are never decoded, so a template needn't be text, or in an encoding that Python can decode
         """
         if type(data) is str:
-            with open(data, "rt") as f:
+            with open(data, "rt" if encoding is None else "rb") as f:
                 lines = f.readlines()
         elif isinstance(data, IOBase):
             lines = data.readlines()
@@ -17,7 +20,10 @@ class Fpos:
             lines = data
         else:
             raise ValueError("Invalid data")
+        if encoding is not None:
+            lines = [ x.decode(encoding, "surrogateescape") if x[:1] == b'#' else x for x in lines ]
         self.lines = lines
+        self.encoding = encoding
         self.cpos = 0
         self.rpos = 0
 
@@ -26,6 +32,10 @@ class Fpos:
         ios = StringIO(string)
         return Fpos(ios)
 
+    @classmethod
+    def from_bytes(cls, data : bytes, encoding : str = "utf-8"):
+        return Fpos(BytesIO(data), encoding)
+
     @property
     def v(self):
         """- Returns the current row and column view of the stream"""
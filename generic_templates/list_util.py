@@ -1,18 +1,76 @@
 # Simple tools for working with python lists
+import itertools
+import re
+from .text_finder import needle_index
 
-def _grep(_list, needle):
-    """returns a generator that can iterate over list items that contain 'needle'"""
+def _matcher(needle, regex=False):
+    """returns a function that tests whether a string contains 'needle'
+
+    needle - a string, a compiled regular expression, or a list of them
+    regex - if True, strings are regular expressions rather than plain text """
     if type(needle) is not list:
         needle = [ needle ]
+    patterns = []
+    texts = []
+    for n in needle:
+        if isinstance(n, re.Pattern):
+            patterns.append(n.search)
+        elif regex:
+            patterns.append(re.compile(n).search)
+        else:
+            texts.append(n)
+    if len(texts) > 1 and all(texts):
+        # one pass over each item for all of the needles
+        patterns.append(needle_index(tuple(texts)).contains)
+    elif len(texts) > 1:
+        patterns.append(lambda s: any(n in s for n in texts))
+    elif texts:
+        text = texts[0]
+        patterns.append(lambda s: text in s)
+    if len(patterns) == 1:
+        return patterns[0]
+    return lambda s: any(p(s) for p in patterns)
+
+def _grep(_list, needle, regex=False):
+    """returns a generator that can iterate over list items that contain 'needle'"""
+    match = _matcher(needle, regex)
     for l in _list:
-        for n in needle:
-            if n in str(l):
-                yield l
-                break
+        # each item is converted to a string once, whatever the number of needles
+        if match(l if type(l) is str else str(l)):
+            yield l
 
-def grep(_list, needle):
+def _grep_chunk(chunk, needle, regex):
+    """runs grep over one chunk of a list in a worker process"""
+    return list(_grep(chunk, needle, regex))
+
+def igrep(_list, needle, regex=False):
+    """returns an iterator over the items of _list that contain 'needle', reading _list lazily
+
+    _list - the iterable to search, eg. a generator reading a large file
+    needle - a string, a compiled regular expression, or a list of them
+    regex - if True, string needles are regular expressions """
+    return _grep(_list, needle, regex)
+
+def grep(_list, needle, regex=False, workers=None, chunk_size=100000, executor=None):
     """returns a list of items from _list that contain 'needle'
-    
+
     _list - the iterable to search
-    needle - a string or list of strings to search for """
-    return list(_grep(_list, needle))
+    needle - a string or list of strings to search for, or compiled regular expressions
+    regex - if True, string needles are regular expressions
+    workers - if given, lists with more than chunk_size items are split into chunks of
+              chunk_size items that are searched by this many worker processes.  The items
+              and needles must be picklable.
+    chunk_size - the number of items searched by a worker at a time
+    executor - a concurrent.futures executor owned by the caller that the chunks are searched
+               with instead, so that repeated calls reuse its workers rather than starting
+               a process pool of their own.  It is left running when grep returns. """
+    if (workers or executor is not None) and isinstance(_list, (list, tuple)) and len(_list) > chunk_size:
+        chunks = (_list[i:i+chunk_size] for i in range(0, len(_list), chunk_size))
+        if executor is not None:
+            results = executor.map(_grep_chunk, chunks, itertools.repeat(needle), itertools.repeat(regex))
+            return list(itertools.chain.from_iterable(results))
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(workers) as pool:
+            results = pool.map(_grep_chunk, chunks, itertools.repeat(needle), itertools.repeat(regex))
+            return list(itertools.chain.from_iterable(results))
+    return list(_grep(_list, needle, regex))
@@ -0,0 +1,187 @@
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from .template_instr import is_constant
+
+# Matches the secret references that are substituted after the VM has run (see template_secrets)
+SECRET_REF = re.compile(r"@([a-zA-Z_\.-]+):([a-zA-Z_\.-]+)@")
+INCLUDE_DIRECTIVE = re.compile(r"^#[ ]*include\b")
+
+
+def file_stamp(path : str):
+    """- Returns the (mtime, size) of a file, or None if it no longer exists"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+class RenderedTemplate:
+    """The result of running a template, as stored in the RenderCache.
+
+    The body is kept from before secret substitution, so a body that references secrets
+    never holds secret values; has_secrets tells the caller to substitute them again.
+    """
+    def __init__(self, body : str, outfile : str = None, reports=None, includes=None):
+        self.body = body
+        self.outfile = outfile
+        self.reports = reports or []
+        self.has_secrets = SECRET_REF.search(body) is not None
+        # included files with the stamp they had when the template was run
+        self.includes = includes or []
+
+    @classmethod
+    def from_vm(cls, vm, loader=None):
+        stamp = file_stamp if loader is None else loader.stamp
+        includes = [ [path, stamp(path)] for path in dict.fromkeys(vm.includes) ]
+        return cls("".join(vm.output), vm.outfile, list(vm.reports), includes)
+
+    def is_current(self, loader=None) -> bool:
+        """- Returns False if any included template has changed since the result was rendered,
+        'loader' is the loader the templates were read with (see template_loader)"""
+        stamp = file_stamp if loader is None else loader.stamp
+        return all(stamp(path) == s for path, s in self.includes)
+
+    def to_dict(self) -> dict:
+        return { "body": self.body, "outfile": self.outfile, "reports": self.reports, "includes": self.includes }
+
+    @classmethod
+    def from_dict(cls, d : dict):
+        return cls(d["body"], d["outfile"], d["reports"], d["includes"])
+
+
+class RenderCache:
+    """LRU cache of rendered templates, keyed by the template source, the variables it can
+    reference and its arguments.
+
+    The key is a hash of the template source rather than of its compiled program: the
+    same source always compiles to the same program, and hashing the source lets a hit
+    skip compiling as well as running the VM.  Only variables whose names occur in the
+    template, in its arguments, or in the values of other referenced variables can change
+    the output, so the other variables are left out of the key.  A template that uses
+    #include is keyed on all of its variables, and its cached results are discarded when
+    an included file changes.
+
+    Results are held in memory, and also written to 'directory' as JSON files when one
+    is given so that they survive between processes.
+
+    Example:
+        renders = RenderCache(maxsize=1000, directory=".render-cache")
+        fill_template("foo.py.template", env, render_cache=renders)
+    """
+    def __init__(self, maxsize : int = 256, directory : str = None):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def referenced(lines, env : dict, argv) -> dict:
+        """- Returns the variables of 'env' that can affect the output of the template 'lines'"""
+        if any(INCLUDE_DIRECTIVE.match(line) for line in lines):
+            return env
+        texts = [ "".join(lines) ] + [ repr(x) for x in argv ]
+        refs = { '__FILE__' }           # #outfile paths are relative to __FILE__
+        found = True
+        while found:
+            found = False
+            for name in env:
+                if name not in refs and any(name in text for text in texts):
+                    refs.add(name)
+                    texts.append(repr(env[name]))
+                    found = True
+        return { k: env[k] for k in env if k in refs }
+
+    def key(self, lines, env : dict, argv) -> str:
+        """- Returns the cache key for rendering the template 'lines' with 'env' and 'argv', or
+        None if the render can't be cached because a value is a generator or other object
+        without a stable repr"""
+        refs = self.referenced(lines, env, argv)
+        if not (is_constant(list(argv)) and is_constant(refs)):
+            return None
+        h = hashlib.sha256()
+        for line in lines:
+            h.update(line.encode("utf-8", "surrogatepass"))
+        h.update(b"\0")
+        h.update(repr(sorted(refs.items(), key=lambda kv: kv[0])).encode("utf-8", "surrogatepass"))
+        h.update(b"\0")
+        h.update(repr(list(argv)).encode("utf-8", "surrogatepass"))
+        return h.hexdigest()
+
+    def get(self, key : str, loader=None) -> RenderedTemplate:
+        """- Returns the cached result for 'key', or None.  Results whose #include files have
+        changed in 'loader', or on disk if no loader is given, are discarded"""
+        with self.lock:
+            result = self.entries.get(key)
+            if result is not None:
+                self.entries.move_to_end(key)
+        if result is None and self.directory:
+            result = self._load(key)
+        if result is not None and not result.is_current(loader):
+            self.invalidate(key)
+            result = None
+        with self.lock:
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries[key] = result
+                self._evict()
+        return result
+
+    def put(self, key : str, result : RenderedTemplate) -> RenderedTemplate:
+        """- Stores a result and returns it"""
+        with self.lock:
+            self.entries[key] = result
+            self.entries.move_to_end(key)
+            self._evict()
+        if self.directory:
+            self._save(key, result)
+        return result
+
+    def invalidate(self, key : str = None):
+        """- Drops one result, or all of them if no key is given"""
+        with self.lock:
+            if key is None:
+                keys = list(self.entries)
+                self.entries.clear()
+            else:
+                keys = [ key ]
+                self.entries.pop(key, None)
+        if self.directory:
+            if key is None:
+                keys = [ f[:-5] for f in os.listdir(self.directory) if f.endswith(".json") ]
+            for k in keys:
+                try:
+                    os.unlink(self._path(k))
+                except OSError:
+                    pass
+
+    def _evict(self):
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def _path(self, key : str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _load(self, key : str) -> RenderedTemplate:
+        try:
+            with open(self._path(key), "rt") as f:
+                return RenderedTemplate.from_dict(json.load(f))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _save(self, key : str, result : RenderedTemplate):
+        path = self._path(key)
+        tmppath = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmppath, "wt") as f:
+            json.dump(result.to_dict(), f)
+        os.replace(tmppath, path)
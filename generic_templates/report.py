@@ -1,28 +1,73 @@
+import io
+import tempfile
+
+
+class SpilledAttachment():
+    """An attachment that is kept in a temporary file rather than in memory"""
+    def __init__(self, value):
+        self.text = isinstance(value, str)
+        self.file = tempfile.TemporaryFile("w+b")
+        self.file.write(value.encode("utf-8") if self.text else value)
+
+    def read(self):
+        self.file.seek(0)
+        data = self.file.read()
+        return data.decode("utf-8") if self.text else data
+
+    def close(self):
+        self.file.close()
+
+
 class Report():
-    def __init__(self, textwidth=80):
+    def __init__(self, textwidth=80, spill_size=None):
+        """
+        textwidth - lines longer than this are truncated
+        spill_size - str or bytes attachments longer than this are kept in temporary files
+                     rather than in memory, by default attachments are never spilled
+        """
         self.sections = []
-        self.sections_log = {}
+        self.numbers = {}           # section -> section number
+        self.sections_log = {}      # section -> the lines logged and not yet flushed
         self.attachments = {}
         self.textwidth = textwidth
+        self.spill_size = spill_size
+        self.headed = set()         # sections whose heading flush() has written
+        self.last_flushed = None    # the section flush() last wrote to
         self.section("Overview")
         self.pending_subhead = None
 
     def section(self, section):
         self.current_section = section
-        if section not in self.sections:
+        if section not in self.sections_log:
             self.sections.append(section)
+            self.numbers[section] = len(self.sections)
             self.sections_log[section] = []
 
     def attach(self, name, value):
+        old = self.attachments.get(name)
+        if isinstance(old, SpilledAttachment):
+            old.close()
+        if self.spill_size is not None and isinstance(value, (str, bytes)) and len(value) > self.spill_size:
+            value = SpilledAttachment(value)
         self.attachments[name] = value
         self.print(f"    See attachment: '{name}'")
 
     def attachment(self, name):
-        return self.attachments[name]
+        value = self.attachments[name]
+        if isinstance(value, SpilledAttachment):
+            return value.read()
+        return value
 
     def has_attachment(self, name):
         return name in self.attachments
 
+    def close(self):
+        """removes the temporary files of spilled attachments"""
+        for value in self.attachments.values():
+            if isinstance(value, SpilledAttachment):
+                value.close()
+        self.attachments.clear()
+
     def log_text(self, txt):
         #if txt == "" and len(self.sections_log[self.current_section])==0: return
         if len(txt)>self.textwidth: txt=txt[:self.textwidth-3]+"..."
@@ -30,7 +75,7 @@ class Report():
 
     def sub_heading(self, header):
         self.pending_subhead = header
-        
+
     def sub_section(self, header):
         self.pending_subhead = header
 
@@ -42,15 +87,42 @@ class Report():
         #print("data=",data)
         self.log_text("    "+(" ".join([str(x) for x in data])))
 
+    def write(self, f):
+        """writes the report to the file object 'f'"""
+        for i, section in enumerate(self.sections):
+            if i>0: f.write("\n")
+            f.write(f"{i+1}. {section}\n")
+            self.write_lines(f, self.sections_log[section])
+
+    @staticmethod
+    def write_lines(f, lines):
+        if lines:
+            f.write("\n".join(lines))
+            f.write("\n")
+
+    def flush(self, f):
+        """writes the lines logged since the last flush to the file object 'f' and releases them,
+        so a long run can stream its report as it goes.  A section that is continued after
+        another section has been written gets its heading again, marked '(continued)'."""
+        for section in self.sections:
+            log = self.sections_log[section]
+            if not log and section in self.headed:
+                continue
+            if section != self.last_flushed:
+                if self.last_flushed is not None: f.write("\n")
+                continued = " (continued)" if section in self.headed else ""
+                f.write(f"{self.numbers[section]}. {section}{continued}\n")
+                self.headed.add(section)
+                self.last_flushed = section
+            self.write_lines(f, log)
+            log.clear()
+        if hasattr(f, "flush"):
+            f.flush()
+
     def __str__(self):
-        result = ""
-        for i in range(len(self.sections)):
-            if i>0: result += "\n"
-            section = self.sections[i]
-            result += f"{i+1}. {section}\n"
-            for j in range(len(self.sections_log[section])):
-                result += f"{self.sections_log[section][j]}\n"
-        return result
+        result = io.StringIO()
+        self.write(result)
+        return result.getvalue()
 
     def show(self):
         print(str(self))
@@ -1,18 +1,45 @@
+import re
+from functools import lru_cache
+
+# $NAME or ${NAME}
+VARIABLE = re.compile(r"\$(?:([A-Za-z_]+)|\{([A-Za-z_]+)\})")
+
+
+@lru_cache(maxsize=256)
+def compile_template(template):
+    """ Returns (format, names) for a template, where 'format' is the template as a str.format()
+    string with a {} for each variable reference, and 'names' the kvlist key of each reference
+    """
+    parts = []
+    names = []
+    pos = 0
+    for m in VARIABLE.finditer(template):
+        parts.append(template[pos:m.start()].replace("{", "{{").replace("}", "}}"))
+        names.append("$" + (m.group(1) or m.group(2)))
+        pos = m.end()
+    parts.append(template[pos:].replace("{", "{{").replace("}", "}}"))
+    return "{}".join(parts), tuple(names)
+
+
+def _render(compiled, kvlist):
+    fmt, names = compiled
+    try:
+        return fmt.format(*[ kvlist[name] for name in names ])
+    except KeyError as e:
+        raise ValueError(f"Unknown template variable {e.args[0]}") from None
+
+
 def str_interpolate(template, kvlist={}):
     """ Replaces string contents with values from the kvlist
+
+    Both $NAME and ${NAME} are replaced with kvlist["$NAME"].  The template is scanned once,
+    so values that contain '$' are inserted as they are.
+    """
+    return _render(compile_template(template), kvlist)
+
+
+def str_interpolate_many(template, kvlists):
+    """ Returns a list with the template interpolated with each kvlist of 'kvlists'
     """
-    import re
-    while True:
-        m = re.search(r"\$([A-Za-z_]+)", template)
-        if not m:
-            m = re.search(r"\$({[A-Za-z_]+})", template)
-        if not m:
-            break
-        var = "$"+m.group(1)
-        #print(f"var={var}")
-        if var in kvlist:
-            #print(f"kvlist[var]={kvlist[var]}")
-            template = template.replace(var, kvlist[var])
-        else:
-            raise ValueError(f"Unknown template variable {var}")
-    return template
\ No newline at end of file
+    compiled = compile_template(template)
+    return [ _render(compiled, kvlist) for kvlist in kvlists ]
@@ -0,0 +1,100 @@
+import csv
+import json
+import os
+
+
+class TableColumn:
+    """One column of a TableSource.
+
+    Iterating over a column reads the table from the start, one row at a time, so a
+    column can drive any number of #for loops without the table ever being held in
+    memory.  Columns of the same table used in one loop are read side by side.
+    """
+    def __init__(self, source, column : str):
+        self.source = source
+        self.column = column
+
+    def __iter__(self):
+        return self.source.iter_column(self.column)
+
+    def __repr__(self):
+        return f"<TableColumn {self.source.path}:{self.column}>"
+
+
+class TableSource:
+    """Streams rows from a CSV, TSV or JSON lines file for use as #for loop lists.
+
+    The column names are taken from the CSV header row, or from the keys of the first
+    JSON object.  Each column is bound to a preprocessor symbol by bind(), optionally
+    with a prefix:
+
+        env.update(TableSource("datasets.csv").bind("@"))
+        fill_template("transforms.py.template", env)
+
+    with a template such as:
+
+        #for @NAME, @PATH in @name, @path
+        @NAME = Input("@PATH")
+        #endfor
+    """
+    FORMATS = {
+        ".csv": "csv",
+        ".tsv": "tsv",
+        ".jsonl": "jsonl",
+        ".ndjson": "jsonl"
+    }
+
+    def __init__(self, path : str, format : str = None):
+        """
+        path :str: The file to read
+        format :str: One of 'csv', 'tsv' or 'jsonl', detected from the file extension if not given
+        """
+        if format is None:
+            format = self.FORMATS.get(os.path.splitext(path)[1].lower())
+            if format is None:
+                raise ValueError(f"Unknown table format for {path}, expected one of {', '.join(self.FORMATS)}")
+        if format not in ("csv", "tsv", "jsonl"):
+            raise ValueError(f"Unknown table format {format}")
+        self.path = path
+        self.format = format
+        self.columns = self.read_columns()
+
+    def open(self):
+        return open(self.path, "rt", newline="" if self.format != "jsonl" else None, encoding="utf-8")
+
+    def reader(self, f):
+        """- Returns an iterator of rows; lists for CSV and TSV files, dicts for JSON lines"""
+        if self.format == "jsonl":
+            return (json.loads(line) for line in f if line.strip())
+        return csv.reader(f, delimiter="\t" if self.format == "tsv" else ",")
+
+    def read_columns(self):
+        with self.open() as f:
+            first = next(self.reader(f), None)
+        if first is None:
+            return []
+        if self.format == "jsonl":
+            return list(first)
+        return first
+
+    def iter_column(self, column : str):
+        """- Generates the values of one column, reading the file incrementally"""
+        with self.open() as f:
+            rows = self.reader(f)
+            if self.format == "jsonl":
+                for row in rows:
+                    yield row.get(column, "")
+            else:
+                index = self.columns.index(column)
+                next(rows, None)    # header
+                for row in rows:
+                    yield row[index] if index < len(row) else ""
+
+    def column(self, column : str) -> TableColumn:
+        if column not in self.columns:
+            raise KeyError(f"{self.path} has no column '{column}'")
+        return TableColumn(self, column)
+
+    def bind(self, prefix : str = "") -> dict:
+        """- Returns a { symbol: column } mapping with a symbol for each column"""
+        return { f"{prefix}{column}": TableColumn(self, column) for column in self.columns }
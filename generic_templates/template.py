@@ -1,27 +1,83 @@
 from typing import Optional, Dict, List
 import os
+import sys
 
 from .fpos import Fpos
-from .template_instr import print_program
 from .template_vm import PreprocessorVM
 from .template_parser import compile
 from .template_secrets import find_replace_variables
 from .error_report import ErrorReport
+from .render_cache import RenderedTemplate
 
 
-def preprocess(fp : Fpos, environ : dict={}, args : List[str]=[]) -> PreprocessorVM:
-    """- Runs the preprocessor on the input file 'fp' and returns the result as a string
+def read_template(template_path : str, metrics=None, loader=None, encoding=None) -> Fpos:
+    """- Reads a template file, recording the 'read' stage if metrics are being collected
     Args:
-        fp :Fpos: The file to be read from
+        template_path :str: Path of the template
+        metrics :TemplateMetrics: Optional collector for per-stage metrics
+        loader :FileLoader: Optional loader to read the template with (see template_loader)
+        encoding :str: Read the template in bytes mode, with directives decoded with 'encoding' (see Fpos)
+    """
+    source = template_path if loader is None else loader.lines(template_path, encoding)
+    if metrics is None:
+        return Fpos(source, encoding)
+    with metrics.stage("read") as stage:
+        fp = Fpos(source, encoding)
+        stage.bytes_out += sum(len(x) for x in fp.lines)
+    return fp
+
+def run_program(prog, environ : dict={}, args : List[str]=[], trace=None, metrics=None, cache=None, parallel=None, linked=False, loader=None,
+                limits=None, encoding=None, errors=None) -> PreprocessorVM:
+    """- Executes a compiled template program in a new VM and returns the VM
+    Args:
+        prog :List[Instruction]: The program returned by compile()
         environ :Dict[str, str]: The initial environment defines
+        trace :TraceHook: Optional hook that receives execution events
+        metrics :TemplateMetrics: Optional collector for per-stage metrics
+        cache :TemplateCache: Optional cache of compiled templates used by #include
+        parallel :ParallelLoops: Optional process pool for rendering large independent #for loops
+        linked :bool: Run in a linked VM, with variables in slots rather than 'environ' (see template_link)
+        loader :FileLoader: Optional loader that #include files are read with (see template_loader)
+        limits :TemplateLimits: Optional execution budget for the run (see template_limits)
+        encoding :str: Run a bytes mode program, compiled from a template read with this encoding (see Fpos)
+        errors :ErrorReport: Optional report that errors are recorded in, with their template line (see error_report)
     """
-    # Generate preprocessor script from input and execute the script in a VM
-    vm = PreprocessorVM(environ, args)
-    prog = compile(fp)
+    vm = PreprocessorVM(environ, args, trace=trace, metrics=metrics, cache=cache, parallel=parallel, linked=linked,
+                        loader=loader, limits=limits, encoding=encoding, errors=errors)
     vm.prog(prog)
-    vm.execute()
+    if metrics is None:
+        vm.execute()
+    else:
+        with metrics.stage("execute") as stage:
+            vm.execute()
+            stage.items += vm.icount
+            stage.bytes_out += sum(len(x) for x in vm.output)
     return vm
 
+def preprocess(fp : Fpos, environ : dict={}, args : List[str]=[], trace=None, metrics=None, cache=None, parallel=None, linked=False, loader=None,
+                limits=None, encoding=None, errors=None) -> PreprocessorVM:
+    """- Runs the preprocessor on the input file 'fp' and returns the result as a string
+    Args:
+        fp :Fpos: The file to be read from
+        environ :Dict[str, str]: The initial environment defines
+        trace :TraceHook: Optional hook that receives compile and execution events
+        metrics :TemplateMetrics: Optional collector for per-stage metrics
+        cache :TemplateCache: Optional cache of compiled templates used by #include
+        parallel :ParallelLoops: Optional process pool for rendering large independent #for loops
+        linked :bool: Run in a linked VM (see template_link)
+        loader :FileLoader: Optional loader that #include files are read with (see template_loader)
+        limits :TemplateLimits: Optional execution budget for the run (see template_limits)
+        encoding :str: Encoding of a bytes mode template, defaults to that of 'fp' (see Fpos)
+        errors :ErrorReport: Optional report that syntax and runtime errors are recorded in, with their template position
+    """
+    # Generate preprocessor script from input and execute the script in a VM.  The program is
+    # only run with 'environ', so #ifdef blocks that it decides are resolved while lexing.
+    prog = compile(fp, trace=trace, metrics=metrics, defines=environ, errors=errors)
+    if encoding is None:
+        encoding = fp.encoding
+    return run_program(prog, environ, args, trace=trace, metrics=metrics, cache=cache, parallel=parallel, linked=linked,
+                       loader=loader, limits=limits, encoding=encoding, errors=errors)
+
 def fix_module_names(fpath):
     from os.path import dirname, basename
     mydir = str(dirname(fpath))
@@ -63,14 +119,53 @@ def fill_template(
         errors = None,
         fp :Optional[Fpos] = None,
         output_dir :str = None,
-        input_dir :str = None
+        input_dir :str = None,
+        trace = None,
+        metrics = None,
+        cache = None,
+        render_cache = None,
+        tables = None,
+        table_prefix = "",
+        parallel = None,
+        linked = False,
+        loader = None,
+        writer = None,
+        limits = None,
+        encoding = None,
+        cwd = None,
+        environ = None
 ):
     """
     template_file :str: Path to the template file
     env :Dict[str,str]: Environment variables can be used in place of #define statements
     *argv :List[str]: Argument list
-    errors :ErrorReport:
+    errors :ErrorReport: Optional report that errors are recorded in, with the template line they occurred on.  Once the
+        template has been rendered, the program exits if an error was recorded (see error_report)
     fp :Fpos: Optional open rewindable file input buffer with row and column position tracking
+    trace :TraceHook: Optional hook that receives structured trace events (see template_trace)
+    metrics :TemplateMetrics: Optional collector for per-stage timing and memory (see template_metrics)
+    cache :TemplateCache: Optional cache of compiled templates, reused across calls (see template_cache)
+    render_cache :RenderCache: Optional cache of rendered results; on a hit the template is not run
+        and only secret substitution is repeated (see render_cache)
+    tables :List[Union[str, TableSource, Tuple[str, Union[str, TableSource]]]]: Optional CSV or JSON lines files
+        whose columns are bound to the symbols '<prefix><column>', for use as #for lists.  A (prefix, table) pair
+        gives the prefix of one table, like '-T prefix=table'.  Rows are read as the loops advance (see table_source)
+    table_prefix :str: The prefix of the tables that aren't given as (prefix, table) pairs
+    parallel :ParallelLoops: Optional process pool for rendering large independent #for loops (see template_parallel)
+    linked :bool: Run the template in a linked VM, which resolves variables to slots when the program is
+        loaded; 'env' is then copied rather than updated by the template (see template_link)
+    loader :FileLoader: Optional loader that the template and its #include files are read with, eg. a
+        MemoryLoader holding preloaded templates.  Templates are looked up in its search path (see template_loader)
+    writer :FileWriter: Optional writer for the rendered file, eg. an OutputCollector that keeps it in memory
+    limits :TemplateLimits: Optional limits on the instructions, time, output, #include depth and stack depth
+        of the render; exceeding one raises LimitExceeded (see template_limits)
+    encoding :str: Render the template in bytes mode: directives are read from the lines that start with an
+        ASCII '#', decoded with 'encoding', and the other lines are copied to the output as bytes without being
+        decoded, with variables encoded with 'encoding' (see Fpos).  The result is bytes, and 'render_cache'
+        is not used
+    cwd :str: Directory that relative paths (the template, its #include files, tables, output files and
+        'setting.sh') are resolved from, instead of the working directory of the process
+    environ :Dict[str, str]: Environment variables used for '@env:' substitutions, instead of os.environ
     Returns :str: The result of processing the template on success.  Throws an exception on error.
     """
     # read template
@@ -78,44 +173,109 @@ def fill_template(
 
     if input_dir:
         template_file = os.path.join(input_dir, template_file)
+    if cwd is not None and loader is None:
+        from .template_loader import FileLoader
+        loader = FileLoader(root=cwd)
+    if loader is not None:
+        template_file = loader.find(template_file) or template_file
     if '__FILE__' not in env:
         env['__FILE__'] = template_file
-
-    if not fp:
-        fp = Fpos(template_file)
+    if tables:
+        from .table_source import TableSource
+        for table in tables:
+            prefix = table_prefix
+            if isinstance(table, tuple):
+                prefix, table = table
+            if not isinstance(table, TableSource):
+                table = TableSource(table if cwd is None else os.path.join(cwd, table))
+            env.update(table.bind(prefix))
 
     if errors is None:
         errors = ErrorReport()
 
     # process template
-    vm = preprocess(fp, env, argv)
-    body = find_replace_variables("".join(vm.output))
+    if encoding is None and fp is not None:
+        encoding = fp.encoding
+    if render_cache is not None and encoding is None:
+        # on a miss a template read from its file is run from the compiled template cache
+        compiled = cache is not None and not fp
+        if not fp:
+            fp = read_template(template_file, metrics, loader)
+        key = render_cache.key(fp.lines, env, argv)
+        result = render_cache.get(key, loader) if key else None
+        if result is None:
+            if compiled:
+                prog = cache.get(template_file, trace=trace, metrics=metrics, loader=loader, errors=errors)
+                vm = run_program(prog, env, argv, trace=trace, metrics=metrics, cache=cache, parallel=parallel, linked=linked, loader=loader, limits=limits, errors=errors)
+            else:
+                vm = preprocess(fp, env, argv, trace=trace, metrics=metrics, cache=cache, parallel=parallel, linked=linked, loader=loader, limits=limits, errors=errors)
+            result = RenderedTemplate.from_vm(vm, loader)
+            if key is not None:
+                result = render_cache.put(key, result)
+        else:
+            for report in result.reports:
+                print(report)
+        outfile = result.outfile
+        body = result.body
+        has_secrets = result.has_secrets
+    else:
+        if fp:
+            vm = preprocess(fp, env, argv, trace=trace, metrics=metrics, cache=cache, parallel=parallel, linked=linked, loader=loader, limits=limits, errors=errors,
+                            encoding=encoding)
+        elif cache is not None:
+            prog = cache.get(template_file, trace=trace, metrics=metrics, loader=loader, encoding=encoding, errors=errors)
+            vm = run_program(prog, env, argv, trace=trace, metrics=metrics, cache=cache, parallel=parallel, linked=linked, loader=loader, limits=limits, errors=errors,
+                             encoding=encoding)
+        else:
+            fp = read_template(template_file, metrics, loader, encoding)
+            vm = preprocess(fp, env, argv, trace=trace, metrics=metrics, parallel=parallel, linked=linked, loader=loader, limits=limits, errors=errors)
+        outfile = vm.outfile
+        body = "".join(vm.output) if encoding is None else b"".join(vm.output)
+        has_secrets = True
+    if has_secrets:
+        if metrics is None:
+            body = find_replace_variables(body, encoding, environ, cwd, errors)
+        else:
+            with metrics.stage("secrets", len(body)) as stage:
+                body = find_replace_variables(body, encoding, environ, cwd, errors)
+                stage.bytes_out += len(body)
     errors.exit_on_error()
 
     # write output
     savepath = None
-    if vm.outfile:
-        savepath = vm.outfile
+    if outfile:
+        savepath = outfile
     elif template_file.endswith(".template"):
         savepath = template_file[:-9]
 
     if savepath:
+        if cwd is not None:
+            # the output paths are worked out as they would be when running in 'cwd'
+            savepath = os.path.relpath(savepath, cwd)
         if output_dir:
             if input_dir:
                 savepath = savepath.replace(input_dir, output_dir)
             else:
                 savepath = os.path.join(output_dir, savepath)
         savepath = fix_module_names(savepath) # removes illegal characters for python modules 
-        odir = os.path.dirname(savepath)
-        if odir and not os.path.isdir(odir):
-            print(f"creating directory {odir}")
-            os.makedirs(odir)
-        
+        if writer is None:
+            from .template_loader import FileWriter
+            writer = FileWriter()
 
         print(f"writing {savepath}")
+        if cwd is not None:
+            savepath = os.path.join(cwd, savepath)
 
-        with open(savepath, "wt") as f:
-            f.write(warning(template_file, savepath))
-            f.write(body)
+        header = warning(template_file, savepath)
+        if encoding is not None:
+            header = header.encode(encoding)
+        if metrics is None:
+            writer.write(savepath, header, body)
+        else:
+            with metrics.stage("write", len(body)) as stage:
+                stage.bytes_out += writer.write(savepath, header, body)
+    elif encoding is not None:
+        sys.stdout.flush()
+        sys.stdout.buffer.write(body)
     else:
         print(body)
\ No newline at end of file
@@ -0,0 +1,57 @@
+import os
+import threading
+
+from .template_parser import compile
+
+
+class TemplateCache:
+    """Cache of compiled template programs keyed by absolute path, or by loader and path for
+    templates read through a loader (see template_loader).
+
+    Every lookup stats the file and recompiles it if its modification time or size
+    has changed, so a long lived process (see template_daemon) always renders the
+    current version of a template.  Lookups are safe to make from multiple threads.
+
+    Example:
+        cache = TemplateCache()
+        fill_template("foo.py.template", env, cache=cache)
+    """
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, template_path : str, trace=None, metrics=None, loader=None, encoding=None, errors=None):
+        """- Returns the compiled program for a template file, compiling it if needed.  'encoding'
+        compiles it in bytes mode (see Fpos), syntax errors are recorded in 'errors' (see error_report)"""
+        from .template import read_template
+        if loader is None:
+            key = os.path.abspath(template_path)
+            st = os.stat(key)
+            stamp = (st.st_mtime_ns, st.st_size)
+        else:
+            key = (loader, template_path)
+            stamp = loader.stamp(template_path)
+        stamp = (stamp, encoding)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == stamp:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        prog = compile(read_template(template_path if loader else key, metrics, loader, encoding), trace=trace, metrics=metrics,
+                       errors=errors)
+        with self.lock:
+            self.entries[key] = (stamp, prog)
+        return prog
+
+    def invalidate(self, template_path : str = None):
+        """- Drops one template from the cache, or every template if no path is given"""
+        with self.lock:
+            if template_path is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(os.path.abspath(template_path), None)
+                for key in [ k for k in self.entries if type(k) is tuple and k[1] == template_path ]:
+                    del self.entries[key]
@@ -0,0 +1,211 @@
+"""Long lived render daemon for fill-template.
+
+Build systems that run fill-template once per file spend most of their time starting
+Python and compiling templates.  The daemon keeps the parser, compiled templates (for
+both the main template and its #include files), rendered results, the settings.sh cache
+and the secret cache warm, and serves render requests over a Unix domain socket.  The client,
+'fill-template-client', takes exactly the same arguments as 'fill-template' and falls
+back to rendering in-process when no daemon is listening.
+
+Protocol: the client sends one JSON object terminated by a newline:
+    {"op": "render", "argv": [...], "cwd": "...", "environ": {...}}
+and the daemon answers with one JSON line:
+    {"status": <exit code>, "stdout": "...", "stderr": "..."}
+The ops "ping" and "invalidate" answer with a status of 0.
+
+Connections are served on separate threads and render concurrently.  The working directory
+and environment of a request are passed to fill-template rather than set on the daemon, and
+standard output and error are captured per thread (see ThreadStream), so renders don't
+share any process state.
+"""
+import io
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+
+
+def default_socket_path() -> str:
+    """- Returns $FILL_TEMPLATE_SOCKET, or a per-user socket in the temp directory"""
+    path = os.environ.get("FILL_TEMPLATE_SOCKET")
+    if not path:
+        tmpdir = os.environ.get("TMPDIR", "/tmp")
+        path = os.path.join(tmpdir, f"fill-template-{os.getuid()}.sock")
+    return path
+
+
+class ThreadStream(io.TextIOBase):
+    """Replacement for sys.stdout or sys.stderr that writes to the stream captured by the
+    current thread, or to the original stream for threads that haven't captured one"""
+    def __init__(self, default):
+        self.default = default
+        self.local = threading.local()
+
+    def stream(self):
+        return getattr(self.local, "stream", None) or self.default
+
+    def write(self, s):
+        return self.stream().write(s)
+
+    def flush(self):
+        self.stream().flush()
+
+    def capture(self, stream):
+        """- Sends the output of the current thread to 'stream' until release() is called"""
+        self.local.stream = stream
+
+    def release(self):
+        self.local.stream = None
+
+
+class RenderHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads(line)
+            reply = self.server.dispatch(request)
+        except Exception as e:
+            reply = { "status": 1, "stdout": "", "stderr": f"fill-template daemon: {e}\n" }
+        self.wfile.write(json.dumps(reply).encode("utf-8") + b"\n")
+
+
+class RenderServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path : str, cache=None, render_cache=None):
+        """
+        path :str: Filesystem path of the Unix domain socket to listen on
+        cache :TemplateCache: Cache of compiled templates, a new one is created if not given
+        render_cache :RenderCache: Cache of rendered results, a new one is created if not given
+        """
+        from .template_cache import TemplateCache
+        from .render_cache import RenderCache
+        from . import template_parser
+        template_parser.release_parser(template_parser.get_parser())    # build a parser before the first request
+        self.cache = cache or TemplateCache()
+        self.render_cache = render_cache or RenderCache()
+        self.path = path
+        if os.path.exists(path):
+            os.unlink(path)
+        # the socket is created by bind(), so it is private to the user from the start
+        umask = os.umask(0o177)
+        try:
+            super().__init__(path, RenderHandler)
+        finally:
+            os.umask(umask)
+        self.stdout = sys.stdout = ThreadStream(sys.stdout)
+        self.stderr = sys.stderr = ThreadStream(sys.stderr)
+
+    def dispatch(self, request : dict) -> dict:
+        op = request.get("op", "render")
+        if op == "ping":
+            return { "status": 0, "stdout": "", "stderr": "" }
+        if op == "invalidate":
+            self.cache.invalidate(request.get("path"))
+            self.render_cache.invalidate()
+            return { "status": 0, "stdout": "", "stderr": "" }
+        if op == "render":
+            return self.render(request)
+        raise ValueError(f"unknown op '{op}'")
+
+    def render(self, request : dict) -> dict:
+        """- Runs fill-template for one request and captures its exit status and output"""
+        import traceback
+        from .arglist import Arglist
+        from .cli import main
+
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+        status = 0
+        self.stdout.capture(stdout)
+        self.stderr.capture(stderr)
+        try:
+            args = Arglist(list(request.get("argv", [])))
+            args.program = request.get("program", "fill-template")
+            main(args, cache=self.cache, render_cache=self.render_cache, cwd=request.get("cwd", os.getcwd()),
+                 environ=request.get("environ"))
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                status = e.code or 0
+            else:
+                print(e.code, file=sys.stderr)
+                status = 1
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            self.stdout.release()
+            self.stderr.release()
+        return { "status": status, "stdout": stdout.getvalue(), "stderr": stderr.getvalue() }
+
+    def server_close(self):
+        super().server_close()
+        if sys.stdout is self.stdout:
+            sys.stdout = self.stdout.default
+        if sys.stderr is self.stderr:
+            sys.stderr = self.stderr.default
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def serve(path : str = None):
+    """- Runs the render daemon until it is interrupted"""
+    import signal
+    path = path or default_socket_path()
+    server = RenderServer(path)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f"fill-template daemon listening on {path}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def request(message : dict, path : str = None) -> dict:
+    """- Sends one request to the daemon and returns its reply.
+
+    Raises OSError if no daemon is listening on the socket.
+    """
+    path = path or default_socket_path()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall(json.dumps(message).encode("utf-8") + b"\n")
+        data = b""
+        while not data.endswith(b"\n"):
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    return json.loads(data)
+
+
+def client_main(argv=None, path : str = None):
+    """- Drop-in replacement for the fill-template command that renders through the daemon"""
+    if argv is None:
+        argv = sys.argv[1:]
+    message = {
+        "op": "render",
+        "argv": list(argv),
+        "cwd": os.getcwd(),
+        "environ": dict(os.environ),
+        "program": os.path.basename(sys.argv[0])
+    }
+    try:
+        reply = request(message, path)
+    except OSError:
+        # no daemon, render in this process instead
+        from .arglist import Arglist
+        from .cli import main
+        args = Arglist(list(argv))
+        args.program = sys.argv[0]
+        main(args)
+        return
+    sys.stdout.write(reply["stdout"])
+    sys.stderr.write(reply["stderr"])
+    sys.exit(reply["status"])
@@ -6,7 +6,32 @@ def gensym(prefix="sym"):
     g_symbolcount += 1
     return f"{prefix}{g_symbolcount}"
 
+def is_constant(value) -> bool:
+    """Returns True for values that can be copied into a program or a cache key, ie. values
+    that are not consumed by iterating over them (such as generators) and that have a stable repr"""
+    if value is None or type(value) in (str, bytes, int, float, bool, range):
+        return True
+    if type(value) in (list, tuple):
+        return all(is_constant(x) for x in value)
+    if type(value) is dict:
+        return all(is_constant(k) and is_constant(v) for k, v in value.items())
+    return False
+
+# Instructions that neither change variables (other than the loop variables set by NEXT),
+# nor the output file, nor have effects outside the VM.  A #for body built only from these
+# renders each iteration independently of the others (see template_parallel).
+PURE_OPCODES = frozenset([
+    'LABEL', 'JMP', 'JMPIF', 'JMPIFNOT', 'EMIT', 'WRITE', 'CONST', 'GET', 'DUP', 'EXISTS',
+    'EVAL1', 'EVAL2', 'XCALL', 'FOREACH', 'NEXT'
+])
+
+def is_pure(prog) -> bool:
+    """Returns True if every instruction in 'prog' is free of side effects"""
+    return all(instr.opcode in PURE_OPCODES for instr in prog)
+
 class Instruction:
+    line = None         # the template line the instruction was compiled from, set by the compiler
+
     def __init__(self, opcode, arg1=None, arg2=None):
         self.op = [opcode, arg1, arg2]
 
@@ -29,8 +54,14 @@ class Instruction:
     def JMPIF(cls, label): # NOSONAR
         return Instruction('JMPIF', label)
     @classmethod
-    def EMIT(cls, text): # NOSONAR
-        return Instruction('EMIT', text)
+    def JMPIFNOT(cls, label): # NOSONAR
+        return Instruction('JMPIFNOT', label)
+    @classmethod
+    def EMIT(cls, text, skip=None): # NOSONAR
+        return Instruction('EMIT', text, skip)
+    @classmethod
+    def WRITE(cls, text): # NOSONAR
+        return Instruction('WRITE', text)
     @classmethod
     def ARG(cls, argn, symbol): # NOSONAR
         return Instruction('ARG', argn, symbol)
@@ -68,6 +99,15 @@ class Instruction:
     def EVAL1(cls, op): # NOSONAR
         return Instruction('EVAL1', op)
     @classmethod
+    def FOREACH(cls, argc, independent=False): # NOSONAR
+        return Instruction('FOREACH', argc, True if independent else None)
+    @classmethod
+    def NEXT(cls, label, symbols): # NOSONAR
+        return Instruction('NEXT', label, symbols)
+    @classmethod
+    def CACHED(cls, reg, label): # NOSONAR
+        return Instruction('CACHED', reg, label)
+    @classmethod
     def PRINT(cls): # NOSONAR
         return Instruction('PRINT')
 
@@ -103,7 +143,7 @@ class Instruction:
             label = self.arg1+':'
             arg1 = None
             result = f"{label:7s} "
-        elif self.opcode == 'CONST' or self.opcode == 'EMIT':
+        elif self.opcode == 'CONST' or self.opcode == 'EMIT' or self.opcode == 'WRITE':
             if type(arg1) is str:
                 arg1 = '"'+arg1.replace("\n",r"\n")+'"'
 
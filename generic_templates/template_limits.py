@@ -0,0 +1,123 @@
+"""Execution budgets for the preprocessor VM.
+
+A render service that runs templates it doesn't control can bound the work of each render:
+
+    limits = TemplateLimits(instructions=10_000_000, seconds=5, output_bytes=50_000_000,
+                            include_depth=16, stack_depth=1000)
+    fill_template("untrusted.py.template", env, limits=limits)
+
+The budget is shared by a template and everything it #includes.  The VM checks it every
+'check_every' instructions rather than on every instruction, so the counts can overshoot a
+limit by up to that many instructions, and a VM without limits runs exactly as before.
+Parallel loops (see template_parallel) are run in the VM when limits are given, so that
+every instruction is counted against the budget.
+Exceeding a limit raises LimitExceeded, which carries the template and line that was running.
+"""
+import time
+
+
+class LimitExceeded(RuntimeError):
+    def __init__(self, limit : str, value, maximum, template : str = None, line : int = None, pc : int = None,
+                 instruction=None):
+        """ Raised by the VM when a render exceeds one of its TemplateLimits
+
+        limit :str: The name of the limit, one of the TemplateLimits arguments
+        value :Union[int, float]: The amount used when the limit was detected
+        maximum :Union[int, float]: The limit
+        template :str: The template that was running (its __FILE__)
+        line :int: The template line of the instruction that was running, when known
+        pc :int: The program counter of the instruction that was running
+        instruction :Instruction: The instruction that was running
+        """
+        self.limit = limit
+        self.value = value
+        self.maximum = maximum
+        self.template = template
+        self.line = line
+        self.pc = pc
+        self.instruction = instruction
+        where = f"{template or '<template>'}:{line}" if line is not None else (template or "<template>")
+        super().__init__(f"{where}: {limit} limit of {maximum} exceeded ({value}) at pc {pc}: {instruction}")
+
+    def to_dict(self) -> dict:
+        return {
+            "limit": self.limit,
+            "value": self.value,
+            "maximum": self.maximum,
+            "template": self.template,
+            "line": self.line,
+            "pc": self.pc,
+            "instruction": repr(self.instruction)
+        }
+
+
+class TemplateLimits:
+    def __init__(self, instructions : int = None, seconds : float = None, output_bytes : int = None,
+                 include_depth : int = None, stack_depth : int = None, check_every : int = 1024):
+        """ Limits on a single render, None for no limit.
+
+        instructions :int: Instructions executed
+        seconds :float: Wall clock time
+        output_bytes :int: Characters of output
+        include_depth :int: Nesting of #include
+        stack_depth :int: Entries on the VM data stack
+        check_every :int: Number of instructions run between checks of the budget
+        """
+        self.instructions = instructions
+        self.seconds = seconds
+        self.output_bytes = output_bytes
+        self.include_depth = include_depth
+        self.stack_depth = stack_depth
+        self.check_every = max(check_every, 1)
+
+    def budget(self):
+        """- Returns a new Budget that counts one render against these limits"""
+        return Budget(self)
+
+
+class Budget:
+    """The resources used so far by one render, shared by the VMs of its #include files"""
+    def __init__(self, limits : TemplateLimits):
+        self.limits = limits
+        self.deadline = None if limits.seconds is None else time.monotonic() + limits.seconds
+        self.instructions = 0
+        self.output_bytes = 0
+        self.depth = 0
+
+    def budget(self):
+        """- Returns this budget, so that the VMs of #include files count against it"""
+        return self
+
+    def fail(self, vm, limit, value, maximum, pc):
+        """- Raises LimitExceeded for the instruction at 'pc' of 'vm'"""
+        progmem = vm.progmem
+        instr = progmem[pc] if 0 <= pc < len(progmem) else None
+        raise LimitExceeded(limit, value, maximum, vm.vars.get('__FILE__'), vm.source_line(pc), pc, instr)
+
+    def check(self, vm, pc):
+        """- Raises LimitExceeded if the render has used more than its limits, charging it to the
+        instruction at 'pc', the last one that 'vm' executed"""
+        limits = self.limits
+        if limits.instructions is not None and self.instructions > limits.instructions:
+            self.fail(vm, "instructions", self.instructions, limits.instructions, pc)
+        if limits.output_bytes is not None and self.output_bytes > limits.output_bytes:
+            self.fail(vm, "output_bytes", self.output_bytes, limits.output_bytes, pc)
+        if limits.stack_depth is not None and len(vm.stack) > limits.stack_depth:
+            self.fail(vm, "stack_depth", len(vm.stack), limits.stack_depth, pc)
+        if self.deadline is not None:
+            now = time.monotonic()
+            if now > self.deadline:
+                self.fail(vm, "seconds", round(now - self.deadline + limits.seconds, 3), limits.seconds, pc)
+
+    def enter(self, vm):
+        """- Counts an #include, raising LimitExceeded if it is nested too deeply.  Called by the
+        INCLUDE instruction, after the VM has moved its pc past it"""
+        self.depth += 1
+        maximum = self.limits.include_depth
+        if maximum is not None and self.depth > maximum:
+            depth = self.depth
+            self.depth -= 1
+            self.fail(vm, "include_depth", depth, maximum, vm.pc - 1)
+
+    def exit(self):
+        self.depth -= 1
@@ -0,0 +1,158 @@
+"""Linking of compiled templates to VM slots.
+
+A linked VM (PreprocessorVM(linked=True)) keeps its variables in a list of slots instead
+of a dict.  As a program is loaded, link() rewrites the instructions that name a
+variable to use its slot number:
+
+    GET  @N        ->  GETS  3
+    SET  @N        ->  SETS  3
+    ARG  0, @N     ->  ARGS  0, 3
+    NEXT brk, (@N, @V)  ->  NEXTS brk, (3, 4)
+
+Register operands ('R0'..'R63') are resolved to register numbers in every VM.
+
+The variables are still available as a mapping through vm.vars (a SlotVars), so
+#include, the trace hooks and callers that read the variables after a run work
+unchanged.  Variables that the program never names are kept in an ordinary dict.
+"""
+from collections.abc import MutableMapping
+from .template_instr import Instruction
+
+# the value of a slot whose variable is not defined
+UNDEFINED = type("Undefined", (), { "__repr__": lambda self: "UNDEFINED" })()
+
+# opcodes whose symbol operand is replaced by a slot, and the linked opcode
+LINKED = {
+    'GET': 'GETS',
+    'SET': 'SETS',
+    'ARG': 'ARGS',
+    'NEXT': 'NEXTS'
+}
+
+# opcodes whose first operand is a register
+REGISTER_OPS = frozenset([ 'PUSH', 'POP', 'ADD', 'GETIDX', 'CACHED' ])
+
+
+def register(reg) -> int:
+    """- Returns the number of a register given as 'R<n>' or as a number"""
+    return reg if type(reg) is int else int(reg[1:])
+
+
+def link_registers(prog) -> list:
+    """- Returns 'prog' with register names resolved to register numbers"""
+    out = []
+    for instr in prog:
+        op = instr.opcode
+        if op in REGISTER_OPS and type(instr.arg1) is not int:
+            arg2 = register(instr.arg2) if op == 'GETIDX' else instr.arg2
+            instr = Instruction(op, register(instr.arg1), arg2)
+        out.append(instr)
+    return out
+
+
+def link(prog, slots) -> list:
+    """- Returns 'prog' with its variables resolved to the slots of 'slots' (a SlotVars)"""
+    out = []
+    for instr in prog:
+        op = instr.opcode
+        linked = LINKED.get(op)
+        if linked is None:
+            out.append(instr)
+        elif op == 'GET' or op == 'SET':
+            out.append(Instruction(linked, slots.slot(instr.arg1)))
+        elif op == 'ARG':
+            out.append(Instruction(linked, instr.arg1, slots.slot(instr.arg2)))
+        else:
+            out.append(Instruction(linked, instr.arg1, tuple(slots.slot(x) for x in instr.arg2)))
+    return out
+
+
+class SlotVars(MutableMapping):
+    def __init__(self, env=None):
+        """ The variables of a linked VM.  Variables that a program names are stored in
+        self.slots at the index given by self.symbols, the others in self.extra.
+
+        env :Dict[str, Any]: The initial variables, which are copied
+        """
+        self.symbols = {}
+        self.slots = []
+        self.slot_names = []
+        self.extra = dict(env) if env else {}
+        self.names = dict.fromkeys(self.extra)     # defined variables, in the order they were defined
+        self.order = None           # (name, slot) in interpolation order, rebuilt when a variable is defined
+
+    def slot(self, name : str) -> int:
+        """- Returns the slot of a variable, allocating one if needed"""
+        s = self.symbols.get(name)
+        if s is None:
+            s = len(self.slots)
+            self.symbols[name] = s
+            self.slots.append(self.extra.pop(name, UNDEFINED))
+            self.slot_names.append(name)
+            self.order = None
+        return s
+
+    def define(self, s : int):
+        """- Records that the variable in slot 's' is about to be defined"""
+        self.names[self.slot_names[s]] = None
+        self.order = None
+
+    def __getitem__(self, name):
+        s = self.symbols.get(name)
+        if s is None:
+            return self.extra[name]
+        value = self.slots[s]
+        if value is UNDEFINED:
+            raise KeyError(name)
+        return value
+
+    def get(self, name, default=None):
+        s = self.symbols.get(name)
+        if s is None:
+            return self.extra.get(name, default)
+        value = self.slots[s]
+        return default if value is UNDEFINED else value
+
+    def __setitem__(self, name, value):
+        if name not in self.names:
+            self.names[name] = None
+            self.order = None
+        s = self.symbols.get(name)
+        if s is None:
+            self.extra[name] = value
+        else:
+            self.slots[s] = value
+
+    def __delitem__(self, name):
+        del self.names[name]
+        s = self.symbols.get(name)
+        if s is None:
+            del self.extra[name]
+        else:
+            self.slots[s] = UNDEFINED
+        self.order = None
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def interpolate(self, body : str, skip=None) -> str:
+        """- Same as PreprocessorVM.interpolate, with the interpolation order kept between calls"""
+        order = self.order
+        if order is None:
+            order = self.order = [ (name, self.symbols.get(name)) for name in sorted(self.names, key=len, reverse=True) ]
+        slots = self.slots
+        extra = self.extra
+        for v, s in order:
+            # only convert values that are used, loop lists can be very large
+            if v in body and not (skip and v in skip):
+                body = body.replace(v, str(extra[v] if s is None else slots[s]))
+        return body
@@ -0,0 +1,187 @@
+"""Where templates are read from and where rendered files are written to.
+
+By default fill_template reads templates and their #include files from disk, relative to
+the working directory, and writes the rendered file next to the template.  A loader and a
+writer can be given to change that:
+
+    loader = MemoryLoader({ "main.py.template": "#include \\"common.inc\\"\\n...",
+                            "lib/common.inc": "..." }, search_path=[ "lib" ])
+    writer = OutputCollector()
+    fill_template("main.py.template", env, loader=loader, writer=writer)
+    writer.files["main.py"]
+
+An #include path is looked up as given, then relative to the directory of the including
+template, then in each directory of the search path.  The first template found is used.
+
+Loaders:
+    FileLoader     templates on disk, with an optional search path
+    MemoryLoader   templates held in memory, eg. preloaded by a render service or a test,
+                   or read from a single .zip or .tar archive with MemoryLoader.from_archive()
+
+Writers:
+    FileWriter       writes the rendered files to disk, creating directories as needed
+    OutputCollector  keeps the rendered files in memory and writes nothing
+"""
+import io
+import os
+import itertools
+import posixpath
+import tarfile
+import zipfile
+from typing import Dict, List, Union
+
+
+class FileLoader:
+    def __init__(self, search_path : List[str] = None, root : str = None):
+        """ Reads templates from disk.  Loaders with the same search path and root are equal, so
+        that a TemplateCache shares the templates they read.
+
+        search_path :List[str]: Directories searched for templates that aren't found as given
+        root :str: Directory that relative paths are resolved from, instead of the working directory
+        """
+        self.search_path = list(search_path or [])
+        self.root = root
+
+    def __eq__(self, other):
+        return type(other) is type(self) and (other.root, other.search_path) == (self.root, self.search_path)
+
+    def __hash__(self):
+        return hash((type(self), self.root, tuple(self.search_path)))
+
+    def resolve(self, path : str) -> str:
+        """- Returns 'path' relative to the loader's root"""
+        return path if self.root is None else os.path.join(self.root, path)
+
+    def candidates(self, name : str, relative_to : str = None):
+        """- Generates the paths that 'name' can refer to, in the order they are tried"""
+        yield self.resolve(name)
+        if os.path.isabs(name):
+            return
+        if relative_to:
+            yield os.path.join(os.path.dirname(relative_to), name)
+        for directory in self.search_path:
+            yield os.path.join(self.resolve(directory), name)
+
+    def find(self, name : str, relative_to : str = None) -> str:
+        """- Returns the path of the template 'name', or None if it can't be found
+        Args:
+            name :str: The template path, as given to fill_template or #include
+            relative_to :str: The path of the including template, if any
+        """
+        for path in self.candidates(name, relative_to):
+            if self.exists(path):
+                return path
+        return None
+
+    def exists(self, path : str) -> bool:
+        return os.path.isfile(path)
+
+    def lines(self, path : str, encoding : str = None) -> List[str]:
+        """- Returns the lines of a template, raises FileNotFoundError if it doesn't exist.  Given
+        'encoding', the lines are read as bytes for a bytes mode template (see Fpos)"""
+        with open(path, "rt" if encoding is None else "rb") as f:
+            return f.readlines()
+
+    def stamp(self, path : str):
+        """- Returns a value that changes whenever the template changes, or None if it doesn't exist"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return [st.st_mtime_ns, st.st_size]
+
+
+class MemoryLoader(FileLoader):
+    # every add() gets a new version, so a replaced template never has the stamp of the old one
+    versions = itertools.count(1)
+
+    # every MemoryLoader holds its own templates
+    __eq__ = object.__eq__
+    __hash__ = object.__hash__
+
+    def __init__(self, files : Dict[str, str] = None, search_path : List[str] = None):
+        """ Reads templates from memory.  Paths are normalised, so 'a/../b.inc' and './b.inc' are
+        the same template.
+
+        files :Dict[str, Union[str, bytes]]: The initial templates, as { path: text }
+        search_path :List[str]: Directories searched for templates that aren't found as given
+        """
+        super().__init__(search_path)
+        self.files = {}
+        for path, text in (files or {}).items():
+            self.add(path, text)
+
+    @staticmethod
+    def key(path : str) -> str:
+        return posixpath.normpath(path.replace(os.sep, "/"))
+
+    def add(self, path : str, text : Union[str, bytes]):
+        """- Adds or replaces a template"""
+        self.files[self.key(path)] = (next(self.versions), text)
+
+    def remove(self, path : str):
+        self.files.pop(self.key(path), None)
+
+    def exists(self, path : str) -> bool:
+        return self.key(path) in self.files
+
+    def lines(self, path : str, encoding : str = None) -> List[str]:
+        entry = self.files.get(self.key(path))
+        if entry is None:
+            raise FileNotFoundError(f"No template {path}")
+        text = entry[1]
+        if encoding is None:
+            return io.StringIO(text if type(text) is str else text.decode("utf-8")).readlines()
+        return io.BytesIO(text if type(text) is bytes else text.encode(encoding)).readlines()
+
+    def stamp(self, path : str):
+        entry = self.files.get(self.key(path))
+        return None if entry is None else [entry[0], len(entry[1])]
+
+    @classmethod
+    def from_archive(cls, archive : str, search_path : List[str] = None, encoding : str = "utf-8"):
+        """- Returns a loader holding every file of a .zip or .tar (optionally compressed) archive
+        Args:
+            archive :str: Path of the archive
+            search_path :List[str]: Directories of the archive searched for templates
+            encoding :str: Encoding of the templates in the archive
+        """
+        loader = cls(search_path=search_path)
+        if zipfile.is_zipfile(archive):
+            with zipfile.ZipFile(archive) as zf:
+                for info in zf.infolist():
+                    if not info.is_dir():
+                        loader.add(info.filename, zf.read(info).decode(encoding))
+        elif tarfile.is_tarfile(archive):
+            with tarfile.open(archive) as tf:
+                for member in tf:
+                    if member.isfile():
+                        loader.add(member.name, tf.extractfile(member).read().decode(encoding))
+        else:
+            raise ValueError(f"{archive} is not a zip or tar archive")
+        return loader
+
+
+class FileWriter:
+    """Writes rendered files to disk"""
+    def write(self, path : str, header : str, body : str) -> int:
+        """- Writes a rendered file and returns the number of characters written.  The header and body
+        of a bytes mode template are bytes, and are written as they are"""
+        odir = os.path.dirname(path)
+        if odir and not os.path.isdir(odir):
+            print(f"creating directory {odir}")
+            os.makedirs(odir)
+        with open(path, "wt" if type(body) is str else "wb") as f:
+            return f.write(header) + f.write(body)
+
+
+class OutputCollector(FileWriter):
+    """Keeps rendered files in memory, as { path: text } in self.files (bytes for a bytes mode template),
+    instead of writing them"""
+    def __init__(self):
+        self.files = {}
+
+    def write(self, path : str, header : str, body : str) -> int:
+        text = header + body
+        self.files[path] = text
+        return len(text)
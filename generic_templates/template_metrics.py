@@ -0,0 +1,147 @@
+import json
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+class StageMetrics:
+    """Accumulated measurements for one pipeline stage of fill_template"""
+    def __init__(self, name : str):
+        self.name = name
+        self.calls = 0
+        self.wall_s = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.items = 0          # tokens or instructions depending on the stage
+        self.peak_mem = 0
+
+    def to_dict(self) -> dict:
+        return {
+            "stage": self.name,
+            "calls": self.calls,
+            "wall_s": self.wall_s,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "items": self.items,
+            "peak_mem": self.peak_mem
+        }
+
+
+class TemplateMetrics:
+    """Collects per-stage timing and memory metrics while a template is filled.
+
+    The stages recorded by fill_template are: read, lex, parse, optimize, execute,
+    include, secrets and write.  Repeated stages (eg. the lex stage of an included
+    template) accumulate into the same record.  Stages nest, eg. the stages of an included
+    template run inside the include stage, which runs inside the execute stage of the
+    including template.  The time of each stage excludes the stages nested in it, so the
+    include stage only counts the work of the #include itself and the stage times add up
+    to the time measured.  Text sizes are counted in characters.
+
+    Example:
+        metrics = TemplateMetrics("foo.py.template", trace_memory=True)
+        fill_template("foo.py.template", env, metrics=metrics)
+        metrics.write("metrics.prom")
+    """
+    def __init__(self, template : str = None, trace_memory : bool = False):
+        """
+        template :str: Name of the template reported with each metric
+        trace_memory :bool: Use tracemalloc to record the peak memory of each stage
+        """
+        self.template = template
+        self.trace_memory = trace_memory
+        self.stages = {}
+        self._open = []
+        self._nested = []       # time spent in the stages nested in each open stage
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def get(self, name : str) -> StageMetrics:
+        """- Returns the record for a stage, creating it if needed"""
+        rec = self.stages.get(name)
+        if rec is None:
+            rec = StageMetrics(name)
+            self.stages[name] = rec
+        return rec
+
+    def _fold_peak(self):
+        # tracemalloc has a single peak counter, so fold it into every open stage
+        # before it is reset or the stage is closed
+        peak = tracemalloc.get_traced_memory()[1]
+        for entry in self._open:
+            if peak - entry[1] > entry[0].peak_mem:
+                entry[0].peak_mem = peak - entry[1]
+
+    @contextmanager
+    def stage(self, name : str, bytes_in : int = 0):
+        """- Measures the stage 'name' for the duration of a with block
+
+        Yields the StageMetrics record so that the block can add byte and item counts.
+        """
+        rec = self.get(name)
+        rec.calls += 1
+        rec.bytes_in += bytes_in
+        if self.trace_memory:
+            self._fold_peak()
+            tracemalloc.reset_peak()
+            self._open.append([rec, tracemalloc.get_traced_memory()[0]])
+        nested = self._nested
+        nested.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield rec
+        finally:
+            elapsed = time.perf_counter() - start
+            rec.wall_s += elapsed - nested.pop()
+            if nested:
+                nested[-1] += elapsed
+            if self.trace_memory:
+                self._fold_peak()
+                self._open.pop()
+
+    def to_json_lines(self) -> str:
+        """- Returns one JSON object per stage, one per line"""
+        lines = []
+        for rec in self.stages.values():
+            d = { "template": self.template }
+            d.update(rec.to_dict())
+            lines.append(json.dumps(d))
+        return "\n".join(lines) + "\n"
+
+    def to_prometheus(self, prefix : str = "fill_template_stage") -> str:
+        """- Returns the metrics in the Prometheus text exposition format"""
+        fields = [
+            ("calls", "Number of times the stage ran"),
+            ("wall_s", "Wall clock seconds spent in the stage"),
+            ("bytes_in", "Characters read by the stage"),
+            ("bytes_out", "Characters produced by the stage"),
+            ("items", "Tokens or instructions processed by the stage"),
+            ("peak_mem", "Peak traced memory of the stage in bytes")
+        ]
+        template = str(self.template).replace("\\", "\\\\").replace('"', '\\"')
+        result = []
+        for field, text in fields:
+            metric = f"{prefix}_{field}"
+            result.append(f"# HELP {metric} {text}")
+            result.append(f"# TYPE {metric} gauge")
+            for rec in self.stages.values():
+                value = getattr(rec, field)
+                result.append(f'{metric}{{template="{template}",stage="{rec.name}"}} {value}')
+        return "\n".join(result) + "\n"
+
+    def write(self, path : str):
+        """- Writes the metrics to a file.
+
+        Files ending in '.prom' are replaced with the Prometheus text format (written to a
+        temporary file and renamed, as the node exporter textfile collector expects).  Any
+        other file has one JSON line per stage appended to it.
+        """
+        if path.endswith(".prom"):
+            tmppath = f"{path}.{os.getpid()}.tmp"
+            with open(tmppath, "wt") as f:
+                f.write(self.to_prometheus())
+            os.replace(tmppath, path)
+        else:
+            with open(path, "at") as f:
+                f.write(self.to_json_lines())
@@ -0,0 +1,190 @@
+"""Optimisation pass over compiled templates.
+
+An expression such as basename(DATASET) compiles to a GET or CONST followed by one or
+more XCALLs.  optimize() rewrites expressions in two ways:
+
+  - Inside a #for loop, an expression whose operand is not assigned anywhere in the
+    loop (by #define, #template, #for or an #include) is computed the first time it is
+    reached and kept in a register for the rest of the loop:
+
+            CACHED  R1, cached7     ; push R1 and skip the expression once it is set
+            GET     DATASET
+            XCALL   basename
+            DUP
+            POP     R1
+    cached7: LABEL
+
+    The register is cleared before the FOREACH of the outermost loop for which the
+    expression is invariant.  Computing the value when it is first reached, rather than
+    before the loop, means expressions in empty loops or untaken branches are never
+    evaluated, just as before.
+
+  - Within a straight run of instructions, an expression that is repeated while none of
+    its operands change is computed once; the first occurrence saves its result in a
+    register with DUP/POP and the others PUSH it.  This is only done where it saves work.
+
+interpolate() reads every variable, including the loop variables, so it is never
+treated as loop invariant, but repeated interpolations are shared.  indices() returns
+an iterator that a loop consumes, so it is never shared.
+"""
+from .template_instr import Instruction, gensym
+
+# XCALL functions whose result only depends on their argument (and for interpolate, the variables)
+CACHEABLE = frozenset([ 'basename', 'dirname', 'len', 'interpolate' ])
+
+# registers available to the optimiser; R0 holds the template name during #include
+REGISTERS = [ f'R{x}' for x in range(1, 64) ]
+
+# stands for "every variable" in dependency sets
+ALL = None
+
+
+def expressions(prog):
+    """- Returns (start, end, deps) for each GET/CONST followed by cacheable XCALLs, where
+    deps is the set of variables read, or ALL"""
+    result = []
+    pc = 0
+    while pc < len(prog):
+        instr = prog[pc]
+        if instr.opcode == 'GET' or instr.opcode == 'CONST':
+            end = pc + 1
+            while end < len(prog) and prog[end].opcode == 'XCALL' and prog[end].arg1 in CACHEABLE:
+                end += 1
+            if end > pc + 1:
+                if any(prog[x].arg1 == 'interpolate' for x in range(pc+1, end)):
+                    deps = ALL
+                elif instr.opcode == 'GET':
+                    deps = frozenset([ instr.arg1 ])
+                else:
+                    deps = frozenset()
+                result.append((pc, end, deps))
+                pc = end
+                continue
+        pc += 1
+    return result
+
+
+def loops(prog):
+    """- Returns (foreach, end, assigned) for each #for loop, where the body runs up to the
+    'brk' LABEL at 'end' and assigned is the set of variables set in the loop, or ALL"""
+    labels = { instr.arg1: pc for pc, instr in enumerate(prog) if instr.opcode == 'LABEL' }
+    result = []
+    for pc, instr in enumerate(prog):
+        if instr.opcode != 'FOREACH' or pc+2 >= len(prog) or prog[pc+2].opcode != 'NEXT':
+            continue
+        end = labels[prog[pc+2].arg1]
+        assigned = set()
+        for x in range(pc+2, end):
+            op = prog[x].opcode
+            if op == 'SET':
+                assigned.add(prog[x].arg1)
+            elif op == 'ARG':
+                assigned.add(prog[x].arg2)
+            elif op == 'NEXT':
+                assigned.update(prog[x].arg2)
+            elif op == 'INCLUDE':
+                assigned = ALL
+                break
+        result.append((pc, end, assigned))
+    return result
+
+
+def invalidates(instr, deps) -> bool:
+    """- Returns True if 'instr' can change the value of an expression that reads 'deps'"""
+    op = instr.opcode
+    if op == 'INCLUDE':
+        return True
+    if op == 'SET':
+        return deps is ALL or instr.arg1 in deps
+    if op == 'ARG':
+        return deps is ALL or instr.arg2 in deps
+    return False
+
+
+def cost(prog, start, end) -> int:
+    """- Rough cost of running an expression, in instructions"""
+    return sum(8 if prog[x].arg1 == 'interpolate' else 1 for x in range(start, end))
+
+
+def optimize(prog) -> list:
+    """- Returns 'prog' with loop invariant expressions cached and repeated expressions shared"""
+    exprs = expressions(prog)
+    if not exprs:
+        return prog
+    registers = iter(REGISTERS)
+    replace = {}        # start -> (end, replacement instructions)
+    resets = {}         # FOREACH pc -> registers to clear
+
+    # loop invariant expressions, cached for the outermost loop they are invariant in
+    all_loops = loops(prog)
+    cached = {}
+    shared = []
+    for start, end, deps in exprs:
+        target = None
+        if deps is not ALL:
+            for foreach, loop_end, assigned in all_loops:
+                if foreach < start < loop_end and assigned is not ALL and not (deps & assigned):
+                    target = foreach
+                    break
+        if target is None:
+            shared.append((start, end, deps))
+            continue
+        key = (target, tuple((prog[x].opcode, prog[x].arg1) for x in range(start, end)))
+        if key not in cached:
+            reg = next(registers, None)
+            if reg is None:
+                continue
+            cached[key] = reg
+            resets.setdefault(target, []).append(reg)
+        reg = cached[key]
+        label = gensym('cached')
+        replace[start] = (end, [ Instruction.CACHED(reg, label) ] + prog[start:end] + [
+            Instruction.DUP(),
+            Instruction.POP(reg),
+            Instruction.LABEL(label)
+        ])
+
+    # repeated expressions within a straight run of instructions
+    groups = []
+    run = {}
+    pos = 0
+    for start, end, deps in shared:
+        for x in range(pos, start):
+            op = prog[x].opcode
+            if op in ('LABEL', 'JMP', 'JMPIF', 'JMPIFNOT', 'NEXT', 'FOREACH', 'HALT'):
+                run = {}
+            elif run and op in ('SET', 'ARG', 'INCLUDE'):
+                run = { k: g for k, g in run.items() if not invalidates(prog[x], g[0]) }
+        pos = end
+        key = tuple((prog[x].opcode, prog[x].arg1) for x in range(start, end))
+        if key in run:
+            run[key][1].append(start)
+        else:
+            run[key] = (deps, [ start ])
+            groups.append((start, end, run[key][1]))
+    for start, end, sites in groups:
+        if (len(sites)-1) * (cost(prog, start, end)-1) <= 2:
+            continue
+        reg = next(registers, None)
+        if reg is None:
+            break
+        replace[start] = (end, prog[start:end] + [ Instruction.DUP(), Instruction.POP(reg) ])
+        for site in sites[1:]:
+            replace[site] = (site + end - start, [ Instruction.PUSH(reg) ])
+
+    if not replace:
+        return prog
+    out = []
+    pc = 0
+    while pc < len(prog):
+        if pc in resets:
+            for reg in resets[pc]:
+                out += [ Instruction.CONST(None), Instruction.POP(reg) ]
+        if pc in replace:
+            end, code = replace[pc]
+            out += code
+            pc = end
+        else:
+            out.append(prog[pc])
+            pc += 1
+    return out
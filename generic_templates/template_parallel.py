@@ -0,0 +1,164 @@
+"""Parallel rendering of independent #for loops.
+
+The compiler marks a #for loop as independent when its body only writes text, tests
+conditions and reads variables (see template_instr.is_pure), so that no iteration can
+change what another one renders.  When a VM is given a ParallelLoops pool, independent
+loops with at least 'threshold' rows are split into chunks of 'chunk_size' rows that are
+rendered by worker processes, and the outputs of the chunks are joined in order.  The
+errors reported by a worker are merged into the ErrorReport of the VM as its chunk is joined.
+
+    with ParallelLoops(workers=8) as parallel:
+        fill_template("huge.py.template", env, parallel=parallel)
+
+Smaller loops, loops in traced VMs, and loops whose rows or variables can't be pickled
+are run in the VM as usual.  Only a bounded number of chunks are in flight at once, so
+rows from a lazy source (eg. table_source) are still read incrementally.
+"""
+import itertools
+import os
+import pickle
+from collections import deque
+from .template_instr import Instruction
+from .error_report import ErrorReport
+
+
+def referenced(prog, env : dict, rows, encoding : str = None) -> dict:
+    """- Returns the variables of 'env' that can be interpolated while rendering 'rows' with 'prog',
+    'encoding' is that of a bytes mode program (see Fpos)"""
+    texts = [ instr.arg1 for instr in prog
+              if type(instr.arg1) is str and instr.opcode != 'LABEL' and instr.opcode != 'WRITE' ]
+    if encoding is not None:
+        texts += [ instr.arg1.decode(encoding, "surrogateescape") for instr in prog
+                   if type(instr.arg1) is bytes and instr.opcode == 'EMIT' ]
+    texts += [ str(value) for row in rows for value in row ]
+    text = "\0".join(texts)
+    refs = {}
+    found = True
+    while found:
+        found = False
+        for name in env:
+            if name not in refs and name in text:
+                refs[name] = env[name]
+                text += "\0" + str(env[name])
+                found = True
+    return refs
+
+
+def render_chunk(prog, env : dict, rows, symbols, encoding : str = None):
+    """- Runs a loop program over 'rows' and returns (output, the variables set in 'symbols', the
+    ErrorReport of the chunk, the exception that stopped it or None)
+
+    This is the function run by the worker processes.  Errors are buffered in the report rather
+    than printed, for the parent to merge into its own report in the order of the chunks.
+    """
+    from .template_vm import PreprocessorVM
+    errors = ErrorReport(buffered=True)
+    vm = PreprocessorVM(dict(env), encoding=encoding, errors=errors)
+    vm.prog(prog)
+    vm.loops.append(iter(rows))
+    failure = None
+    try:
+        vm.execute()
+    except Exception as e:
+        failure = e
+    changed = { k: vm.vars[k] for k in symbols if k in vm.vars and (k not in env or vm.vars[k] is not env[k]) }
+    return ("".join(vm.output) if encoding is None else b"".join(vm.output)), changed, errors, failure
+
+
+class ParallelLoops:
+    def __init__(self, workers : int = None, threshold : int = 10000, chunk_size : int = 2000):
+        """
+        workers :int: Number of worker processes, defaults to the number of CPUs
+        threshold :int: Loops with fewer rows than this are run in the VM
+        chunk_size :int: Number of rows rendered by a worker at a time
+        """
+        self.workers = workers
+        self.threshold = max(threshold, 1)
+        self.chunk_size = max(chunk_size, 1)
+        self.pool = None
+
+    def executor(self):
+        if self.pool is None:
+            from concurrent.futures import ProcessPoolExecutor
+            self.pool = ProcessPoolExecutor(self.workers)
+        return self.pool
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def chunks(self, rows):
+        while True:
+            chunk = list(itertools.islice(rows, self.chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+    def run(self, vm, rows):
+        """- Runs the loop starting at vm.pc over 'rows'.
+
+        Returns None when the loop has been rendered, with the VM positioned after it, or an
+        iterator over the rows for the VM to run the loop itself.
+        """
+        progmem = vm.source           # the instructions before variables were linked to slots
+        pc = vm.pc
+        if pc+1 >= len(progmem) or progmem[pc].opcode != 'LABEL' or progmem[pc+1].opcode != 'NEXT':
+            return rows
+        head = list(itertools.islice(rows, self.threshold))
+        if len(head) < self.threshold:
+            return iter(head)
+        rows = itertools.chain(head, rows)
+
+        # the loop from 'LABEL loop' up to and including 'LABEL brk', as a program of its own
+        next_instr = progmem[pc+1]
+        end = vm.labels[next_instr.arg1]
+        prog = [ Instruction.LABEL('main') ] + progmem[pc:end+1] + [ Instruction.HALT() ]
+        symbols = set()
+        for instr in prog:
+            if instr.opcode == 'NEXT':
+                symbols.update(instr.arg2)
+
+        # every chunk starts from the variables as they were before the loop
+        initial = dict(vm.vars)
+        chunks = self.chunks(rows)
+        first = next(chunks)
+        encoding = vm.encoding
+        env = referenced(prog, initial, first, encoding)
+        try:
+            pickle.dumps((env, first))
+        except Exception:
+            return itertools.chain(first, itertools.chain.from_iterable(chunks))
+
+        pool = self.executor()
+        window = 2 * (self.workers or os.cpu_count() or 1)
+        pending = deque([ pool.submit(render_chunk, prog, env, first, symbols, encoding) ])
+        last = first[-1]
+        for chunk in chunks:
+            last = chunk[-1]
+            pending.append(pool.submit(render_chunk, prog, referenced(prog, initial, chunk, encoding), chunk, symbols, encoding))
+            if len(pending) >= window:
+                self.collect(vm, pending.popleft().result())
+        while pending:
+            self.collect(vm, pending.popleft().result())
+
+        for var, val in zip(next_instr.arg2, last):
+            vm.vars[var] = val
+        vm.pc = end
+        return None
+
+    @staticmethod
+    def collect(vm, result):
+        output, changed, errors, failure = result
+        vm.output.append(output)
+        vm.vars.update(changed)
+        if errors.errors or errors.dropped:
+            vm.error_report().merge(errors)
+        if failure is not None:
+            raise failure
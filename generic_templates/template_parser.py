@@ -1,11 +1,13 @@
 from lark import Transformer, Lark
-from .template_instr import Instruction, gensym
+from lark.lexer import Lexer
+from .template_instr import Instruction, gensym, is_pure
 from .template_tokenizer import PreprocessorLexer
-import sys
+from .template_optimize import optimize
+from .error_report import ErrorReport
 
-TRACE=False
-
-# Syntax definition for the preprocessor
+# Syntax definition for the preprocessor.  The grammar is written so that every
+# instruction can be emitted at the reduction that completes it: the 'head' rules are
+# reduced before the block that follows them is parsed.
 preprocessor_bnf = r"""
 start: block
 
@@ -19,9 +21,15 @@ anyitem: body
     | instruction
     | for
 
-for: FOR arglist IN exprlist block ENDFOR -> foreach
+for: forhead block ENDFOR -> foreach
+
+forhead: FOR arglist IN exprlist
+
+include: includehead includename (COMMA expr)* -> include
 
-include: INCLUDE exprlist -> include
+includehead: INCLUDE
+
+includename: expr
 
 define: DEFINE SYMBOL expr? -> setsymbol
     | TEMPLATE arglist -> template
@@ -37,11 +45,14 @@ exprlist: expr -> exprlist
 instruction: HALT -> halt
     | OUTFILE expr -> outfile
 
-condbody: IF bexpr block ENDIF -> condbody
-    | IF bexpr block ELSE block ENDIF -> condbody
-    | IFDEF SYMBOL block ENDIF -> condbody2
-    | IFDEF SYMBOL block ELSE block ENDIF -> condbody2
-    | IFNDEF SYMBOL block ENDIF -> condbody2
+condbody: ifhead block ENDIF -> condbody
+    | ifhead block elsehead block ENDIF -> condbody
+
+ifhead: IF bexpr -> ifhead
+    | IFDEF SYMBOL -> ifdefhead
+    | IFNDEF SYMBOL -> ifdefhead
+
+elsehead: ELSE
 
 body: TEXT+
 
@@ -65,6 +76,17 @@ expr: SYMBOL -> eval1
 %declare BASENAME DIRNAME INTERPOLATE IN FOR ENDFOR INDICES REPORT
 """
 
+# EVAL2 compares the top of the stack with the value below it, so comparisons whose
+# operands are pushed in source order use the mirrored operator
+MIRROR = {
+    '==': '==',
+    '!=': '!=',
+    '<': '>',
+    '>': '<',
+    '<=': '>=',
+    '>=': '<='
+}
+
 # Utility functions
 def unwrap_str(s):
     """ Removes quotes and evaluates escaped characters to produce a string from a source-code quoted string representation
@@ -73,24 +95,63 @@ def unwrap_str(s):
     return ast.literal_eval(s)
 
 
-# Parser tree transformer to output file (as a list of lines)
+# Code generator, applied by the parser as each rule is reduced so that no parse tree is built
 class ParsePreprocessor(Transformer):
-    def __init__(self):
-        pass
+    def __init__(self, trace=None):
+        """- Construct the code generator
+        Args:
+          trace :TraceHook: Optional hook that receives a 'reduce' event for each rule
+        """
+        self.reset(trace)
+
+    def reset(self, trace=None):
+        """- Prepares to generate a new program.
+
+        Instructions are appended to self.code in program order.  Forward jumps use labels
+        that are placed when the end of their block is reduced; the constructs that are
+        still open are kept on self.pending.  The template line of each instruction is set
+        by locate() as the tokens of the line are reduced.  Each open #for has an entry
+        [ pure, scanned ] on self.loops: whether the instructions of its body scanned so far are
+        free of side effects, and where the scan stopped, so that every instruction is scanned once.
+        """
+        self.code = []
+        self.pending = []
+        self.loops = []
+        self.located = 0        # instructions before this one have their source line set
+        self.line = None
+        self.trace = trace
+        if trace is not None:
+            self.log = trace.reduce
+        elif 'log' in self.__dict__:
+            del self.log
 
     def log(self, node, v):
-        global TRACE
-        if TRACE:
-           print(f"reduce {node} {v}", file=sys.stderr)
+        pass
+
+    def scan(self):
+        """- Adds the instructions generated since the innermost open #for was last scanned to its purity"""
+        top = self.loops[-1]
+        code = self.code
+        top[0] = top[0] and is_pure(code[top[1]:])
+        top[1] = len(code)
+
+    def locate(self, line):
+        """- Sets the 1-based template line of the instructions generated since the last call"""
+        self.line = line
+        code = self.code
+        for i in range(self.located, len(code)):
+            code[i].line = line
+        self.located = len(code)
 
     def start(self, v):
         # block
         self.log("start",v)
-        block = v[0]
-        result = block + [
-            Instruction.HALT()
-        ]
-        return result
+        code = self.code
+        code.append(Instruction.HALT())
+        self.locate(self.line)
+        self.code = []
+        self.located = 0
+        return code
 
     def dumpstack(self, rule, v):
         print(rule, "dumpstack")
@@ -99,84 +160,65 @@ class ParsePreprocessor(Transformer):
 
     def report(self, v):
         # REPORT expr
-        code = v[1] + [ Instruction.PRINT() ]
-        return code
+        self.log("report", v)
+        self.code.append(Instruction.PRINT())
+        self.locate(v[0].line + 1)
 
-    def foreach(self, v):
-        #self.dumpstack("foreach",v)
-        # FOREACH arglist IN exprlist block ENDFOREACH
+    def forhead(self, v):
+        # FOR arglist IN exprlist
+        self.log("forhead", v)
         arglist = v[1]
-        exprlist = v[3]
-        block = v[4]
-        assert(len(arglist)==len(exprlist))
-
-        arglen = len(arglist)
-
-        # save the registers that will be used for this foreach loop and initialize the main index
-        code = [
-            Instruction.PUSH(f'R{n}') for n in range(arglen+2)
-        ] + [
-            Instruction.CONST(0),
-            Instruction.POP('R0'),   # index
-        ]
-
-        # initialize the lists that will be iterated over
-        for i in range(len(arglist)):
-            code += exprlist[i]                     # run the n-th expr
-            if i==0:
-                code += [
-                    Instruction.DUP(),
-                    Instruction.XCALL('len'),
-                    Instruction.POP('R1')        # len of first expr is saved in R1
-                ]
-            code += [
-                Instruction('POP', f"R{i+2}")       # n-th expr result
-            ]
+        argc = v[3]
+        assert(len(arglist)==argc)
 
-        # check if we are at the end of the loop iterations
+        # FOREACH zips the lists together; each NEXT sets the loop variables from the next
+        # row of the zip, or exits the loop when the shortest list runs out
         loop0 = gensym('loop')
         break0 = gensym('brk')
-        code += [
+        if self.loops:
+            self.scan()
+        self.pending.append((len(self.code), loop0, break0))
+        self.code += [
+            Instruction.FOREACH(argc),
             Instruction.LABEL(loop0),
-            Instruction.PUSH('R0'),
-            Instruction.PUSH('R1'),
-            Instruction.EVAL2('<='),
-            Instruction.JMPIF(break0),           # exit loop if len <= index
+            Instruction.NEXT(break0, tuple(arglist))
         ]
+        self.loops.append([ True, len(self.code) ])
+        self.locate(v[0].line + 1)
 
-        # set the iterators
-        for i in range(len(arglist)):
-            code += [
-                Instruction.GETIDX(f'R{i+2}', 'R0'),
-                Instruction.SET(arglist[i])      # arglist[i] = expr[i]
-            ]
-
-        # run the loop body, increment, and loop.  on loop exit restore the registers.
-        code += block + [
-            Instruction.ADD('R0', 1),
+    def foreach(self, v):
+        # forhead block ENDFOR
+        self.log("foreach", v)
+        start, loop0, break0 = self.pending.pop()
+        # loops whose iterations can't affect each other are marked so that they can be
+        # run in parallel, which is only known once the whole body has been generated.
+        # A loop is pure if its own instructions and its nested loops are.
+        self.scan()
+        pure = self.loops.pop()[0]
+        code = self.code
+        line = code[start].line
+        code[start] = Instruction.FOREACH(code[start].arg1, pure)
+        code[start].line = line
+        code += [
             Instruction.JMP(loop0),
-            Instruction.LABEL(break0) #end
-        ] + [
-            Instruction.POP(f'R{n-1}') for n in range(arglen+2, 0, -1)
+            Instruction.LABEL(break0)
         ]
-        return code
-
+        if self.loops:
+            outer = self.loops[-1]
+            outer[0] = outer[0] and pure
+            outer[1] = len(code)
+        self.locate(v[-1].line + 1)
 
     def block(self, v):
         # anyitem*
         self.log("block", v)
-        result = []
-        for i in v:
-            result.extend(i)
-        return result
 
     def template(self, v):
         # TEMPLATE arglist
         self.log("template", v)
-        result = []
         for i, _v in enumerate(v[1]):
-            result.append(Instruction.ARG(i, _v))
-        return result
+            self.code.append(Instruction.ARG(i, _v))
+        self.locate(v[0].line + 1)
 
     def arglist(self, v):
         # symbol | arglist, symbol
@@ -188,182 +230,234 @@ class ParsePreprocessor(Transformer):
         return result
 
     def exprlist(self, v):
-        #self.dumpstack("exprlist", v)
         # expr | exprlist, expr
+        # returns the number of expressions, whose code has already been emitted
         self.log("exprlist", v)
         if len(v)==1:
-            result = [ v[0] ]
-        else:
-            v[0].append(v[2])
-            result = v[0]
-        return result
+            return 1
+        return v[0] + 1
 
     def halt(self, v):
         # halt
         self.log("halt", v)
-        return [ Instruction.HALT() ]
-    
+        self.code.append(Instruction.HALT())
+        self.locate(v[0].line + 1)
+
+    def includehead(self, v):
+        # INCLUDE
+        self.log("includehead", v)
+        self.code.append(Instruction.PUSH("R0"))
+        self.locate(v[0].line + 1)
+
+    def includename(self, v):
+        # expr
+        self.log("includename", v)
+        self.code.append(Instruction.POP("R0"))       # template name to include in R0
+
     def include(self, v):
-        # include exprlist
+        # includehead includename (COMMA expr)*
         self.log("include", v)
-        exprlist = v[1]
-        code = [
-            Instruction.PUSH("R0")
-        ] + exprlist[0] + [
-            Instruction.POP("R0")       # template name to include in R0
-        ]
-        argc = len(exprlist)-1
-        for i in range(argc):
-            code += exprlist[i+1]       # run the n-th expr
-        code += [
-            Instruction.INCLUDE(len(exprlist)-1),
+        argc = (len(v)-2) // 2
+        self.code += [
+            Instruction.INCLUDE(argc),
             Instruction.POP("R0")
         ]
-        return code
+        self.locate(self.line)
 
     def outfile(self, n):
         # outfile string
         self.log("outfile", n)
-        return n[1] + [ Instruction.OUTFILE() ]
+        self.code.append(Instruction.OUTFILE())
+        self.locate(n[0].line + 1)
 
     def anyitem(self, v):
         self.log("anyitem", v)
-        return v[0]
 
     def setsymbol(self, v):
         self.log("setsymbol", v)
         var = v[1].value
-        value = True
-        if len(v) > 2:
-            value = v[2]
-        else:
-            value = [ Instruction.CONST(True) ]
-
-        result = value + [
-            Instruction.SET(var)
-        ]
-
-        #print(f"node setsymbol  {result}", file=sys.stderr)
-        return result
+        if len(v) == 2:
+            self.code.append(Instruction.CONST(True))
+        self.code.append(Instruction.SET(var))
+        self.locate(v[0].line + 1)
 
     def body(self, v):
         self.log("body", v)
-        result = [ Instruction.EMIT(x.value) for x in v ]
-        return result
-
-    def condbody(self, v):
-        self.log("condbody", v)
-        bexpr = v[1]
-        truestart = v[2]
-        falsestart = v[4] if len(v)==6 else []
-
-        # if bcond truestart else falsestart endif
-        truecase = gensym('true')
-        xcontinue = gensym('xcont')
-        result = bexpr + [
-            Instruction.JMPIF(truecase)
-        ] + falsestart + [
-            Instruction.JMP(xcontinue),
-            Instruction.LABEL(truecase)
-        ] + truestart + [
-            Instruction.LABEL(xcontinue)
+        for x in v:
+            instr = Instruction.EMIT(x.value)
+            instr.line = x.line + 1
+            self.code.append(instr)
+        self.line = v[-1].line + 1
+        self.located = len(self.code)
+
+    def ifhead(self, v):
+        # IF bexpr
+        self.log("ifhead", v)
+        falsecase = gensym('false')
+        self.pending.append(falsecase)
+        self.code.append(Instruction.JMPIFNOT(falsecase))
+        self.locate(v[0].line + 1)
+
+    def ifdefhead(self, v):
+        # IFDEF SYMBOL | IFNDEF SYMBOL
+        self.log("ifdefhead", v)
+        falsecase = gensym('false')
+        self.pending.append(falsecase)
+        self.code += [
+            Instruction.CONST(v[1].value),
+            Instruction.EVAL1('defined'),
+            Instruction.JMPIF(falsecase) if v[0].type == 'IFNDEF' else Instruction.JMPIFNOT(falsecase)
         ]
+        self.locate(v[0].line + 1)
 
-        #print(f"node condbody -> {result}", file=sys.stderr)
-        return result
-
-    def condbody2(self, v):
-        self.log("condbody2", v)
-        sym = v[1].value
-
-        truestart = v[2]
-        falsestart = v[4] if len(v)==6 else []
-
-        # ifn?def sym block1 else block2 endif
-        truecase = gensym('true')
+    def elsehead(self, v):
+        # ELSE
+        self.log("elsehead", v)
+        falsecase = self.pending.pop()
         xcontinue = gensym('xcont')
-
-        invert = []
-        if v[0].type == 'IFNDEF':
-            invert = [ Instruction.EVAL1('!') ]
-
-        result = [
-            Instruction.CONST(sym),
-            Instruction.EVAL1('defined')
-        ] + invert + [
-            Instruction.JMPIF(truecase)
-        ] + falsestart + [
+        self.pending.append(xcontinue)
+        self.code += [
             Instruction.JMP(xcontinue),
-            Instruction.LABEL(truecase)
-        ] + truestart + [
-            Instruction.LABEL(xcontinue)
+            Instruction.LABEL(falsecase)
         ]
+        self.locate(v[0].line + 1)
 
-        #print(f"node condbody2 -> {result}", file=sys.stderr)
-        return result
+    def condbody(self, v):
+        # ifhead block [elsehead block] ENDIF
+        self.log("condbody", v)
+        self.code.append(Instruction.LABEL(self.pending.pop()))
+        self.locate(v[-1].line + 1)
 
     def fncall(self, n):
-        # returns a list of instructions
         # <function> ( <expr> )
-
         self.log("fncall", n)
-
         builtin = n[0].type
-        return n[2] + [ Instruction.XCALL(builtin.lower()) ]
+        self.code.append(Instruction.XCALL(builtin.lower()))
 
     def eval1(self, n):
-        # returns a list of instructions
         self.log("eval1", n)
         cond = n[0].value
         if n[0].type == 'SYMBOL':
-            return [ Instruction.GET(cond) ]
+            self.code.append(Instruction.GET(cond))
         elif n[0].type == 'STRING':
-            return [ Instruction.CONST(unwrap_str(cond))]
+            self.code.append(Instruction.CONST(unwrap_str(cond)))
         elif n[0].type == 'TRUE':
-            return [ Instruction.CONST(True)]
+            self.code.append(Instruction.CONST(True))
         elif n[0].type == 'FALSE':
-            return [ Instruction.CONST(False)]
-        raise NotImplementedError(f"eval1: Type {n[0].type}")
+            self.code.append(Instruction.CONST(False))
+        else:
+            raise NotImplementedError(f"eval1: Type {n[0].type}")
 
     def expr0(self, v):
         self.log("expr0", v)
-        result = v[0]
-        return result
 
     def expr1(self, v):
         self.log("expr1", v)
         if v[0].type == 'UNARY':
             # ! a
-            a = v[1]
-            func = v[0].value
+            self.code.append(Instruction.EVAL1(v[0].value))
         elif v[0].type == 'DEFINED':
             # defined ( a )
-            a = v[2]
-            func = 'defined'
-
-        result = a + [ Instruction.EVAL1(func) ]
-        #print(f"node expr1 {result}", file=sys.stderr)
-        return result
+            self.code += [
+                Instruction.CONST(v[2].value),
+                Instruction.EVAL1('defined')
+            ]
 
     def expr2(self, v):
-        # a <=> b
+        # a <=> b, with a and b already on the stack in that order
         self.log("expr2", v)
-        a = v[0]
-        cmp = v[1].value
-        b = v[2]
-        result = b + a + [ Instruction.EVAL2(cmp) ]
-        #print(f"node expr2 {result}", file=sys.stderr)
-        return result
+        self.code.append(Instruction.EVAL2(MIRROR[v[1].value]))
+
+
+class TokenStream(Lexer):
+    """Passes tokens that were already produced by PreprocessorLexer through to the parser.
+    Lexing outside of Lark lets each compile use its own lexer settings (eg. trace hooks)"""
+    def __init__(self, lexer_conf=None):
+        pass
+
+    def lex(self, tokens):
+        return tokens
+
 
+_parsers = []       # idle parsers, each with its own code generator
+def get_parser():
+    """- Returns an idle preprocessor parser, building one if there is none.
 
-def compile(fp):
-    # Generate preprocessor script from input and execute the script in a VM
-    parser = Lark(preprocessor_bnf, parser='lalr', lexer=PreprocessorLexer)
+    Each parser runs its own ParsePreprocessor as the rules are reduced, so a parser is
+    only used by one compile at a time and is handed back with release_parser().  The
+    LALR tables are cached on disk by Lark (cache=True) so that short lived processes
+    such as fill-template don't rebuild them on every run.
+    """
+    try:
+        return _parsers.pop()
+    except IndexError:
+        return Lark(preprocessor_bnf, parser='lalr', lexer=TokenStream, transformer=ParsePreprocessor(), cache=True)
+
+
+def release_parser(parser):
+    """- Returns a parser from get_parser() for reuse"""
+    _parsers.append(parser)
+
+
+def syntax_error(e, fp, errors=None):
+    """- Reports a template that can't be compiled and exits.  The error is placed at the token
+    the parser stopped at, or else at the position the lexer reached in 'fp'"""
+    token = getattr(e, "token", None)
+    if getattr(token, "line", None) is not None:
+        where = (token.line + 1, token.column + 1)
+    else:
+        where = (fp.rpos + 1, fp.cpos + 1)
+    if errors is None:
+        errors = ErrorReport()
+    errors.error(str(e), where)
+    errors.exit_on_error()
+
+
+def compile(fp, trace=None, metrics=None, defines=None, errors=None):
+    """- Compiles a template into a list of VM instructions
+    Args:
+        fp :Fpos: The template source
+        trace :TraceHook: Optional hook that receives 'token' and 'reduce' events
+        metrics :TemplateMetrics: Optional collector for the lex, parse and optimize stages
+        defines :Dict[str, Any]: The environment the program will be run with.  When given,
+            #ifdef/#ifndef blocks that it decides are resolved by the lexer, so the program
+            must only be run with this environment
+        errors :ErrorReport: Optional report that syntax errors are recorded in, with their template position
+    """
+    if metrics is not None:
+        return compile_measured(fp, trace, metrics, defines, errors)
+    parser = get_parser()
+    parser.options.transformer.reset(trace)
+    try:
+        program = parser.parse(PreprocessorLexer(trace=trace, defines=defines).lex(fp))
+    except Exception as e:
+        syntax_error(e, fp, errors)
+    finally:
+        release_parser(parser)
+    return optimize(program)
+
+
+def compile_measured(fp, trace, metrics, defines=None, errors=None):
+    """- Same as compile() but runs the lexer to completion before parsing so that
+    each stage can be measured separately"""
+    size = sum(len(line) for line in fp.lines)
+    try:
+        with metrics.stage("lex", size) as stage:
+            tokens = list(PreprocessorLexer(trace=trace, defines=defines).lex(fp))
+            stage.items += len(tokens)
+    except Exception as e:
+        syntax_error(e, fp, errors)
+    parser = get_parser()
+    parser.options.transformer.reset(trace)
     try:
-        tree = parser.parse(fp)
+        with metrics.stage("parse") as stage:
+            stage.items += len(tokens)
+            program = parser.parse(tokens)
     except Exception as e:
-        print(e)
-        sys.exit(1)
-    #print(tree)
-    program = ParsePreprocessor().transform(tree)
+        syntax_error(e, fp, errors)
+    finally:
+        release_parser(parser)
+    with metrics.stage("optimize") as stage:
+        stage.items += len(program)
+        program = optimize(program)
     return program
\ No newline at end of file
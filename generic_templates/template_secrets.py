@@ -1,8 +1,6 @@
+import os
 import re
-try:
-    from jupyter_aws.secret import Secret
-except:
-    from .secret import Secret
+import time
 from .error_report import ErrorReport
 
 def replace_variable(body, span, varvalue):
@@ -19,13 +17,28 @@ def replace_variable(body, span, varvalue):
     #print(body)
     return body
 
-def get_secret(varname : str) -> str:
+# Secrets that have been fetched, as name -> (time fetched, value).  Entries are reused
+# for SECRET_CACHE_TTL seconds, which matters for long lived processes (see template_daemon).
+SECRET_CACHE_TTL = 300
+secret_cache = {}
+
+def get_secret(varname : str, errors : ErrorReport = None) -> str:
     """- Fetches a secret by name
     Args:
         varname :str: The name of the secret to fetch the value of
+        errors :ErrorReport: The report that a secret that can't be fetched is recorded in
     Returns:
         :str: the value of the secret
     """
+    cached = secret_cache.get(varname)
+    if cached is not None and time.monotonic() - cached[0] < SECRET_CACHE_TTL:
+        return cached[1]
+
+    # jupyter_aws is optional and slow to import, so it is only loaded when a secret is used
+    try:
+        from jupyter_aws.secret import Secret
+    except ImportError:
+        from .secret import Secret
 
     varvalue = None
     try:
@@ -33,15 +46,18 @@ def get_secret(varname : str) -> str:
         varvalue = secretid.get_secret()
         if varvalue is None:
             raise ValueError(f"invalid secret {varname}")
+        secret_cache[varname] = (time.monotonic(), varvalue)
     except AttributeError:
-        errors.error(f"Value error: Unable to get secret '{varname}'")
+        (errors or ErrorReport()).error(f"Value error: Unable to get secret '{varname}'")
 
     #print("get_secret", varname, "->", varvalue)
     return varvalue
 
 
-settings = None
-def get_setting(varname : str) -> str:
+# Parsed settings files, as absolute path -> ((mtime, size), settings).  A settings file
+# is read again when it changes.
+settings = {}
+def get_setting(varname : str, cwd : str = None) -> str:
     """- Returns an entry from a shell script 'setting.sh' in your local directory
 
     The file 'setting.sh' must contain shell variable definitions in the format:
@@ -50,24 +66,34 @@ def get_setting(varname : str) -> str:
 
     Args:
         varname :str: The name of the setting to fetch
+        cwd :str: The directory to read 'setting.sh' from, instead of the working directory
     Returns:
         :str: the value of the shell variable (ie the dequoted string)
     """
-    global settings
-    if settings is None:
-        with open("setting.sh", "rt") as f:
-            settings = {}
+    path = os.path.abspath(os.path.join(cwd or "", "setting.sh"))
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    cached = settings.get(path)
+    if cached is None or cached[0] != stamp:
+        with open(path, "rt") as f:
+            values = {}
             for line in f.readlines():
                 m = re.match(r'^ *([A-Za-z][A-Za-z0-9]*)="(.*)"$', line)
                 if m:
                     var = m.group(1)
                     val = m.group(2)
                     print(f"Setting {var}={val}")
-                    settings[var] = val
-    return settings[varname]
+                    values[var] = val
+        cached = (stamp, values)
+        settings[path] = cached
+    return cached[1][varname]
+
 
+SECRET_VARIABLE = re.compile(r"@([a-zA-Z_\.-]+):([a-zA-Z_\.-]+)@")
+SECRET_VARIABLE_BYTES = re.compile(rb"@([a-zA-Z_\.-]+):([a-zA-Z_\.-]+)@")
 
-def find_replace_variables(body : str) -> str:
+def find_replace_variables(body : str, encoding : str = None, environ : dict = None, cwd : str = None,
+                           errors : ErrorReport = None) -> str:
     """- Interpolates variables in the body of a document
 
     Variables have the form '@<type>:<varname>[.<property>]@'.  The supported
@@ -80,27 +106,42 @@ def find_replace_variables(body : str) -> str:
     environment.
 
     Args:
-        body :str: The document body to be interpolated.
+        body :Union[str, bytes]: The document body to be interpolated.
+        encoding :str: Encoding of the values substituted into a bytes body
+        environ :Dict[str, str]: The environment variables, instead of os.environ
+        cwd :str: The directory of 'setting.sh', instead of the working directory
+        errors :ErrorReport: The report that variables that can't be found are recorded in
     """
+    if environ is None:
+        environ = os.environ
+    if errors is None:
+        errors = ErrorReport()
+    binary = type(body) is bytes
+    pattern = SECRET_VARIABLE_BYTES if binary else SECRET_VARIABLE
     while True:
-        m = re.search(r"@([a-zA-Z_\.-]+):([a-zA-Z_\.-]+)@", body)
+        m = pattern.search(body)
         if m:
             span = m.group(0)
             vartype = m.group(1)
             varname = m.group(2)
+            if binary:
+                vartype = vartype.decode("ascii")
+                varname = varname.decode("ascii")
             #print(f"find_replace_variables: {vartype} {varname}")
             if vartype == "secret":
                 varname, varprop = varname.split(".")
-                varvalue = get_secret(varname)[varprop]
+                varvalue = get_secret(varname, errors)[varprop]
             elif vartype == "env":
-                varvalue = os.environ.get(varname)
+                varvalue = environ.get(varname)
                 if varvalue is None:
                     errors.error(f"Value error: Unable to get env '{varname}'")
             elif vartype == "setting.sh":
-                varvalue = get_setting(varname)
+                varvalue = get_setting(varname, cwd)
             else:
                 errors.error(f"Unknown variable type: '{vartype}'")
                 varvalue = None
+            if binary:
+                varvalue = b"NODATA" if varvalue is None else varvalue.encode(encoding or "utf-8")
             body = replace_variable(body, span, varvalue)
         else:
             break
@@ -0,0 +1,205 @@
+"""Partial evaluation of compiled templates against a fixed environment.
+
+specialize() takes a compiled program and the defines that will be the same for every
+render (eg. '@ENVIRON=prod') and returns a residual program in which:
+
+  - reads of the fixed symbols are replaced by their values,
+  - #if/#ifdef/#ifndef conditions that only depend on fixed symbols are resolved and the
+    dead branches are removed,
+  - basename(), dirname(), interpolate() and comparisons of constants are evaluated,
+  - fixed symbols are interpolated into the text ahead of time.
+
+The residual program starts by defining the fixed symbols, so it is run with only the
+remaining #template arguments.  Any other defines that will be passed at run time must
+be named in 'runtime_defines':
+
+    prog = specialize(Fpos("foo.py.template"), { "@ENVIRON": "prod" })
+    vm = run_program(prog, { "__FILE__": "foo.py.template" }, args)
+
+A fixed symbol is only treated as known if the template never assigns it (#define,
+#template or #for) and doesn't #include other templates, which could redefine it.
+
+Text is only pre-interpolated where the result is the same as interpolating at run
+time, ie. where the names of the fixed and remaining symbols don't overlap and the
+fixed values don't contain the names of other symbols.  The one thing that can't be
+checked ahead of time is the values of the remaining arguments: they are assumed not
+to contain the names of fixed symbols.
+"""
+import operator
+import os
+from .template_instr import Instruction, is_constant
+
+# EVAL2 operators, applied as 'top <op> second'
+COMPARE = {
+    '==': operator.eq,
+    '<=': operator.le,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '>': operator.gt,
+    '!=': operator.ne
+}
+
+
+def dynamic_symbols(prog) -> set:
+    """- Returns the symbols that are assigned while a program runs"""
+    names = { '__FILE__' }
+    for instr in prog:
+        if instr.opcode == 'SET':
+            names.add(instr.arg1)
+        elif instr.opcode == 'ARG':
+            names.add(instr.arg2)
+        elif instr.opcode == 'NEXT':
+            names.update(instr.arg2)
+    return names
+
+
+class Specializer:
+    def __init__(self, fixed_env : dict, dynamic : set, closed : bool = True):
+        """
+        fixed_env :Dict[str, Any]: The fixed defines
+        dynamic :Set[str]: Symbols that may be assigned at run time
+        closed :bool: False if symbols not listed in 'dynamic' may also be assigned at run time
+        """
+        self.env = fixed_env
+        self.dynamic = dynamic
+        self.closed = closed
+        # the order in which the VM interpolates the known symbols
+        self.order = sorted(fixed_env, key=len, reverse=True)
+        # values such as generators can only be used once, so they are never folded
+        self.known = { k for k in fixed_env if k not in dynamic and is_constant(fixed_env[k]) }
+        self.skip = frozenset(self.known)
+
+    def entangled(self, k : str) -> bool:
+        """- Returns True if interpolating the known symbol 'k' early could change the result"""
+        val = str(self.env[k])
+        for d in self.dynamic:
+            if d in k or k in d or d in val:
+                return True
+        return False
+
+    def interpolate(self, text : str):
+        """- Interpolates the known symbols into 'text' in the same order as the VM.
+
+        Returns (text, complete) where complete is True if no other symbol can change the
+        text at run time, or (None, False) if the text can't be interpolated early.
+        """
+        for v in self.order:
+            if v in self.known and v in text:
+                if self.entangled(v):
+                    return None, False
+                text = text.replace(v, str(self.env[v]))
+        complete = self.closed and not any(d in text for d in self.dynamic)
+        return text, complete
+
+    def fold(self, prog) -> list:
+        """- Constant folds a program, returning the new instruction list"""
+        out = []
+        for instr in prog:
+            op = instr.opcode
+            top = out[-1] if out and out[-1].opcode == 'CONST' else None
+            if op == 'GET' and instr.arg1 in self.known:
+                instr = Instruction.CONST(self.env[instr.arg1])
+            elif op == 'EMIT' and instr.arg2 is None:
+                text, complete = self.interpolate(instr.arg1)
+                if complete:
+                    instr = Instruction.WRITE(text)
+                elif text is not None and text != instr.arg1:
+                    instr = Instruction.EMIT(text, self.skip)
+            elif op == 'EVAL1' and top is not None:
+                if instr.arg1 == '!':
+                    out[-1] = Instruction.CONST(not top.arg1)
+                    continue
+                if instr.arg1 == 'defined' and top.arg1 in self.known:
+                    out[-1] = Instruction.CONST(True)
+                    continue
+            elif op == 'EVAL2' and top is not None and len(out) > 1 and out[-2].opcode == 'CONST':
+                try:
+                    v = COMPARE[instr.arg1](top.arg1, out[-2].arg1)
+                except (KeyError, TypeError):
+                    pass
+                else:
+                    del out[-1]
+                    out[-1] = Instruction.CONST(v)
+                    continue
+            elif op == 'XCALL' and top is not None:
+                value = top.arg1
+                func = instr.arg1
+                if func == 'basename' and type(value) is str:
+                    out[-1] = Instruction.CONST(os.path.basename(value))
+                    continue
+                if func == 'dirname' and type(value) is str:
+                    out[-1] = Instruction.CONST(os.path.dirname(value))
+                    continue
+                if func == 'interpolate' and type(value) is str:
+                    text, complete = self.interpolate(value)
+                    if complete:
+                        out[-1] = Instruction.CONST(text)
+                        continue
+            elif (op == 'JMPIF' or op == 'JMPIFNOT') and top is not None:
+                del out[-1]
+                if bool(top.arg1) == (op == 'JMPIF'):
+                    out.append(Instruction.JMP(instr.arg1))
+                continue
+            out.append(instr)
+        return out
+
+
+def eliminate_dead_code(prog) -> list:
+    """- Removes instructions that can't be reached from the start of the program, and
+    labels that are no longer jumped to"""
+    labels = { instr.arg1: pc for pc, instr in enumerate(prog) if instr.opcode == 'LABEL' }
+    reachable = [ False ] * len(prog)
+    pending = [ 0 ]
+    while pending:
+        pc = pending.pop()
+        while pc < len(prog) and not reachable[pc]:
+            reachable[pc] = True
+            instr = prog[pc]
+            if instr.opcode == 'JMP':
+                pc = labels[instr.arg1]
+                continue
+            if instr.opcode in ('JMPIF', 'JMPIFNOT', 'NEXT'):
+                pending.append(labels[instr.arg1])
+            elif instr.opcode == 'CACHED':
+                pending.append(labels[instr.arg2])
+            elif instr.opcode == 'HALT':
+                break
+            pc += 1
+    live = [ instr for pc, instr in enumerate(prog) if reachable[pc] ]
+    # a jump to the very next instruction does nothing
+    live = [ instr for pc, instr in enumerate(live)
+             if not (instr.opcode == 'JMP' and pc+1 < len(live)
+                     and live[pc+1].opcode == 'LABEL' and live[pc+1].arg1 == instr.arg1) ]
+    targets = { instr.arg1 for instr in live if instr.opcode in ('JMP', 'JMPIF', 'JMPIFNOT', 'NEXT') }
+    targets.update(instr.arg2 for instr in live if instr.opcode == 'CACHED')
+    return [ instr for instr in live if instr.opcode != 'LABEL' or instr.arg1 in targets ]
+
+
+def specialize(template, fixed_env : dict, runtime_defines=()) -> list:
+    """- Returns a residual program for 'template' with the symbols in 'fixed_env' resolved
+    Args:
+        template :Union[str, Fpos, List[Instruction]]: A template path, source or compiled program
+        fixed_env :Dict[str, Any]: The defines that are the same for every render
+        runtime_defines :List[str]: Names of other defines that will be passed when the program is run
+    """
+    if type(template) is list:
+        prog = template
+    else:
+        from .template_parser import compile
+        from .fpos import Fpos
+        fp = template if isinstance(template, Fpos) else Fpos(template)
+        prog = compile(fp)
+
+    fixed_env = { k: v for k, v in fixed_env.items() if k != '__FILE__' }
+    dynamic = dynamic_symbols(prog) | set(runtime_defines)
+    closed = True
+    if any(instr.opcode == 'INCLUDE' for instr in prog):
+        # an included template can define any symbol, so only constants are folded
+        dynamic = dynamic | set(fixed_env)
+        closed = False
+    residual = eliminate_dead_code(Specializer(fixed_env, dynamic, closed).fold(prog))
+
+    prologue = []
+    for k, v in fixed_env.items():
+        prologue += [ Instruction.CONST(v), Instruction.SET(k) ]
+    return prologue + residual
@@ -1,6 +1,47 @@
 from lark.lexer import Lexer, Token
 import re
-TRACE=False
+
+# Directive lines that open, switch or close a conditional block
+CONDITIONAL = re.compile(r"^#[ ]*(ifdef|ifndef|if|else|endif)\b")
+# An #ifdef or #ifndef of a single symbol
+IFDEF_SYMBOL = re.compile(r"^#[ ]*(?:ifdef|ifndef)[ \t]+([@A-Za-z_][@A-Za-z0-9_]*)[ \t]*\r?\n?$")
+# Directives that can define symbols while the template runs
+ASSIGNMENT = re.compile(r"^#[ ]*(?:define|template|for)\b(.*)")
+INCLUDE = re.compile(r"^#[ ]*include\b")
+SYMBOL = re.compile(r"[@A-Za-z_][@A-Za-z0-9_]*")
+
+
+def fixed_symbols(lines, defines) -> dict:
+    """- Returns { symbol: defined } for the #ifdef/#ifndef symbols whose definition can't
+    change while the template runs.
+
+    Symbols in 'defines' stay defined, as the VM never removes a variable.  Other symbols
+    are known to be undefined if the template can't assign them, ie. they don't appear on
+    a #define, #template or #for line and the template doesn't #include anything.
+    """
+    fixed = {}
+    assigned = set()
+    tested = set()
+    closed = True
+    for line in lines:
+        if line[:1] != '#':
+            continue
+        m = IFDEF_SYMBOL.match(line)
+        if m:
+            tested.add(m.group(1))
+            continue
+        m = ASSIGNMENT.match(line)
+        if m:
+            assigned.update(SYMBOL.findall(m.group(1)))
+        elif INCLUDE.match(line):
+            closed = False
+    for sym in tested:
+        if sym in defines:
+            fixed[sym] = True
+        elif closed and sym not in assigned:
+            fixed[sym] = False
+    return fixed
+
 
 class PreprocessorLexer(Lexer):
     """Tokenizes an input file returning TEXT tokens for unrecognized text, and preprocessor
@@ -45,31 +86,42 @@ class PreprocessorLexer(Lexer):
         ("EOL", r"\n"),
     ]
 
-    def __init__(self, lexer_conf=None):
-        """- Construct PreprocessorLexer"""
-        pass
+    def __init__(self, lexer_conf=None, trace=None, defines=None):
+        """- Construct PreprocessorLexer
+        Args:
+          trace :TraceHook: Optional hook that receives a 'token' event for each token
+          defines :Dict[str, Any]: The initial environment.  When given, #ifdef and #ifndef
+            blocks whose outcome is fixed by it (see fixed_symbols) are resolved here: the
+            dead branch is skipped line by line without being tokenized, and the directives
+            of the resolved block are dropped
+        """
+        self.trace = trace
+        self.defines = defines
+        self.fixed = None
+        self.open = []          # resolved blocks being lexed: [ 'then' or 'else', nested #if depth ]
 
     def next_token(self, fp):
         """- Fetch the next token"""
-        global TRACE
         if fp.eof:
-            if TRACE: print("+EOF+")
             return None
         if fp.cpos == 0:
+            ltext = fp.v
+            if type(ltext) is bytes:
+                return self.bytes_token(fp, ltext)
             for r,pat in self.rules0:
-                m = re.match(pat, fp.v)
+                m = re.match(pat, ltext)
                 #print("next_token:", m, pat, fp.v)
                 if m:
                     token = Token(r, m.group(0), 0, fp.rpos, fp.cpos)
                     fp.skip(len(token.value))
-                    if TRACE: print(f"+TOKEN+ {token.type:16s} {token.value}")
                     return token
-            ltext = fp.v
+            if fp.encoding is not None:
+                # a '#' line of a bytes mode template that isn't a directive
+                return self.bytes_token(fp, ltext.encode(fp.encoding, "surrogateescape"))
             if not ltext.endswith('\n'):
                 ltext += '\n'
             token = Token("TEXT", ltext, 0, fp.rpos, fp.cpos)
             fp.skip(len(fp.v))
-            if TRACE: print(f"+TOKEN+ {token.type:16s} {token.value}")
             return token
         else:
             for r,pat in self.rules1:
@@ -77,19 +129,107 @@ class PreprocessorLexer(Lexer):
                 if m:
                     token = Token(r, m.group(0), 0, fp.rpos, fp.cpos)
                     fp.skip(len(token.value))
-                    if TRACE: print(f"+TOKEN+ {token.type:16s} {token.value}")
                     return token
             raise TypeError(f"Invalid token at {fp.v}")
 
+    @staticmethod
+    def bytes_token(fp, ltext : bytes):
+        """- Returns a TEXT token for a line of a bytes mode template (see Fpos).  The token's
+        value is the line as bytes"""
+        if not ltext.endswith(b'\n'):
+            ltext += b'\n'
+        token = Token("TEXT", "", 0, fp.rpos, fp.cpos)
+        token.value = ltext
+        PreprocessorLexer.next_line(fp)
+        return token
+
+    @staticmethod
+    def next_line(fp):
+        fp.cpos = 0
+        fp.rpos += 1
+
+    def skip_branch(self, fp, start : int) -> str:
+        """- Skips the lines of a dead branch, returning the 'else' or 'endif' that ends it"""
+        depth = 0
+        lines = fp.lines
+        while fp.rpos < len(lines):
+            line = lines[fp.rpos]
+            fp.rpos += 1
+            if line[:1] == '#':
+                m = CONDITIONAL.match(line)
+                if m:
+                    word = m.group(1)
+                    if word == 'endif':
+                        if depth == 0:
+                            return word
+                        depth -= 1
+                    elif word == 'else':
+                        if depth == 0:
+                            return word
+                    else:
+                        depth += 1
+        raise TypeError(f"Missing #endif for the conditional at line {start+1}")
+
+    def conditional(self, fp) -> bool:
+        """- Resolves the conditional directive on the current line if its outcome is fixed.
+        Returns True if the line was consumed"""
+        line = fp.lines[fp.rpos]
+        if line[:1] != '#':
+            return False
+        m = CONDITIONAL.match(line)
+        if m is None:
+            return False
+        word = m.group(1)
+        if word == 'if' or word == 'ifdef' or word == 'ifndef':
+            m = IFDEF_SYMBOL.match(line) if word != 'if' else None
+            value = self.fixed.get(m.group(1)) if m else None
+            if value is None:
+                if self.open:
+                    self.open[-1][1] += 1
+                return False
+            start = fp.rpos
+            self.next_line(fp)
+            if value != (word == 'ifndef'):
+                self.open.append([ 'then', 0 ])
+            elif self.skip_branch(fp, start) == 'else':
+                self.open.append([ 'else', 0 ])
+            return True
+        if not self.open:
+            return False
+        top = self.open[-1]
+        if top[1] > 0:
+            # the else or endif of a conditional that is left to the VM
+            if word == 'endif':
+                top[1] -= 1
+            return False
+        start = fp.rpos
+        self.next_line(fp)
+        self.open.pop()
+        if word == 'else':
+            if top[0] != 'then' or self.skip_branch(fp, start) != 'endif':
+                raise TypeError(f"Unexpected #else at line {start+1}")
+        return True
+
     def lex(self, fp):
         """- Generates tokens until EOF.  Whitespace tokens are skipped.
         Args:
           fp :Fpos: The input stream to read from
         """
+        trace = self.trace
+        resolve = False
+        if self.defines is not None:
+            self.fixed = fixed_symbols(fp.lines, self.defines)
+            resolve = len(self.fixed) > 0
         while True:
+            if resolve and fp.cpos == 0 and not fp.eof and self.conditional(fp):
+                continue
             tok = self.next_token(fp)
             if tok is None:
                 break
             #print(f"{tok.type:16s} {tok.value}")
             if not (tok.type == 'SPACE' or tok.type == 'EOL'):
-                yield tok
\ No newline at end of file
+                if trace is not None:
+                    trace.token(tok)
+                yield tok
+        if self.open:
+            raise TypeError("Missing #endif at end of file")
\ No newline at end of file
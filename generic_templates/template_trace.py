@@ -0,0 +1,114 @@
+import sys
+from collections import deque
+
+
+class TraceHook:
+    """Receives structured trace events from the preprocessor compiler and VM.
+
+    A hook is registered per compile (see template_parser.compile) or per VM (see
+    PreprocessorVM).  When no hook is registered the untraced code paths are selected
+    up front, so tracing costs nothing unless it is turned on.  All of the event
+    methods are no-ops; subclasses override the events they are interested in.
+    """
+    def token(self, token):
+        """- Called by the lexer for each token passed to the parser"""
+        pass
+
+    def reduce(self, rule, children):
+        """- Called by the code generator for each grammar rule that is reduced"""
+        pass
+
+    def instruction(self, vm, pc, instr):
+        """- Called by the VM before each instruction is executed"""
+        pass
+
+    def include_enter(self, vm, path, argv):
+        """- Called by the VM before an included template is processed"""
+        pass
+
+    def include_exit(self, vm, path):
+        """- Called by the VM after an included template has been processed"""
+        pass
+
+    def output(self, vm, text):
+        """- Called by the VM for each string written to the output"""
+        pass
+
+    def error(self, vm, pc, exc):
+        """- Called by the VM when execute() is about to raise an exception"""
+        pass
+
+
+class PrintTrace(TraceHook):
+    """Writes every trace event to a file as it happens (stderr by default)"""
+    def __init__(self, file=None):
+        self.file = file or sys.stderr
+
+    def token(self, token):
+        print(f"+TOKEN+ {token.type:16s} {token.value}", file=self.file)
+
+    def reduce(self, rule, children):
+        print(f"reduce {rule} {children}", file=self.file)
+
+    def instruction(self, vm, pc, instr):
+        print(f"{pc:03d} {instr}", file=self.file)
+        print("  v", vm.vars, file=self.file)
+        print("  s", vm.stack, file=self.file)
+
+    def include_enter(self, vm, path, argv):
+        print(f"+INCLUDE+ {path} {argv}", file=self.file)
+
+    def include_exit(self, vm, path):
+        print(f"-INCLUDE- {path}", file=self.file)
+
+    def output(self, vm, text):
+        print(f"+OUTPUT+ {text!r}", file=self.file)
+
+
+class RingBufferTrace(TraceHook):
+    """Records the most recent trace events in a bounded ring buffer.
+
+    Nothing is written while the template runs.  If execute() raises, the
+    recorded events leading up to the failure are dumped for post-mortem analysis.
+
+    Example:
+        trace = RingBufferTrace(1000)
+        fill_template("foo.py.template", env, trace=trace)
+    """
+    def __init__(self, maxlen : int = 256, file=None, dump_on_error : bool = True):
+        self.events = deque(maxlen=maxlen)
+        self.file = file
+        self.dump_on_error = dump_on_error
+
+    def token(self, token):
+        self.events.append(("token", token.type, token.value, token.line))
+
+    def reduce(self, rule, children):
+        self.events.append(("reduce", rule))
+
+    def instruction(self, vm, pc, instr):
+        self.events.append(("instruction", pc, instr))
+
+    def include_enter(self, vm, path, argv):
+        self.events.append(("include_enter", path, argv))
+
+    def include_exit(self, vm, path):
+        self.events.append(("include_exit", path))
+
+    def output(self, vm, text):
+        self.events.append(("output", text))
+
+    def error(self, vm, pc, exc):
+        self.events.append(("error", pc, repr(exc)))
+        if self.dump_on_error:
+            self.dump()
+
+    def clear(self):
+        self.events.clear()
+
+    def dump(self, file=None):
+        """- Writes the recorded events, oldest first"""
+        file = file or self.file or sys.stderr
+        print(f"--- last {len(self.events)} trace events ---", file=file)
+        for event in self.events:
+            print(" ".join(str(x) for x in event), file=file)
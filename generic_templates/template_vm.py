@@ -1,45 +1,94 @@
-import sys
 import os
-from copy import copy
+import itertools
 from .arglist import Arglist
 
 from .template_instr import Instruction
+from .error_report import ErrorReport
+from .template_link import link, link_registers, register, SlotVars, UNDEFINED
 
 
-TRACE=False
+def indices(values):
+    """ Returns the indices of 'values' without building a list.  Iterables without a length
+    (eg. generators) get an unbounded count, which a #for loop zips with the iterable itself.
+    """
+    try:
+        return range(len(values))
+    except TypeError:
+        return itertools.count()
 
 
 class PreprocessorVM:
-    def __init__(self, env=None, argv:Arglist=None):
-        """ The preprocessor VM is a simple stack machine with no registers.  Instead all instructions
-        run either the top of the stack or using one of the two arguments present in the instruction
-        itself.  There is also indexed memory for storing and retrieving variables (self.vars).
+    def __init__(self, env=None, argv:Arglist=None, trace=None, metrics=None, cache=None, parallel=None, linked=False, loader=None,
+                 limits=None, encoding=None, errors=None):
+        """ The preprocessor VM is a stack machine.  Instructions operate on the top of the data stack
+        (self.stack) or on the one or two operands held in the instruction itself, and there are 64
+        registers (self.r, numbered R0..R63) for values the compiler caches between instructions.
+        Variables are kept in self.vars: 'env' itself, or in a linked VM ('linked', see template_link)
+        a SlotVars over a copy of 'env' whose variables the loaded programs address by slot number
+        rather than by name.  Jumps go through a table of labels (self.labels) that is rebuilt by
+        prescanning the program for 'LABEL' instructions whenever a program is loaded.
 
-        There is also a jump table (self.labels) used to move the PC to the correct instruction when
-        branching.  Labels are initialized by prescanning the code for 'LABEL' instructions.
+        The optional collaborators are chosen once, here, so a VM pays nothing for those it isn't given:
+          trace :TraceHook: Selects the traced instruction step (see template_trace)
+          metrics :TemplateMetrics: Counts the instructions executed (see template_metrics)
+          cache :TemplateCache: Compiles #include files (see template_cache)
+          loader :FileLoader: Finds and reads #include files (see template_loader)
+          parallel :ParallelLoops: Renders large #for loops that the compiler found to be independent on
+            a process pool, unless the VM is traced or has limits (see template_parallel)
+          limits :TemplateLimits: Checks the instructions, time, output, #include depth and stack depth of
+            the run every few instructions, against a budget shared with #include files (see template_limits)
+          encoding :str: Runs bytes mode programs (see fpos.Fpos), whose text is bytes, encoding variable names
+            and values with 'encoding' as they are interpolated
+          errors :ErrorReport: Records the errors of the run with the template line they occurred on, and
+            the errors of parallel loop workers (see error_report)
+
+        #include files run in VMs of their own, created with the same options.
         """
         if env is None:
             env = {}
         self.stack = []
-        self.vars = env
+        self.linked = linked
+        if linked:
+            self.vars = SlotVars(env)
+            self.slots = self.vars.slots
+            self.interpolate = self.vars.interpolate
+        else:
+            self.vars = env
         self.progmem = [ Instruction.LABEL('main') ]
+        self.source = self.progmem if not linked else list(self.progmem)   # progmem before linking
         self.pc = 0
         self.seg_count = 0          # generates unique labels
         self.output = []
+        self.reports = []           # values printed by #report
+        self.includes = []          # paths of every template included while running
         self.outfile = None
         self.running = False
         self.labels = {}
-        self.r = { f'R{x}': None for x in range(64) }
+        self.loops = []             # iterators of the active #for loops
+        self.r = [ None ] * 64        # registers R0..R63
         self.argv = argv or Arglist()
+        self.trace = trace
+        self.metrics = metrics
+        self.cache = cache
+        self.parallel = parallel if trace is None and limits is None else None
+        self.loader = loader
+        self.budget = None if limits is None else limits.budget()
+        self.included_bytes = 0     # output of #include files, already counted by their VMs
+        self.encoding = encoding
+        self.errors = errors
+        if encoding is not None:
+            self.interpolate_text = self.interpolate
+            self.interpolate = self.interpolate_bytes
+        self.icount = 0             # instructions executed, counted only when collecting metrics
+        if trace is not None:
+            self.execute1 = self.trace_execute1
         self.scan_labels()
 
     def get_r(self, reg):
-        assert(reg in self.r)
-        return self.r[reg]
+        return self.r[register(reg)]
 
     def set_r(self, reg, value):
-        assert(reg in self.r)
-        self.r[reg] = value
+        self.r[register(reg)] = value
 
     def scan_labels(self):
         """ Scans program memory for LABEL statements and adds them to the index """
@@ -48,11 +97,12 @@ class PreprocessorVM:
                 self.labels[i.arg1] = pc
 
     def prog(self, instr):
-        """ Appends a new program to progmem and rescans the labels """
+        """ Appends a new program to progmem, linking it, and rescans the labels """
+        instr = link_registers(instr)
+        if self.linked:
+            self.source.extend(instr)
+            instr = link(instr, self.vars)
         self.progmem.extend(instr)
-        if TRACE:
-            from .template_instr import print_program
-            print_program(self.progmem)
         self.scan_labels()
 
     def gensym(self):
@@ -66,21 +116,90 @@ class PreprocessorVM:
 
     def pop(self):
         """ Data stack pop, exception on underflow """
-        v = self.stack[-1]
-        del self.stack[-1]
-        return v
+        return self.stack.pop()
 
-    def interpolate(self, body:str):
+    def interpolate(self, body:str, skip=None):
         """Interpolates preprocessor variables into the string given, starting with the longest strings to allow for the possibility
         of common prefixes in variable names.
 
         body :str: Body of text within which to interpolate variables
+        skip :Set[str]: Variables that have already been interpolated into the body (see template_specialize)
+        """
+        names = sorted(self.vars, key=len, reverse=True)
+        if skip:
+            names = [ v for v in names if v not in skip ]
+        for v in names:
+            # only convert values that are used, loop lists can be very large
+            if v in body:
+                body = body.replace(v, str(self.vars[v]))
+        return body
+
+    def interpolate_bytes(self, body, skip=None):
+        """Interpolates preprocessor variables into the text of a bytes mode template.  Strings, eg.
+        the argument of interpolate(), are interpolated as usual.
+
+        body :Union[bytes, str]: Body of text within which to interpolate variables
+        skip :Set[str]: Variables that have already been interpolated into the body (see template_specialize)
         """
-        for v in sorted(self.vars, key=len, reverse=True):
-            val = str(self.vars[v])
-            body = body.replace(v, val)
+        if type(body) is not bytes:
+            return self.interpolate_text(body, skip)
+        encoding = self.encoding
+        names = sorted(self.vars, key=len, reverse=True)
+        if skip:
+            names = [ v for v in names if v not in skip ]
+        for v in names:
+            key = v.encode(encoding, "surrogateescape")
+            if key in body:
+                value = self.vars[v]
+                if type(value) is not bytes:
+                    value = str(value).encode(encoding, "surrogateescape")
+                body = body.replace(key, value)
         return body
-    
+
+    def source_line(self, pc):
+        """- Returns the template line of the instruction at 'pc', or of the closest instruction before
+        it whose line is known, or None"""
+        progmem = self.progmem
+        for x in range(min(pc, len(progmem)-1), -1, -1):
+            if progmem[x].line is not None:
+                return progmem[x].line
+        return None
+
+    def report_error(self, e):
+        """- Records the exception 'e' raised by this VM in its ErrorReport, with the template line of
+        the instruction that raised it, and marks it as reported"""
+        pc = getattr(e, "pc", None)
+        if pc is not None:
+            # a LimitExceeded names the instruction that was charged
+            self.error_report().error(str(e), getattr(e, "line", None))
+        else:
+            # execute1 has already moved the pc past the instruction that failed
+            self.error_report().error(f"{e} (pc {self.pc - 1})", self.source_line(self.pc - 1))
+        try:
+            e.reported = True
+        except AttributeError:
+            pass
+
+    def error_report(self):
+        """- Returns the ErrorReport of the run, creating one if none was given"""
+        if self.errors is None:
+            self.errors = ErrorReport()
+        return self.errors
+
+    def include(self, template_path, env, argv):
+        """ Runs an included template in a new VM and returns the VM """
+        from .template import preprocess, run_program, read_template
+        if self.cache is not None:
+            prog = self.cache.get(template_path, trace=self.trace, metrics=self.metrics, loader=self.loader,
+                                  encoding=self.encoding)
+            return run_program(prog, env, argv, trace=self.trace, metrics=self.metrics, cache=self.cache,
+                               parallel=self.parallel, linked=self.linked, loader=self.loader, limits=self.budget,
+                               encoding=self.encoding, errors=self.errors)
+        fp = read_template(template_path, self.metrics, self.loader, self.encoding)
+        return preprocess(fp, env, argv, trace=self.trace, metrics=self.metrics, parallel=self.parallel,
+                          linked=self.linked, loader=self.loader, limits=self.budget, encoding=self.encoding,
+                          errors=self.errors)
+
     def execute1(self):
         """ Executes a single instruction in the Preprocessor VM
         """
@@ -88,19 +207,56 @@ class PreprocessorVM:
 
         pc = self.pc
         instr = self.progmem[pc]
-        if TRACE:
-            print(f"{pc:03d} {instr}")
-            print("  v", self.vars)
-            print("  s", self.stack)
         opcode = instr.opcode
         arg1 = instr.arg1
         arg2 = instr.arg2
         pc += 1
         self.pc = pc
         if opcode == 'EMIT':
-            self.output.append(self.interpolate(arg1))
+            self.output.append(self.interpolate(arg1, arg2))
+        elif opcode == 'WRITE':
+            self.output.append(arg1)
+        elif opcode == 'NEXT':
+            # NEXT label, symbols: sets the loop variables or exits the loop
+            row = next(self.loops[-1], None)
+            if row is None:
+                del self.loops[-1]
+                self.pc = self.labels[arg1]
+            else:
+                for var, val in zip(arg2, row):
+                    self.vars[var] = val
+        elif opcode == 'NEXTS':
+            # NEXTS label, slots: NEXT for a linked VM
+            row = next(self.loops[-1], None)
+            if row is None:
+                del self.loops[-1]
+                self.pc = self.labels[arg1]
+            else:
+                slots = self.slots
+                for s, val in zip(arg2, row):
+                    if slots[s] is UNDEFINED:
+                        self.vars.define(s)
+                    slots[s] = val
+        elif opcode == 'FOREACH':
+            # FOREACH argc, independent: starts a loop over the top argc lists on the stack
+            iterables = self.stack[-arg1:]
+            del self.stack[-arg1:]
+            rows = zip(*iterables)
+            if arg2 and self.parallel is not None:
+                rows = self.parallel.run(self, rows)
+            if rows is not None:
+                self.loops.append(rows)
+        elif opcode == 'CACHED':
+            # CACHED reg, label: pushes a register and skips to label once the register is set
+            value = self.r[arg1]
+            if value is not None:
+                self.push(value)
+                self.pc = self.labels[arg2]
         elif opcode == 'GET':
             self.push(self.vars.get(arg1,''))
+        elif opcode == 'GETS':
+            value = self.slots[arg1]
+            self.stack.append('' if value is UNDEFINED else value)
         elif opcode == 'CONST':
             self.push(arg1)
         elif opcode == 'DUP':
@@ -135,6 +291,9 @@ class PreprocessorVM:
             lbl = arg1
             if cond:
                 self.pc = self.labels[lbl]
+        elif opcode == 'JMPIFNOT':
+            if not self.pop():
+                self.pc = self.labels[arg1]
         elif opcode == 'JMP':
             lbl = arg1
             self.pc = self.labels[lbl]
@@ -142,6 +301,10 @@ class PreprocessorVM:
             var = arg1
             val = self.pop()
             self.vars[var] = val
+        elif opcode == 'SETS':
+            if self.slots[arg1] is UNDEFINED:
+                self.vars.define(arg1)
+            self.slots[arg1] = self.stack.pop()
         elif opcode == 'ARG':
             # ARG number, var
             number = arg1
@@ -150,6 +313,12 @@ class PreprocessorVM:
             assert(type(var) is str)
             assert(number < len(self.argv)), "Template is asking for more arguments than were given"
             self.vars[var] = self.argv[number]
+        elif opcode == 'ARGS':
+            # ARGS number, slot
+            assert(arg1 < len(self.argv)), "Template is asking for more arguments than were given"
+            if self.slots[arg2] is UNDEFINED:
+                self.vars.define(arg2)
+            self.slots[arg2] = self.argv[arg1]
         elif opcode == 'OUTFILE':
             # OUTFILE [arglist]
             assert('__FILE__' in self.vars)
@@ -158,8 +327,6 @@ class PreprocessorVM:
             assert(not filename.startswith("/"))
             self.outfile = os.path.join(basedir, filename)
         elif opcode == 'INCLUDE':
-            from .template import preprocess, Fpos
-
             # load the template argument list
             argc = arg1
             argv = []
@@ -168,22 +335,42 @@ class PreprocessorVM:
             argv = list(reversed(argv))
 
             # get the filename of the template to include
-            template_path = self.get_r("R0")
-            fp = Fpos(template_path)
+            template_path = self.r[0]
+            if self.loader is not None:
+                template_path = self.loader.find(template_path, self.vars.get('__FILE__')) or template_path
 
             # run the preprocessor on the included template
-            newvars = copy(self.vars)
+            newvars = dict(self.vars)
             newvars['__FILE__'] = template_path
-            vm = preprocess(fp, newvars, argv)
+            budget = self.budget
+            if budget is not None:
+                budget.enter(self)
+            try:
+                if self.metrics is None:
+                    vm = self.include(template_path, newvars, argv)
+                else:
+                    with self.metrics.stage("include") as stage:
+                        vm = self.include(template_path, newvars, argv)
+                        stage.bytes_out += sum(len(x) for x in vm.output)
+            finally:
+                if budget is not None:
+                    budget.exit()
+            if budget is not None:
+                self.included_bytes += sum(len(x) for x in vm.output)
 
             # add the output of the preprocessor to the current context
             for k,v in vm.vars.items():
                 if k != '__FILE__':
                     self.vars[k] = v
             self.output.extend(vm.output)
+            self.reports.extend(vm.reports)
+            self.includes.append(template_path)
+            self.includes.extend(vm.includes)
         elif opcode == 'PRINT':
             # PRINT
-            print(self.pop())
+            value = self.pop()
+            self.reports.append(str(value))
+            print(value)
         elif opcode == 'HALT':
             self.running = False
         elif opcode == 'XCALL':
@@ -197,39 +384,96 @@ class PreprocessorVM:
             elif arg1 == 'len':
                 self.push(len(self.pop()))
             elif arg1 == 'indices':
-                self.push(list(range(len(self.pop()))))
+                self.push(indices(self.pop()))
         elif opcode == 'EXISTS':
             sym = arg1
             self.push(sym in self.vars)
         elif opcode == 'LABEL':
             pass #NOSONAR
         elif opcode == 'FATAL':
-            msg = arg1
-            print(msg, file=sys.stderr)
-            sys.exit(1)
+            errors = self.error_report()
+            errors.error(arg1, self.source_line(pc - 1))
+            errors.exit_on_error()
         elif opcode == 'PUSH':
-            reg = arg1
-            self.push(self.get_r(reg))
+            self.push(self.r[arg1])
         elif opcode == 'POP':
-            reg = arg1
-            self.set_r(reg, self.pop())
+            self.r[arg1] = self.pop()
         elif opcode == 'ADD':
-            reg = arg1
-            const = arg2
-            self.set_r(reg, self.get_r(reg)+const)
+            self.r[arg1] += arg2
         elif opcode == 'GETIDX':
-            arrreg = arg1
-            idxreg = arg2
-            self.push(self.get_r(arrreg)[self.get_r(idxreg)])
+            self.push(self.r[arg1][self.r[arg2]])
+
+    def trace_execute1(self):
+        """ Executes a single instruction in the Preprocessor VM, reporting it to the trace hook
+        """
+        if not self.running: return
+
+        trace = self.trace
+        instr = self.progmem[self.pc]
+        trace.instruction(self, self.pc, instr)
+        opcode = instr.opcode
+        if opcode == 'INCLUDE':
+            template_path = self.r[0]
+            trace.include_enter(self, template_path, self.stack[len(self.stack)-instr.arg1:])
+            PreprocessorVM.execute1(self)
+            trace.include_exit(self, template_path)
+        else:
+            PreprocessorVM.execute1(self)
+            if opcode == 'EMIT' or opcode == 'WRITE':
+                trace.output(self, self.output[-1])
+
+    def execute_limited(self):
+        """ Runs the program in blocks of instructions, checking the budget between blocks
+        """
+        budget = self.budget
+        step = budget.limits.check_every
+        execute1 = self.execute1
+        output = self.output
+        counted = len(output)
+        pc = self.pc
+        while self.running:
+            n = 0
+            try:
+                while self.running and n < step:
+                    pc = self.pc        # the instruction that is charged for a limit found after it
+                    execute1()
+                    n += 1
+            finally:
+                budget.instructions += n
+                if self.metrics is not None:
+                    self.icount += n
+            size = -self.included_bytes
+            for x in range(counted, len(output)):
+                size += len(output[x])
+            counted = len(output)
+            self.included_bytes = 0
+            budget.output_bytes += size
+            budget.check(self, pc)
 
     def execute(self):
         """ Executes the preprocessor program that was built from parsing a template file
         """
         self.pc = self.labels['main']
         self.running = True
-        while (self.running):
-            try:
-                self.execute1()
-            except Exception as e:
-                print(self.pc, str(e))
-                raise e
\ No newline at end of file
+        execute1 = self.execute1
+        try:
+            if self.budget is not None:
+                self.execute_limited()
+            elif self.metrics is None:
+                while (self.running):
+                    execute1()
+            else:
+                icount = 0
+                try:
+                    while (self.running):
+                        execute1()
+                        icount += 1
+                finally:
+                    self.icount += icount
+        except Exception as e:
+            # the VMs of enclosing #include files see the exception again, it is only reported here
+            if not getattr(e, "reported", False):
+                self.report_error(e)
+            if self.trace is not None:
+                self.trace.error(self, self.pc, e)
+            raise e
\ No newline at end of file
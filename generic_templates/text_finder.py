@@ -1,5 +1,136 @@
 import os
 import re
+from functools import lru_cache
+
+
+@lru_cache(maxsize=256)
+def compiled(pattern, binary : bool = False, encoding : str = "utf-8"):
+    """- Returns the compiled regular expression for 'pattern', as a bytes pattern if 'binary'"""
+    if isinstance(pattern, re.Pattern):
+        return pattern
+    if binary and isinstance(pattern, str):
+        pattern = pattern.encode(encoding)
+    return re.compile(pattern)
+
+
+class NeedleIndex:
+    """
+    Finds many fixed strings at once, in a single pass over the text.
+
+    The needles are built into a trie, and the trie into one regular expression with
+    their common prefixes factored out, eg. "abc", "abd" and "b" become "(?:ab[cd]|b)".
+    Scanning with it runs in the regular expression engine, and each position it stops at
+    is expanded to every needle that starts there by walking the trie, so overlapping
+    needles are all reported.
+
+    Example:
+       index = NeedleIndex([ "he", "she", "hers" ])
+       list(index.finditer("ushers"))   # [(1, 'she'), (2, 'he'), (2, 'hers')]
+    """
+    END = ""        # marks the end of a needle in the trie
+
+    def __init__(self, needles, binary : bool = False, encoding : str = "utf-8"):
+        """
+        needles :Iterable[Union[str, bytes]]: The strings to search for, empty strings are ignored
+        binary :bool: Build the index for bytes (or mmap) texts, encoding str needles with 'encoding'
+        """
+        self.trie = {}
+        self.needles = []
+        for needle in needles:
+            if binary and isinstance(needle, str):
+                needle = needle.encode(encoding)
+            if not needle:
+                continue
+            node = self.trie
+            for ch in needle:
+                node = node.setdefault(ch, {})
+            if self.END not in node:
+                node[self.END] = needle
+                self.needles.append(needle)
+        if not self.needles:
+            raise ValueError("no needles to search for")
+        self.binary = binary
+        expr = self.expression(self.trie)
+        if binary:
+            expr = expr.encode("latin-1")
+        self.first = re.compile(expr)                 # finds the leftmost needle
+        self.pattern = re.compile((b"(?=%s)" if binary else "(?=%s)") % expr)   # stops wherever a needle starts
+
+    def expression(self, node) -> str:
+        """- Returns the regular expression matching the needles below a trie node"""
+        chars = []          # needles that end one character below the node
+        alternatives = []
+        for ch, child in node.items():
+            if ch == self.END:
+                continue
+            prefix = self.escape(ch)
+            if list(child) == [ self.END ]:
+                chars.append(prefix)
+                continue
+            while len(child) == 1 and self.END not in child:
+                # collapse chains of single characters
+                ch, child = next(iter(child.items()))
+                prefix += self.escape(ch)
+            if list(child) == [ self.END ]:
+                alternatives.append(prefix)
+            else:
+                alternatives.append(prefix + self.expression(child))
+        if chars:
+            alternatives.append(chars[0] if len(chars) == 1 else f"[{''.join(chars)}]")
+        expr = alternatives[0] if len(alternatives) == 1 else f"(?:{'|'.join(alternatives)})"
+        if self.END in node:
+            expr = f"(?:{expr})?"
+        return expr
+
+    @staticmethod
+    def escape(ch) -> str:
+        """- Escapes a trie key, bytes needles have int keys that are kept as latin-1 characters"""
+        return re.escape(chr(ch) if type(ch) is int else ch)
+
+    def at(self, s, pos : int, endpos : int):
+        """- Generates the needles that start at 'pos', shortest first"""
+        node = self.trie
+        i = pos
+        while i < endpos:
+            node = node.get(s[i])
+            if node is None:
+                return
+            i += 1
+            needle = node.get(self.END)
+            if needle is not None:
+                yield needle
+
+    def finditer(self, s, pos : int = 0, endpos : int = None):
+        """- Generates (position, needle) for every occurrence of every needle in s[pos:endpos],
+        ordered by position and then by length"""
+        if endpos is None:
+            endpos = len(s)
+        for match in self.pattern.finditer(s, pos, endpos):
+            start = match.start()
+            for needle in self.at(s, start, endpos):
+                yield start, needle
+
+    def search(self, s, pos : int = 0, endpos : int = None):
+        """- Returns (position, needle) of the first occurrence of any needle, the longest needle
+        when several start at the same position, or None"""
+        if endpos is None:
+            endpos = len(s)
+        match = self.first.search(s, pos, endpos)
+        if match is None:
+            return None
+        *_, needle = self.at(s, match.start(), endpos)
+        return match.start(), needle
+
+    def contains(self, s) -> bool:
+        """- Returns True if any of the needles occurs in s"""
+        return self.first.search(s) is not None
+
+
+@lru_cache(maxsize=64)
+def needle_index(needles : tuple, binary : bool = False, encoding : str = "utf-8") -> NeedleIndex:
+    """- Returns the NeedleIndex for a tuple of needles, building it once"""
+    return NeedleIndex(needles, binary, encoding)
+
 
 class TextFinder:
     """
@@ -11,12 +142,28 @@ class TextFinder:
 
     Mark sets a start position, copy() returns the string between
     the mark and the current cursor position.
+
+    The text can also be bytes, or any bytes-like object such as an mmap of a large
+    file, in which case str needles and patterns are encoded with 'encoding' and copy()
+    returns bytes.  Searches run from the cursor in place, so the text is never copied.
     """
-    def __init__(self, s: str):
+    def __init__(self, s, encoding : str = "utf-8"):
         self.s = s
         self.lpos = 0
         self.pos = 0
-        self.lneedle = ""
+        self.binary = not isinstance(s, str)
+        self.encoding = encoding
+        self.lneedle = b"" if self.binary else ""
+
+    def text(self, needle):
+        """- Returns 'needle' in the type of the text"""
+        if self.binary and isinstance(needle, str):
+            return needle.encode(self.encoding)
+        return needle
+
+    def regex(self, pattern):
+        """- Returns 'pattern' compiled for the text"""
+        return compiled(pattern, self.binary, self.encoding)
     
     def find(self, needle = None):
         """
@@ -24,13 +171,40 @@ class TextFinder:
         given string.   
         """
         if needle is None: needle = self.lneedle
-        npos = self.s.index(needle, self.pos)
+        needle = self.text(needle)
+        npos = self.s.find(needle, self.pos)
         if npos < 0:
             raise ValueError(f"text {needle} not found")
         self.pos = npos
         self.lneedle = needle
         return self
     
+    def findany(self, needles):
+        """
+        Positions the cursor at the first character of the first
+        occurance of any of the given strings.  When several start
+        there the longest is taken, and after() skips past it.
+        """
+        hit = self.needles(needles).search(self.s, self.pos)
+        if hit is None:
+            raise ValueError(f"none of {needles} found")
+        self.pos, self.lneedle = hit
+        return self
+
+    def findall(self, needles):
+        """
+        Returns a list of (position, needle) for every occurance of each
+        of the given strings from the cursor to the end of the text,
+        found in a single pass.  The cursor is not moved.
+        """
+        return list(self.needles(needles).finditer(self.s, self.pos))
+
+    def needles(self, needles) -> NeedleIndex:
+        """- Returns the index of 'needles' for the text"""
+        if isinstance(needles, NeedleIndex):
+            return needles
+        return needle_index(tuple(needles), self.binary, self.encoding)
+
     def findx(self, pattern, limit=None):
         """
         Positions the cursor at the first character of the
@@ -53,7 +227,11 @@ class TextFinder:
         the cursor position is 0)
         """
         if needle is None: needle = self.lneedle
-        self.pos = self.s.rindex(needle, self.lpos, self.pos-1)
+        needle = self.text(needle)
+        npos = self.s.rfind(needle, self.lpos, self.pos-1)
+        if npos < 0:
+            raise ValueError(f"text {needle} not found")
+        self.pos = npos
         self.lneedle = needle
         return self
     
@@ -65,7 +243,8 @@ class TextFinder:
         Raise ValueError if the start of the string doesn't match needle.
         """
         if needle is None: needle = self.lneedle
-        if not self.s[self.pos:].startswith(needle):
+        needle = self.text(needle)
+        if self.s[self.pos:self.pos+len(needle)] != needle:
             raise ValueError(f"string {needle} not found at start of string")
         self.pos += len(self.lneedle)
         self.lneedle = needle
@@ -75,16 +254,18 @@ class TextFinder:
         """
         Skips the cursor past white space including newlines.
         """
-        while self.s[self.pos] in " \n\t": self.pos+=1
+        self.pos = self.regex(r"[ \n\t]*").match(self.s, self.pos).end()
         return self
     
     def rtrim(self):
         """
         Skips the cursor left past white space including newlines
         """
-        self.pos-=1
-        while self.s[self.pos]==' ' or self.s[self.pos]=='\n': self.pos-=1
-        self.pos+=1
+        s = self.s
+        space = self.text(" \n")
+        pos = self.pos
+        while pos > 0 and s[pos-1:pos] in space: pos-=1
+        self.pos = pos
         return self
     
     def skip(self, n:int):
@@ -98,12 +279,10 @@ class TextFinder:
         """
         Returns the location of a regex with search starting from the current cursor position
         """
-        match = re.search(find_regex, self.s[self.pos:])
+        match = self.regex(find_regex).search(self.s, self.pos)
         if match is not None:
-            s,e = match.span()
-            self.lneedle = self.s[self.pos+s:self.pos+e]
-            #print("lneedle <=", self.lneedle)
-            return self.pos + s
+            self.lneedle = match.group()
+            return match.start()
         return -1
     
     def spanx(self, allowed_regex:str):
@@ -111,12 +290,27 @@ class TextFinder:
         Skips past a group of characters starting from the cursor where the group of characters
         is represented by a regular expression
         """
-        match = re.match(allowed_regex, self.s[self.pos:])
+        match = self.regex(allowed_regex).match(self.s, self.pos)
         if match is not None:
-            #print(match)
-            self.pos += match.span()[1]
+            self.pos = match.end()
         return self
 
+    def finditer(self, find_regex:str):
+        """
+        Generates the matches of a regex from the current cursor position to the end of the
+        text.  Each match is selected as it is generated, with the mark at its start and the
+        cursor at its end, so copy() returns the matched text and the cursor is left after the
+        last match.
+
+        Example:
+           for m in tf.finditer(r"name=(\w+)"):
+               names.append(m.group(1))
+        """
+        for match in self.regex(find_regex).finditer(self.s, self.pos):
+            self.lpos, self.pos = match.span()
+            self.lneedle = match.group()
+            yield match
+
     def dequote(self):
         """
         Simple remove matching quotes around a marked string region moving the lpos and the cpos 
@@ -145,8 +339,10 @@ class TextFinder:
         Skips past a group of characters starting from the cursor where the group of characters
         is listed in the 'allowed' parameter
         """
-        while self.s[self.pos] in allowed:
-            self.pos += 1
+        if allowed:
+            allowed = re.escape(self.text(allowed))
+            pattern = (b"[%s]*" if self.binary else "[%s]*") % allowed
+            self.pos = self.regex(pattern).match(self.s, self.pos).end()
         return self
     
     def copy(self):
@@ -1,47 +1,87 @@
-from dateutil.parser import isoparse
 import datetime
-import pytz
 import os
+import re
+
+# canonical timestamps that datetime.fromisoformat reads directly, in UTC
+CANONICAL = re.compile(r"\d{4}-\d\d-\d\d[T ]\d\d:\d\d:\d\d(?:\.\d{3}|\.\d{6})?(?:Z|\+00:00)?")
+
+UTC = datetime.timezone.utc
+
+# strftime formats of the formatting methods, which are cached per instance
+FORMATS = {
+    "repr": "%Y-%m-%dT%H:%M:%SZ",
+    "date": "%Y-%m-%d",
+    "time": "%H:%M:%SZ",
+    "met_ts": "%Y%m%d_%H%M%S",
+    "expo_ts": "%Y%m%d",
+    "timestamptz": "%Y-%m-%d %H:%M:%S+00"
+}
 
 class ZuluTime:
+    __slots__ = ("_datetime", "_formats")
+
     def __init__(self, isodate: str = None):
         """
         Returns the time in Zulu standard for the given input string.   If no input string is given
         then if the ZULUTIME environment variable exists that time will be returned.   If neither is 
-        found then the current time is returned.
+        found then the current time is returned.  Times with another UTC offset are converted to UTC,
+        and naive times are taken to be in UTC.
         """
+        self._formats = None
         if isodate is not None:
-            isodate = str(isodate)
-            if ' ' in isodate:
-                isodate = isodate.replace(' ','T')
-            if '+00:00' in isodate:
-                isodate = isodate.replace('+00:00', '')
-            #print(f"isodate is '{isodate}'")
-            d = isoparse(isodate)
-            if ZuluTime.isnaive(d):
-                d = pytz.utc.localize(d)
-            self._datetime = d
+            if isinstance(isodate, datetime.datetime):
+                d = isodate
+            else:
+                d = ZuluTime.parse(str(isodate))
+            self._datetime = ZuluTime.utc(d)
         else:
             if 'ZULUTIME' in os.environ:
-                d = isoparse(os.environ['ZULUTIME'])
-                if ZuluTime.isnaive(d): d = pytz.utc.localize(d)
-                self._datetime = d
+                self._datetime = ZuluTime.utc(ZuluTime.parse(os.environ['ZULUTIME']))
 
             else:
-                now = datetime.datetime.utcnow()
-                self._datetime = pytz.utc.localize(now)
+                self._datetime = datetime.datetime.now(UTC)
+
+    @staticmethod
+    def parse(isodate : str) -> datetime.datetime:
+        """
+        Parses an ISO 8601 timestamp.  Canonical 'YYYY-MM-DDTHH:MM:SS[Z]' timestamps are read
+        with datetime.fromisoformat, anything else with dateutil.
+        """
+        if CANONICAL.fullmatch(isodate):
+            if isodate.endswith('Z'):
+                isodate = isodate[:-1]
+            elif isodate.endswith('+00:00'):
+                return datetime.datetime.fromisoformat(isodate)
+            return datetime.datetime.fromisoformat(isodate + '+00:00')
+        from dateutil.parser import isoparse
+        if ' ' in isodate:
+            isodate = isodate.replace(' ','T')
+        if '+00:00' in isodate:
+            isodate = isodate.replace('+00:00', '')
+        return isoparse(isodate)
 
     @classmethod
     def now(cls):
         """
         Returns the current time in Zulu standard
         """
-        return cls(datetime.datetime.utcnow())
+        return cls(datetime.datetime.now(UTC))
 
     @staticmethod
     def isnaive(dt : datetime.datetime):
         return dt.tzinfo is None or dt.tzinfo.utcoffset(dt) is None
 
+    @staticmethod
+    def utc(dt : datetime.datetime) -> datetime.datetime:
+        """
+        Returns 'dt' in UTC, a naive time is taken to be in UTC already
+        """
+        if ZuluTime.isnaive(dt):
+            return dt.replace(tzinfo=UTC)
+        if dt.tzinfo is not UTC:
+            return dt.astimezone(UTC)
+        return dt
+
     def __sub__(self, ts):
         return self._datetime - ts._datetime
 
@@ -63,24 +103,87 @@ class ZuluTime:
     def __add__(self, offset_sec):
         return self._datetime + datetime.timedelta(seconds=offset_sec)
 
+    def format(self, form : str) -> str:
+        """
+        Returns the time in one of the FORMATS, formatting it only the first time
+        """
+        if self._formats is None:
+            self._formats = {}
+        text = self._formats.get(form)
+        if text is None:
+            text = self._formats[form] = self._datetime.strftime(FORMATS[form])
+        return text
+
     def __repr__(self):
-        return self._datetime.strftime("%Y-%m-%dT%H:%M:%SZ")
+        return self.format("repr")
 
     def date(self):
-        return self._datetime.strftime("%Y-%m-%d")
+        return self.format("date")
 
     def time(self):
-        return self._datetime.strftime("%H:%M:%SZ")
+        return self.format("time")
 
     def met_ts(self):
-        return self._datetime.strftime("%Y%m%d_%H%M%S")
+        return self.format("met_ts")
 
     def expo_ts(self):
-        return self._datetime.strftime("%Y%m%d")
+        return self.format("expo_ts")
 
     def timestamptz(self):
         """format compatible with Redshift TIMESTAMPTZ"""
-        return self._datetime.strftime("%Y-%m-%d %H:%M:%S+00")
+        return self.format("timestamptz")
+
+    def datetime64(self):
+        """
+        Returns the time as a NumPy datetime64 in UTC, with second resolution
+        """
+        import numpy as np
+        return np.datetime64(self._datetime.replace(tzinfo=None), "s")
+
+    @staticmethod
+    def parse_array(values):
+        """
+        Parses a sequence of canonical UTC timestamps ('YYYY-MM-DDTHH:MM:SS[Z]', or with a space
+        or '+00:00') into a NumPy datetime64[s] array in one vectorised conversion.  Timestamps with
+        another UTC offset are converted to UTC one at a time, as ZuluTime does.  Requires NumPy.
+        """
+        import numpy as np
+        values = np.asarray(values)
+        if np.issubdtype(values.dtype, np.datetime64):
+            return values.astype("datetime64[s]")
+        values = values.astype(str)
+        values = np.char.replace(np.char.rstrip(values, "Z"), "+00:00", "")
+        # an offset follows the time, whose '-' and '+' are after the date
+        offset = (np.char.rfind(values, "+") > 10) | (np.char.rfind(values, "-") > 10)
+        if not offset.any():
+            return values.astype("datetime64[s]")
+        times = np.empty(values.shape, "datetime64[s]")
+        times[~offset] = values[~offset].astype("datetime64[s]")
+        times[offset] = [ ZuluTime(v).datetime64() for v in values[offset] ]
+        return times
+
+    @staticmethod
+    def format_array(times, form : str = "repr"):
+        """
+        Formats a NumPy datetime64 array (or anything parse_array accepts) in one of the FORMATS,
+        returning an array of strings.  Requires NumPy.
+        """
+        import numpy as np
+        iso = np.datetime_as_string(ZuluTime.parse_array(times), unit="s")    # YYYY-MM-DDTHH:MM:SS
+        if form == "repr":
+            return np.char.add(iso, "Z")
+        if form == "date":
+            return np.char.partition(iso, "T")[..., 0]
+        if form == "time":
+            return np.char.add(np.char.partition(iso, "T")[..., 2], "Z")
+        if form == "timestamptz":
+            return np.char.add(np.char.replace(iso, "T", " "), "+00")
+        compact = np.char.replace(np.char.replace(iso, "-", ""), ":", "")   # YYYYMMDDTHHMMSS
+        if form == "met_ts":
+            return np.char.replace(compact, "T", "_")
+        if form == "expo_ts":
+            return np.char.partition(compact, "T")[..., 0]
+        raise ValueError(f"Unknown format {form}, expected one of {', '.join(FORMATS)}")
 
 
 if __name__ == "__main__":
@@ -15,10 +15,14 @@ setup(
     url = "https://github.com/ksmathers/generic-templates",
     packages = ['generic_templates'],
     classifiers = [],
-    scripts= ['bin/fill-template'],
+    scripts= ['bin/fill-template', 'bin/fill-template-daemon', 'bin/fill-template-client'],
     tests_require = ['pytest'],
     install_requires = [
        'keyring',
        'lark'
-    ]
+    ],
+    extras_require = {
+       # ZuluTime.datetime64, parse_array and format_array
+       'numpy': ['numpy']
+    }
 )
@@ -1,9 +1,9 @@
 from generic_templates import fill_template, Fpos
 import generic_templates
 
-#generic_templates.template_parser.TRACE = True
-#generic_templates.template_tokenizer.TRACE = True
-#generic_templates.template_vm.TRACE = True
+trace = None
+#trace = generic_templates.PrintTrace()
+#trace = generic_templates.RingBufferTrace(1000)
 
 
 
@@ -23,4 +23,4 @@ def func(
         print(f"{n[0]:32s} {n[1]}")
 """)
 
-fill_template("output-foreach-test.py.template", {}, ['a', 'b', 'c'], [1, 2, 3], fp=fp)
\ No newline at end of file
+fill_template("output-foreach-test.py.template", {}, ['a', 'b', 'c'], [1, 2, 3], fp=fp, trace=trace)
\ No newline at end of file
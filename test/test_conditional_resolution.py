@@ -0,0 +1,111 @@
+import random
+
+import pytest
+
+from generic_templates.fpos import Fpos
+from generic_templates.template_parser import compile
+from generic_templates.template_tokenizer import fixed_symbols
+from generic_templates.template_vm import PreprocessorVM
+
+# The lexer resolves #ifdef/#ifndef blocks whose outcome is fixed by the environment
+# (see template_tokenizer.fixed_symbols).  Each case renders a template with the blocks
+# resolved while lexing and with every block left to the VM, which must give the same output.
+
+SYMBOLS = [ "A", "B", "C", "D" ]
+RANDOM_CASES = 3000
+
+
+def render(lines, env, defines):
+    prog = compile(Fpos(list(lines)), defines=defines)
+    vm = PreprocessorVM(dict(env))
+    vm.prog(prog)
+    vm.execute()
+    return "".join(vm.output), len(prog)
+
+
+def check(lines, env):
+    """- Returns the output of the template, asserting that resolving its conditionals while
+    lexing doesn't change it, and returns the sizes of the unresolved and resolved programs"""
+    expected, size = render(lines, env, None)
+    output, resolved_size = render(lines, env, env)
+    assert output == expected, "".join(lines)
+    return output, size, resolved_size
+
+
+def generate(depth, r):
+    lines = []
+    for _ in range(r.randint(0, 3)):
+        k = r.random()
+        if k < 0.35 and depth < 4:
+            kind = r.choice([ "#ifdef", "#ifndef", "#if" ])
+            cond = r.choice(SYMBOLS) if kind != "#if" else f'{r.choice(SYMBOLS)} == "1"'
+            lines.append(f"{kind} {cond}\n")
+            lines += generate(depth+1, r)
+            if r.random() < 0.5:
+                lines.append("#else\n")
+                lines += generate(depth+1, r)
+            lines.append("#endif\n")
+        elif k < 0.45:
+            lines.append(f'#define {r.choice(SYMBOLS)} "1"\n')
+        else:
+            lines.append(f"t{r.randint(0, 99)} A B\n")
+    return lines
+
+
+def test_randomized_templates():
+    for seed in range(RANDOM_CASES):
+        r = random.Random(seed)
+        lines = generate(0, r)
+        env = { s: "1" for s in SYMBOLS if r.random() < 0.4 }
+        check(lines, env)
+
+
+@pytest.mark.parametrize("env", [ {}, { "A": "1" }, { "B": "1" }, { "A": "1", "B": "1" } ])
+def test_nested_if_else(env):
+    lines = [
+        "#ifdef A\n",
+        "a\n",
+        "#ifndef B\n",
+        "a-not-b\n",
+        "#else\n",
+        "a-b\n",
+        "#endif\n",
+        "#else\n",
+        "#ifdef B\n",
+        "not-a-b\n",
+        "#endif\n",
+        "#if B == \"1\"\n",
+        "b-is-1\n",
+        "#endif\n",
+        "#endif\n",
+        "end\n"
+    ]
+    output, size, resolved_size = check(lines, env)
+    assert resolved_size < size
+    assert output.endswith("end\n")
+
+
+def test_env_defined_symbol_is_resolved():
+    lines = [ "#ifdef A\n", "yes\n", "#else\n", "no\n", "#endif\n" ]
+    output, size, resolved_size = check(lines, { "A": "1" })
+    assert output == "yes\n"
+    assert resolved_size < size
+
+
+def test_template_defined_symbol_is_left_to_the_vm():
+    lines = [ "#ifdef A\n", "early\n", "#endif\n", '#define A "1"\n', "#ifdef A\n", "late\n", "#endif\n" ]
+    output, size, resolved_size = check(lines, {})
+    assert output == "late\n"
+    assert resolved_size == size
+
+
+def test_symbol_assigned_by_for_is_left_to_the_vm():
+    lines = [ "#ifdef @X\n", "before\n", "#endif\n", "#for @X in @L\n", "#ifdef @X\n", "x\n", "#endif\n", "#endfor\n" ]
+    output, size, resolved_size = check(lines, { "@L": [ 1, 2 ] })
+    assert output == "x\nx\n"
+
+
+def test_include_leaves_undefined_symbols_to_the_vm():
+    lines = [ "#ifdef B\n", "b\n", "#endif\n", '#include "other.inc"\n' ]
+    assert fixed_symbols(lines, { "A": "1" }) == {}
+    assert fixed_symbols(lines, { "B": "1" }) == { "B": True }
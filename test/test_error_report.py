@@ -0,0 +1,134 @@
+import pytest
+
+from generic_templates.error_report import ErrorReport
+from generic_templates.fpos import Fpos
+from generic_templates.template import preprocess
+from generic_templates.template_limits import LimitExceeded, TemplateLimits
+from generic_templates.template_loader import MemoryLoader
+from generic_templates.template_parallel import ParallelLoops
+
+
+def test_unbuffered_prints_each_message(capsys):
+    errors = ErrorReport()
+    errors.warn("first", (3, 7))
+    errors.error("second", 4)
+    assert capsys.readouterr().err == "WARN: line 3, column 7: first\nERROR: line 4: second\n"
+
+
+def test_aggregate_counts_repeats(capsys):
+    errors = ErrorReport(aggregate=True)
+    for _ in range(3):
+        errors.error("missing symbol", 2)
+    errors.warn("unused", 5)
+    assert capsys.readouterr().err == "ERROR: line 2: missing symbol\nWARN: line 5: unused\n"
+    assert dict(errors.items()) == {
+        (ErrorReport.Level.ERROR, "line 2: missing symbol"): 3,
+        (ErrorReport.Level.WARN, "line 5: unused"): 1
+    }
+    errors.flush()
+    assert capsys.readouterr().err == "ERROR: line 2: missing symbol (3 times)\n"
+    errors.flush()
+    assert capsys.readouterr().err == ""
+
+
+def test_limit_summarizes_dropped_messages(capsys):
+    errors = ErrorReport(limit=2, buffered=True)
+    for n in range(5):
+        errors.error(f"error {n}")
+    errors.warn("late warning")
+    assert errors.errors == [ "error 0", "error 1" ]
+    assert errors.dropped == { "ERROR": 3, "WARN": 1 }
+    errors.flush()
+    assert capsys.readouterr().err == "ERROR: error 0\nERROR: error 1\n... 4 more messages not shown (3 ERROR, 1 WARN)\n"
+
+
+def test_buffered_holds_messages_until_flush(capsys):
+    errors = ErrorReport(buffered=True)
+    errors.info("one")
+    errors.error("two")
+    assert capsys.readouterr().err == ""
+    with pytest.raises(SystemExit):
+        errors.exit_on_error()
+    captured = capsys.readouterr()
+    assert captured.err == "INFO: one\nERROR: two\n"
+    assert captured.out == "Exiting on error\n"
+
+
+def test_merge_keeps_counts_and_level():
+    worker = ErrorReport(aggregate=True, buffered=True)
+    worker.warn("slow row")
+    worker.warn("slow row")
+    parent = ErrorReport(aggregate=True, buffered=True)
+    parent.warn("slow row")
+    parent.merge(worker)
+    assert dict(parent.items()) == { (ErrorReport.Level.WARN, "slow row"): 3 }
+    assert parent.max_level == ErrorReport.Level.WARN
+
+
+def test_syntax_error_reports_its_position(capsys):
+    errors = ErrorReport(buffered=True)
+    with pytest.raises(SystemExit):
+        preprocess(Fpos.from_string('a\nb\n#if @X ==\nc\n#endif\n'), {}, [], errors=errors)
+    assert errors.errors[0].startswith("line 4, column 1: Unexpected token")
+    assert "ERROR: line 4, column 1:" in capsys.readouterr().err
+
+
+def test_runtime_error_reports_its_line():
+    errors = ErrorReport(buffered=True)
+    with pytest.raises(TypeError):
+        preprocess(Fpos.from_string('a\n#for @X in @L\nrow @X\n#endfor\n'), { "@L": 5 }, [], errors=errors)
+    assert errors.errors == [ "line 2: 'int' object is not iterable (pc 3)" ]
+
+
+def test_nested_include_error_is_reported_once():
+    loader = MemoryLoader({
+        "main.template": 'main\n#include "part.inc"\n',
+        "part.inc": 'part\n\n#for @X in @L\n@X\n#endfor\n'
+    })
+    errors = ErrorReport(buffered=True)
+    with pytest.raises(TypeError):
+        preprocess(Fpos(loader.lines("main.template")), { "__FILE__": "main.template", "@L": 5 }, [],
+                   loader=loader, errors=errors)
+    assert len(errors.errors) == 1
+    assert errors.errors[0].startswith("line 3: 'int' object is not iterable (pc ")
+
+
+def test_include_depth_is_reported_once():
+    loader = MemoryLoader({ "main.template": 'a\n#include "main.template"\n' })
+    errors = ErrorReport(buffered=True)
+    with pytest.raises(LimitExceeded) as raised:
+        preprocess(Fpos(loader.lines("main.template")), { "__FILE__": "main.template" }, [], loader=loader,
+                   limits=TemplateLimits(include_depth=5), errors=errors)
+    assert len(errors.errors) == 1
+    assert errors.errors[0] == f"line 2: {raised.value}"
+
+
+def test_limit_is_reported_at_the_charged_instruction():
+    text = '#define @A "a"\n#define @B "b"\n#for @X in @L\nrow @X\n#endfor\n'
+    errors = ErrorReport(buffered=True)
+    with pytest.raises(LimitExceeded) as raised:
+        preprocess(Fpos.from_string(text), { "@L": range(1000) }, [],
+                   limits=TemplateLimits(instructions=50, check_every=7), errors=errors)
+    e = raised.value
+    assert e.line in (3, 4, 5)
+    assert errors.errors == [ f"line {e.line}: {e}" ]
+    assert errors.errors[0].count(f"pc {e.pc}") == 1
+    assert "(pc" not in errors.errors[0]
+
+
+def test_worker_reports_are_merged():
+    text = '#for @X in @L\nrow @X\n#endfor\n'
+    errors = ErrorReport(buffered=True)
+    vm = preprocess(Fpos.from_string(text), { "@L": [ 1 ] }, [], errors=errors)
+    worker = ErrorReport(buffered=True)
+    worker.warn("from a worker", 2)
+    ParallelLoops.collect(vm, ("row 2\n", { "@X": 2 }, worker, None))
+    assert vm.output[-1] == "row 2\n"
+    assert errors.errors == [ "line 2: from a worker" ]
+
+    failed = ErrorReport(buffered=True)
+    failed.error("chunk failed", 2)
+    with pytest.raises(ValueError):
+        ParallelLoops.collect(vm, ("", {}, failed, ValueError("chunk failed")))
+    assert errors.errors[-1] == "line 2: chunk failed"
+    assert errors.max_level == ErrorReport.Level.ERROR
@@ -0,0 +1,69 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+# The heavy modules are only imported when a template is compiled or rendered, or a NumPy
+# conversion is used, so importing the package loads none of them.
+HEAVY_MODULES = [ "lark", "numpy", "dateutil", "pytz", "jupyter_aws", "generic_templates.template",
+                  "generic_templates.template_vm", "generic_templates.template_parser" ]
+
+# Opt-in budgets for the cumulative import time of the package, in microseconds, checked when
+# IMPORT_TIMING is set in the environment.  Wall clock times vary too much on shared machines
+# for them to be part of the default run.
+IMPORT_BUDGET_US = 20000
+CLI_IMPORT_BUDGET_US = 150000
+timing = pytest.mark.skipif(not os.environ.get("IMPORT_TIMING"), reason="set IMPORT_TIMING to check import times")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run(statement, modules=(), importtime=False):
+    """- Runs 'statement' in a fresh interpreter and returns the modules from 'modules' that it
+    loaded, and the stderr of the interpreter"""
+    code = f"{statement}\nimport sys\nprint(','.join(m for m in {list(modules)!r} if m in sys.modules))"
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    options = [ "-X", "importtime" ] if importtime else []
+    proc = subprocess.run([sys.executable, *options, "-c", code], capture_output=True, text=True, env=env, check=True)
+    return [ x for x in proc.stdout.strip().split(",") if x ], proc.stderr
+
+
+def import_time(statement):
+    """- Returns the best over three runs of the cumulative time spent importing generic_templates
+    and its lazily loaded submodules by 'statement'"""
+    best = None
+    for _ in range(3):
+        _, stderr = run(statement, importtime=True)
+        us = 0
+        for line in stderr.splitlines():
+            fields = line.split("|")
+            if len(fields) != 3 or not fields[1].strip().isdigit():
+                continue
+            name = fields[2][1:]
+            # only top level imports; nested ones are already in their parent's cumulative time
+            if name.startswith("generic_templates"):
+                us += int(fields[1])
+        best = us if best is None else min(best, us)
+    return best
+
+
+def test_package_import_is_lazy():
+    loaded, _ = run("import generic_templates", HEAVY_MODULES)
+    assert loaded == []
+
+
+def test_cli_imports_are_lazy():
+    # the CLI needs the compiler, but none of the optional dependencies
+    loaded, _ = run("from generic_templates import fill_template, Arglist", [ "numpy", "dateutil", "pytz", "jupyter_aws" ])
+    assert loaded == []
+
+
+@timing
+def test_package_import_time():
+    assert import_time("import generic_templates") < IMPORT_BUDGET_US
+
+
+@timing
+def test_cli_import_time():
+    assert import_time("from generic_templates import fill_template, Arglist") < CLI_IMPORT_BUDGET_US
@@ -0,0 +1,99 @@
+import pytest
+
+from generic_templates.fpos import Fpos
+from generic_templates.template import preprocess, run_program
+from generic_templates.template_loader import MemoryLoader
+from generic_templates.template_parallel import ParallelLoops
+from generic_templates.template_specialize import specialize
+
+# Each template is run in an unlinked VM and in a linked VM (see template_link), which must
+# give the same output and leave the same variables behind.
+
+TEMPLATE = """#template @NLIST, @VLIST
+#define MODE "fast"
+#ifdef DEBUG
+debug MODE
+#endif
+#if MODE == "fast"
+mode MODE @PREFIX
+#else
+slow
+#endif
+#for @N, @V in @NLIST, @VLIST
+    @N = @V MODE
+#ifdef @EXTRA
+    extra @EXTRA
+#endif
+#endfor
+#define @EXTRA "x"
+#for @I, @N in indices(@NLIST), @NLIST
+    @I: @N @EXTRA
+#endfor
+#define LAST basename(@PATH)
+last LAST
+"""
+
+
+def run(text, env, args, linked, **kwargs):
+    vm = preprocess(Fpos.from_string(text), dict(env), list(args), linked=linked, **kwargs)
+    return "".join(vm.output), dict(vm.vars)
+
+
+def run_both(text, env, args=(), **kwargs):
+    unlinked = run(text, env, args, False, **kwargs)
+    linked = run(text, env, args, True, **kwargs)
+    assert linked == unlinked
+    return unlinked[0]
+
+
+@pytest.mark.parametrize("env", [
+    { "@PREFIX": "p", "@PATH": "/a/b.txt" },
+    { "@PREFIX": "p", "@PATH": "/a/b.txt", "DEBUG": True, "MODE": "slow" },
+])
+def test_gets_sets_args_nexts(env):
+    output = run_both(TEMPLATE, env, [ [ "a", "b" ], [ 1, 2 ] ])
+    assert "    a = 1 fast\n" in output
+    assert "    1: b x\n" in output
+    assert output.endswith("last b.txt\n")
+
+
+def test_linked_opcodes():
+    vm = preprocess(Fpos.from_string(TEMPLATE), { "@PREFIX": "p", "@PATH": "x" }, [ [ "a" ], [ 1 ] ], linked=True)
+    opcodes = { instr.opcode for instr in vm.progmem }
+    assert { 'GETS', 'SETS', 'ARGS', 'NEXTS' } <= opcodes
+    assert not opcodes & { 'GET', 'SET', 'ARG', 'NEXT' }
+
+
+def test_include():
+    loader = MemoryLoader({
+        "main.template": '#define @A "1"\n#include "part.inc", "arg"\nafter @A @B\n',
+        "part.inc": '#template @P\n#define @B "2"\npart @A @P\n'
+    })
+    env = { "__FILE__": "main.template" }
+    outputs = []
+    for linked in (False, True):
+        fp = Fpos(loader.lines("main.template"))
+        vm = preprocess(fp, dict(env), [], linked=linked, loader=loader)
+        outputs.append(("".join(vm.output), vm.vars.get("@B")))
+    assert outputs[0] == outputs[1]
+    assert outputs[0] == ("part 1 arg\nafter 1 2\n", "2")
+
+
+def test_parallel_loops():
+    text = '#define @S "s"\n#for @X, @Y in @L, @M\nrow @X @Y @S\n#endfor\nend @X\n'
+    env = { "@L": list(range(50)), "@M": [ str(x * 2) for x in range(50) ] }
+    expected = run_both(text, env)
+    with ParallelLoops(2, threshold=10, chunk_size=7) as parallel:
+        assert run_both(text, env, parallel=parallel) == expected
+        assert parallel.pool is not None
+    assert expected.startswith("row 0 0 s\nrow 1 2 s\n")
+
+
+def test_specialized_program():
+    prog = specialize(Fpos.from_string(TEMPLATE), { "@PREFIX": "p" })
+    results = []
+    for linked in (False, True):
+        vm = run_program(prog, { "@PATH": "/x/y" }, [ [ "a", "b" ], [ 1, 2 ] ], linked=linked)
+        results.append("".join(vm.output))
+    assert results[0] == results[1]
+    assert "mode fast p\n" in results[0]
@@ -0,0 +1,31 @@
+import re
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from generic_templates.list_util import grep, igrep
+
+ITEMS = [ f"item {n}" for n in range(1000) ]
+
+
+def test_grep():
+    assert grep(ITEMS, "item 99") == [ "item 99", "item 990", "item 991", "item 992", "item 993",
+                                       "item 994", "item 995", "item 996", "item 997", "item 998", "item 999" ]
+    assert grep(ITEMS, [ "item 5", "item 12" ]) == [ x for x in ITEMS if "item 5" in x or "item 12" in x ]
+    assert grep(ITEMS, r"^item 1\d$", regex=True) == [ f"item 1{n}" for n in range(10) ]
+    assert grep([ 1, 12, 21 ], re.compile("2")) == [ 12, 21 ]
+    assert list(igrep(iter(ITEMS), "item 99")) == grep(ITEMS, "item 99")
+
+
+def test_grep_with_callers_executor():
+    expected = grep(ITEMS, [ "7", "item 3" ])
+    with ThreadPoolExecutor(2) as executor:
+        assert grep(ITEMS, [ "7", "item 3" ], chunk_size=64, executor=executor) == expected
+        # the executor is still usable after grep
+        assert grep(ITEMS, "item 42", chunk_size=64, executor=executor) == [ "item 42" ] + [ f"item 42{n}" for n in range(10) ]
+        assert executor.submit(len, ITEMS).result() == 1000
+    with ProcessPoolExecutor(2) as executor:
+        for _ in range(2):
+            assert grep(ITEMS, [ "7", "item 3" ], chunk_size=300, executor=executor) == expected
+
+
+def test_grep_with_workers():
+    assert grep(ITEMS, "item 99", workers=2, chunk_size=300) == grep(ITEMS, "item 99")
@@ -0,0 +1,68 @@
+import random
+
+from generic_templates.fpos import Fpos
+from generic_templates.template_instr import is_pure
+from generic_templates.template_parser import get_parser, release_parser
+from generic_templates.template_tokenizer import PreprocessorLexer
+
+# The code generator works out whether each #for loop is pure (see template_instr.is_pure) in
+# a single pass as loops are closed.  It must agree with scanning each loop body afterwards.
+
+RANDOM_CASES = 500
+
+
+def parse(lines):
+    parser = get_parser()
+    parser.options.transformer.reset()
+    try:
+        return parser.parse(PreprocessorLexer().lex(Fpos(list(lines))))
+    finally:
+        release_parser(parser)
+
+
+def loops(prog):
+    """- Generates (FOREACH instruction, body) for each loop of an unoptimized program"""
+    labels = { instr.arg1: pc for pc, instr in enumerate(prog) if instr.opcode == 'LABEL' }
+    for pc, instr in enumerate(prog):
+        if instr.opcode == 'FOREACH':
+            end = labels[prog[pc+2].arg1]
+            yield instr, prog[pc+3:end]
+
+
+def generate(depth, r):
+    lines = []
+    for _ in range(r.randint(0, 4)):
+        k = r.random()
+        if k < 0.3 and depth < 4:
+            lines.append(f"#for @X{depth} in @L\n")
+            lines += generate(depth+1, r)
+            lines.append("#endfor\n")
+        elif k < 0.4 and depth < 4:
+            lines.append("#ifdef A\n")
+            lines += generate(depth+1, r)
+            lines.append("#endif\n")
+        elif k < 0.47:
+            lines.append('#define A "1"\n')
+        elif k < 0.5:
+            lines.append('#outfile "x.py"\n')
+        else:
+            lines.append(f"t{r.randint(0, 99)} @X0\n")
+    return lines
+
+
+def test_randomized_nested_loops():
+    for seed in range(RANDOM_CASES):
+        lines = generate(0, random.Random(seed))
+        for instr, body in loops(parse(lines)):
+            assert bool(instr.arg2) == is_pure(body), "".join(lines)
+
+
+def test_side_effect_in_inner_loop_makes_outer_loops_impure():
+    lines = [ "#for @A in @L\n", "a\n", "#for @B in @L\n", "#for @C in @L\n", '#define X "1"\n', "#endfor\n",
+              "#endfor\n", "#for @D in @L\n", "d\n", "#endfor\n", "#endfor\n" ]
+    assert [ bool(instr.arg2) for instr, body in loops(parse(lines)) ] == [ False, False, False, True ]
+
+
+def test_side_effect_after_inner_loop():
+    lines = [ "#for @A in @L\n", "#for @B in @L\n", "b\n", "#endfor\n", '#define X "1"\n', "#endfor\n" ]
+    assert [ bool(instr.arg2) for instr, body in loops(parse(lines)) ] == [ False, True ]
@@ -0,0 +1,43 @@
+import io
+
+from generic_templates.report import Report
+
+
+def test_sections_log_is_kept():
+    report = Report(textwidth=20)
+    report.print("first")
+    report.section("Details")
+    report.sections_log["Details"].append("    appended")
+    report.print("a line that is longer than the width")
+    assert report.sections_log == {
+        "Overview": [ "    first" ],
+        "Details": [ "    appended", "    a line that i..." ]
+    }
+    assert str(report) == "1. Overview\n    first\n\n2. Details\n    appended\n    a line that i...\n"
+
+
+def test_flush_releases_lines():
+    report = Report()
+    report.print("one")
+    report.section("Details")
+    report.print("two")
+    out = io.StringIO()
+    report.flush(out)
+    assert out.getvalue() == "1. Overview\n    one\n\n2. Details\n    two\n"
+    assert report.sections_log == { "Overview": [], "Details": [] }
+
+    report.section("Overview")
+    report.print("three")
+    report.flush(out)
+    assert out.getvalue().endswith("\n1. Overview (continued)\n    three\n")
+
+
+def test_spilled_attachment():
+    report = Report(spill_size=4)
+    report.attach("big", "0123456789")
+    report.attach("small", b"01")
+    assert report.attachment("big") == "0123456789"
+    assert report.attachment("small") == b"01"
+    assert report.sections_log["Overview"][-1] == "        See attachment: 'small'"
+    report.close()
+    assert not report.has_attachment("big")
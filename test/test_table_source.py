@@ -0,0 +1,45 @@
+import pytest
+
+from generic_templates.template import fill_template
+from generic_templates.template_loader import OutputCollector
+from generic_templates.table_source import TableSource
+
+TEMPLATE = """# the name of this file is generated
+#for @NAME, @PATH in @name, @path
+@NAME = Input("@PATH")
+#endfor
+"""
+EXPECTED = """# the name of this file is generated
+sales = Input("/data/sales")
+stock = Input("/data/stock")
+"""
+
+
+@pytest.fixture
+def files(tmp_path):
+    (tmp_path / "datasets.csv").write_text("name,path\nsales,/data/sales\nstock,/data/stock\n")
+    (tmp_path / "transforms.py.template").write_text(TEMPLATE)
+    return tmp_path
+
+
+def render(files, **kwargs):
+    writer = OutputCollector()
+    fill_template("transforms.py.template", {}, cwd=str(files), writer=writer, **kwargs)
+    body, = writer.files.values()
+    return body[body.index("# the name"):]
+
+
+def test_prefix_pair(files):
+    assert render(files, tables=[ ("@", "datasets.csv") ]) == EXPECTED
+
+
+def test_table_prefix(files):
+    assert render(files, tables=[ "datasets.csv" ], table_prefix="@") == EXPECTED
+    assert render(files, tables=[ ("@", TableSource(str(files / "datasets.csv"))) ], table_prefix="x_") == EXPECTED
+
+
+def test_columns_are_read_lazily(files):
+    env = TableSource(str(files / "datasets.csv")).bind("@")
+    assert list(env) == [ "@name", "@path" ]
+    assert list(env["@name"]) == [ "sales", "stock" ]
+    assert list(env["@name"]) == [ "sales", "stock" ]
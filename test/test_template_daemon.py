@@ -0,0 +1,88 @@
+import os
+import stat
+import threading
+
+from generic_templates.template_daemon import RenderServer, request
+
+
+def start(path):
+    server = RenderServer(path)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def render(socket_path, cwd, argv, environ):
+    return request({ "op": "render", "argv": argv, "cwd": cwd, "environ": environ }, socket_path)
+
+
+def test_socket_is_private(tmp_path):
+    server = start(str(tmp_path / "daemon.sock"))
+    try:
+        assert stat.S_IMODE(os.stat(server.path).st_mode) == 0o600
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_concurrent_renders_keep_their_cwd_and_environment(tmp_path):
+    socket_path = str(tmp_path / "daemon.sock")
+    dirs = []
+    for n in range(8):
+        d = tmp_path / f"project{n}"
+        (d / "inc").mkdir(parents=True)
+        (d / "inc" / "part.inc").write_text(f"part {n}\n")
+        (d / "foo.py.template").write_text(f'#include "inc/part.inc"\nname NAME @env:PROJECT@\n')
+        dirs.append(str(d))
+    cwd = os.getcwd()
+    environ = dict(os.environ)
+    server = start(socket_path)
+    replies = [ None ] * len(dirs)
+    try:
+        def run(n):
+            replies[n] = render(socket_path, dirs[n], [ "-D", f"NAME=n{n}", "foo.py.template" ], { "PROJECT": f"p{n}" })
+        threads = [ threading.Thread(target=run, args=(n,)) for n in range(len(dirs)) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        server.shutdown()
+        server.server_close()
+    for n, d in enumerate(dirs):
+        assert replies[n]["status"] == 0, replies[n]["stderr"]
+        assert replies[n]["stdout"] == "writing foo.py\n"
+        with open(os.path.join(d, "foo.py")) as f:
+            assert f.read().endswith(f"part {n}\nname n{n} p{n}\n")
+    assert os.getcwd() == cwd
+    assert dict(os.environ) == environ
+
+
+def test_failed_render_reports_its_error(tmp_path):
+    socket_path = str(tmp_path / "daemon.sock")
+    server = start(socket_path)
+    try:
+        reply = render(socket_path, str(tmp_path), [ "missing.py.template" ], {})
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert reply["status"] == 1
+    assert reply["stdout"].startswith("Usage:")
+
+
+def test_distinct_renders_reuse_the_compiled_template(tmp_path):
+    socket_path = str(tmp_path / "daemon.sock")
+    (tmp_path / "foo.py.template").write_text('name NAME\n')
+    server = start(socket_path)
+    try:
+        reply = render(socket_path, str(tmp_path), [ "-D", "NAME=first", "foo.py.template" ], {})
+        assert reply["status"] == 0, reply["stderr"]
+        hits, misses = server.cache.hits, server.cache.misses
+        reply = render(socket_path, str(tmp_path), [ "-D", "NAME=second", "foo.py.template" ], {})
+        assert reply["status"] == 0, reply["stderr"]
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert (hits, misses) == (0, 1)
+    assert (server.cache.hits, server.cache.misses) == (1, 1)
+    assert (tmp_path / "foo.py").read_text().endswith("name second\n")
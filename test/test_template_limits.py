@@ -0,0 +1,55 @@
+import pytest
+
+from generic_templates.fpos import Fpos
+from generic_templates.template import preprocess
+from generic_templates.template_limits import TemplateLimits, LimitExceeded
+from generic_templates.template_loader import MemoryLoader
+from generic_templates.template_parallel import ParallelLoops
+from generic_templates.template_parser import compile
+from generic_templates.template_vm import PreprocessorVM
+
+
+def test_instruction_limit_reports_the_running_instruction():
+    prog = compile(Fpos.from_string('#define A "1"\n#define B "2"\n#define C "3"\ntext A B C\n'))
+    vm = PreprocessorVM({}, limits=TemplateLimits(instructions=3, check_every=1))
+    vm.prog(prog)
+    with pytest.raises(LimitExceeded) as e:
+        vm.execute()
+    # the 4th instruction executed is the one over the limit
+    assert e.value.limit == "instructions"
+    assert e.value.pc == 3
+    assert e.value.instruction is vm.progmem[3]
+    assert e.value.line == 2
+
+
+def test_include_depth_reports_the_include():
+    loader = MemoryLoader({ "loop.inc": 'before\n#include "loop.inc"\n' })
+    fp = Fpos(loader.lines("loop.inc"))
+    with pytest.raises(LimitExceeded) as e:
+        preprocess(fp, { "__FILE__": "loop.inc" }, [], loader=loader, limits=TemplateLimits(include_depth=3))
+    assert e.value.limit == "include_depth"
+    assert e.value.instruction.opcode == 'INCLUDE'
+    assert e.value.line == 2
+
+
+def test_output_limit():
+    fp = Fpos.from_string("#for @X in @L\nrow @X\n#endfor\n")
+    with pytest.raises(LimitExceeded) as e:
+        preprocess(fp, { "@L": range(10**6) }, [], limits=TemplateLimits(output_bytes=1000, check_every=16))
+    assert e.value.limit == "output_bytes"
+    assert e.value.value <= 1000 + 16 * len("row 999999\n")
+
+
+def test_parallel_loops_are_bounded():
+    fp = Fpos.from_string("#for @X in @L\nrow @X\n#endfor\n")
+    with ParallelLoops(2, threshold=10, chunk_size=100) as parallel:
+        with pytest.raises(LimitExceeded) as e:
+            preprocess(fp, { "@L": range(10**7) }, [], parallel=parallel, limits=TemplateLimits(instructions=10000))
+        assert parallel.pool is None
+    assert e.value.limit == "instructions"
+
+
+def test_no_limits():
+    fp = Fpos.from_string("#for @X in @L\nrow @X\n#endfor\n")
+    vm = preprocess(fp, { "@L": range(3) }, [], limits=TemplateLimits())
+    assert "".join(vm.output) == "row 0\nrow 1\nrow 2\n"
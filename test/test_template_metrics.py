@@ -0,0 +1,40 @@
+import time
+
+from generic_templates.fpos import Fpos
+from generic_templates.template import preprocess
+from generic_templates.template_loader import MemoryLoader
+from generic_templates.template_metrics import TemplateMetrics
+
+
+def test_nested_stage_time_is_not_counted_twice():
+    metrics = TemplateMetrics()
+    start = time.perf_counter()
+    with metrics.stage("outer"):
+        time.sleep(0.02)
+        with metrics.stage("inner"):
+            time.sleep(0.05)
+    elapsed = time.perf_counter() - start
+    outer = metrics.get("outer").wall_s
+    inner = metrics.get("inner").wall_s
+    assert outer >= 0.02
+    assert inner >= 0.05
+    # counted twice, the inner stage would be in both times and they would add up to more than the wall time
+    assert outer + inner <= elapsed
+
+
+def test_stage_times_add_up_to_the_render_time():
+    loader = MemoryLoader({
+        "main.template": '#include "a.inc"\n#include "a.inc"\nmain\n',
+        "a.inc": '#for @X in @L\nrow @X\n#endfor\n#include "b.inc"\n',
+        "b.inc": "b\n" * 1000
+    })
+    metrics = TemplateMetrics("main.template")
+    start = time.perf_counter()
+    vm = preprocess(Fpos(loader.lines("main.template")), { "__FILE__": "main.template", "@L": range(20000) }, [],
+                    metrics=metrics, loader=loader)
+    elapsed = time.perf_counter() - start
+    assert vm.output[-1] == "main\n"
+    assert metrics.get("include").calls == 4
+    total = sum(rec.wall_s for rec in metrics.stages.values())
+    assert total <= elapsed
+    assert metrics.get("execute").wall_s > metrics.get("include").wall_s
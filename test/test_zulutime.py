@@ -0,0 +1,43 @@
+import datetime
+
+import pytest
+
+from generic_templates.zulutime import ZuluTime
+
+OFFSET = "2024-01-01T10:00:00-07:00"
+
+
+def test_offset_is_converted_to_utc():
+    z = ZuluTime(OFFSET)
+    assert repr(z) == "2024-01-01T17:00:00Z"
+    assert z.time() == "17:00:00Z"
+    assert z.timestamptz() == "2024-01-01 17:00:00+00"
+    assert z == ZuluTime("2024-01-01T17:00:00Z")
+    plus2 = datetime.timezone(datetime.timedelta(hours=2))
+    assert repr(ZuluTime(datetime.datetime(2024, 1, 1, 1, tzinfo=plus2))) == "2023-12-31T23:00:00Z"
+
+
+def test_canonical_and_naive_times():
+    assert repr(ZuluTime("2024-01-01T10:00:00Z")) == "2024-01-01T10:00:00Z"
+    assert repr(ZuluTime("2024-01-01 10:00:00+00:00")) == "2024-01-01T10:00:00Z"
+    assert repr(ZuluTime(datetime.datetime(2024, 1, 1, 10))) == "2024-01-01T10:00:00Z"
+    assert ZuluTime("2024-01-01T10:00:00Z").met_ts() == "20240101_100000"
+
+
+def test_datetime64_matches_repr():
+    np = pytest.importorskip("numpy")
+    z = ZuluTime(OFFSET)
+    assert z.datetime64() == np.datetime64("2024-01-01T17:00:00", "s")
+    assert str(z.datetime64()) + "Z" == repr(z)
+
+
+def test_arrays_match_scalars():
+    np = pytest.importorskip("numpy")
+    values = [ "2024-01-01T10:00:00Z", "2024-01-01 11:00:00+00:00", OFFSET, "2024-01-02T00:30:00+01:00" ]
+    times = ZuluTime.parse_array(values)
+    assert times.dtype == np.dtype("datetime64[s]")
+    assert list(times) == [ ZuluTime(v).datetime64() for v in values ]
+    for form in [ "repr", "date", "time", "met_ts", "expo_ts", "timestamptz" ]:
+        assert list(ZuluTime.format_array(values, form)) == [ ZuluTime(v).format(form) for v in values ]
+    with pytest.raises(ValueError):
+        ZuluTime.format_array(values, "unknown")